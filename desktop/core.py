@@ -1,12 +1,31 @@
+import re
+import time
 import db
+import durable_queue
 import requests
+from queue import Empty
 from pyVintedVN import Vinted, requester
 from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
+import filters
+from filters import compile_banwords
+from message_template import item_fields
+import metrics
+from outbox import Outbox
+from photo_hashes import PhotoMatcher
+import priorities
+from relists import RelistDetector
+import supervisor
+import wire
 from logger import get_logger
 
 # Get logger for this module
 logger = get_logger(__name__)
 
+# Maximum number of scraped queries processed in a single batch
+MAX_ITEM_BATCHES = 50
+# Seconds before reading again a batch that couldn't be stored
+STORE_RETRY_DELAY = 5
+
 
 def process_query(query, name=None):
     """
@@ -80,6 +99,8 @@ def process_query(query, name=None):
     else:
         # add the query to the db
         db.add_query_to_db(processed_query, name)
+        # The scraper searches the new query right away
+        supervisor.send_command("queries_changed")
         return "Query added.", True
 
 
@@ -140,7 +161,7 @@ def process_remove_query(number):
         return "Invalid number.", False
 
 
-def process_update_query(query_id, query, name):
+def process_update_query(query_id, query, name, priority=priorities.NORMAL):
     """
     Process the update of a query in the database.
 
@@ -148,6 +169,7 @@ def process_update_query(query_id, query, name):
         query_id (int): The ID of the query to update
         query (str): The new Vinted query URL
         name (str, optional): A new name for the query. If provided, it will be used as the query name.
+        priority (int, optional): The dispatch priority of the query items, see priorities.py
 
     Returns:
         tuple: (message, success)
@@ -180,7 +202,7 @@ def process_update_query(query_id, query, name):
     )
 
     # Update the query in the database
-    if db.update_query_in_db(query_id, processed_query, name):
+    if db.update_query_in_db(query_id, processed_query, name, priority):
         return "Query updated.", True
     else:
         return "Failed to update query.", False
@@ -274,6 +296,86 @@ def get_user_country(profile_id):
     return user_country
 
 
+# A Telegram chat ID, or the @username of a public channel
+TELEGRAM_CHAT_ID = re.compile(r"-?\d+|@\w{5,32}")
+# Compiled filters of the queries, cached until the rules change
+item_filters = filters.ItemFilters(get_user_country)
+# The recent listings, to find the items listed again by their seller
+relist_detector = RelistDetector()
+# The photos of the notified listings, to find the items posted again with the same photo
+photo_matcher = PhotoMatcher()
+# The priorities of the queries and their usual prices, to order the new items
+query_priorities = priorities.QueryPriorities()
+
+# Metrics of the scraper and the extractor, see metrics.py
+fetch_seconds = metrics.histogram(
+    "vinted_fetch_seconds", "Duration of the search request of a query"
+)
+items_scraped = metrics.counter(
+    "vinted_items_scraped_total", "New items returned by the searches"
+)
+items_filtered = metrics.counter(
+    "vinted_items_filtered_total",
+    "Scraped items that were not notified, by reason",
+    ("reason",),
+)
+items_notified = metrics.counter(
+    "vinted_items_notified_total", "Items queued for the notification sinks"
+)
+queue_depth = metrics.gauge(
+    "vinted_queue_depth", "Messages waiting in a queue", ("queue",)
+)
+
+
+def process_add_filter_rule(query_id, rule, value):
+    """
+    Process the addition of a filter rule.
+
+    Args:
+        query_id (int): The ID of the query the rule applies to, None for every query
+        rule (str): The rule type, see filters.RULE_TYPES
+        value (str): The rule value
+
+    Returns:
+        tuple: (message, success)
+            - message (str): Status message
+            - success (bool): True if the rule was added
+    """
+    value = value.strip()
+    error = filters.validate_rule(rule, value)
+    if error:
+        return error, False
+    if not db.add_filter_rule(query_id, rule, value):
+        return "Failed to add rule.", False
+    return "Rule added.", True
+
+
+def process_add_telegram_route(query_id, chat_id):
+    """
+    Process the addition of a Telegram route.
+
+    Args:
+        query_id (int): The ID of the query whose items are sent to the chat, None for every query
+        chat_id (str): The chat ID, or the @username of a channel
+
+    Returns:
+        tuple: (message, success)
+            - message (str): Status message
+            - success (bool): True if the route was added
+    """
+    chat_id = chat_id.strip()
+    if not TELEGRAM_CHAT_ID.fullmatch(chat_id):
+        return "Invalid chat ID, use a number or the @username of a channel.", False
+    if any(
+        route_query_id == query_id and route_chat_id == chat_id
+        for _, route_query_id, route_chat_id in db.get_telegram_routes()
+    ):
+        return "This chat already gets these items.", False
+    if not db.add_telegram_route(query_id, chat_id):
+        return "Failed to add route.", False
+    return "Route added.", True
+
+
 def process_items(queue):
     """
     Process all queries from the database, search for items, and put them in the queue.
@@ -296,98 +398,241 @@ def process_items(queue):
 
     # for each keyword we parse data
     for query in all_queries:
+        # The stages of the items are timed until they are sent, see latency.py
+        trace = {"fetch_start": time.time()}
         all_items = vinted.items.search(query[1], nbr_items=items_per_query)
+        trace["fetch_end"] = time.time()
+        fetch_seconds.observe(trace["fetch_end"] - trace["fetch_start"])
         # Filter to only include new items. This should reduce the amount of db calls.
         data = [item for item in all_items if item.is_new_item()]
-        queue.put((data, query[0]))
+        items_scraped.inc(len(data))
+        trace["enqueued"] = time.time()
+        # Only the fields needed by the extractor are sent
+        queue.put(wire.encode_items(data, query[0], trace))
         logger.info(f"Scraped {len(data)} items for query: {query[1]}")
 
 
-def clear_item_queue(items_queue, new_items_queue):
+def clear_item_queue(items_queue, new_items_queue, seen_items=None, timeout=0):
     """
     Process items from the items_queue.
-    This function is scheduled to run frequently.
+    Waits up to timeout seconds for scraped items, then processes everything already queued as one batch.
+
+    Args:
+        items_queue (Queue): The queue of scraped items
+        new_items_queue (Queue): The queue to put the new items in
+        seen_items (SeenItems, optional): The ids of the stored items. The database is asked if not provided.
+        timeout (float, optional): Seconds to wait for items, 0 returns at once if the queue is empty
     """
-    if not items_queue.empty():
-        data, query_id = items_queue.get()
-        banwords_str = db.get_parameter("banwords")
-        for item in reversed(data):
-
-            # If already in db, pass
-            last_query_timestamp = db.get_last_timestamp(query_id)
-            if (
-                last_query_timestamp is not None
-                and last_query_timestamp >= item.raw_timestamp
-            ):
-                pass
-            # In case of multiple queries, we need to check if the item is already in the db
-            elif db.is_item_in_db_by_id(item.id) is True:
-                # We update the timestamp
-                db.update_last_timestamp(query_id, item.raw_timestamp)
-                pass
-            # If there's an allowlist and
-            # If the user's country is not in the allowlist, we just update the timestamp
-            elif db.get_allowlist() != 0 and (
-                get_user_country(item.raw_data["user"]["id"])
-            ) not in (db.get_allowlist() + ["XX"]):
-                db.update_last_timestamp(query_id, item.raw_timestamp)
-                pass
-            # Check if the item title contains any banwords
-            elif banwords_str and contains_banwords(item.title, banwords_str):
-                # If it contains banwords, just update the timestamp and skip
-                db.update_last_timestamp(query_id, item.raw_timestamp)
-                pass
-            else:
-                # We create the message
-                message_template = db.get_parameter("message_template")
-                content = message_template.format(
-                    title=item.title,
-                    price=str(item.price) + " " + item.currency,
-                    brand=item.brand_title,
-                    image=None if item.photo is None else item.photo,
-                )
-                # add the item to the queue
-                new_items_queue.put((content, item.url, "Open Vinted", None, None))
-                # new_items_queue.put((content, item.url, "Open Vinted", item.buy_url, "Open buy page"))
-                # Add the item to the db
-                db.add_item_to_db(
-                    id=item.id,
-                    timestamp=item.raw_timestamp,
-                    price=item.price,
-                    title=item.title,
-                    photo_url=item.photo,
-                    query_id=query_id,
-                    currency=item.currency,
+    try:
+        batches = [
+            items_queue.get(timeout=timeout) if timeout else items_queue.get_nowait()
+        ]
+    except Empty:
+        return
+    while len(batches) < MAX_ITEM_BATCHES:
+        try:
+            batches.append(items_queue.get_nowait())
+        except Empty:
+            break
+    picked = time.time()
+    try:
+        queue_depth.set(items_queue.qsize(), queue="items")
+    except NotImplementedError:
+        # No qsize() on macOS
+        pass
+
+    # Recompiles the filters if they changed since the last batch
+    item_filters.refresh()
+    relist_detector.refresh()
+    photo_matcher.refresh()
+    query_priorities.refresh()
+    batches = [wire.decode_items(message) for message in batches]
+    for _, _, trace in batches:
+        trace["picked"] = picked
+    # The writes of the whole batch are committed together, so the database doesn't see the
+    # items stored by the earlier queries of the batch: they are tracked here
+    stored = set()
+    last_timestamps = {}
+    with db.write_batch() as results:
+        # The new items accepted by the filters, checked against the notified ones next
+        candidates = []
+        for data, query_id, trace in batches:
+            candidates.extend(
+                _new_items(
+                    data,
+                    query_id,
+                    item_filters.get(query_id),
+                    seen_items,
+                    trace,
+                    last_timestamps,
                 )
+            )
+        if photo_matcher.enabled:
+            # The photos are downloaded while the first items are checked
+            photo_matcher.prefetch([item for item, _, _ in candidates])
+        for item, query_id, trace in candidates:
+            _queue_item(
+                item,
+                query_id,
+                trace,
+                new_items_queue,
+                relist_detector,
+                photo_matcher,
+                stored,
+            )
+    if results and not any(results):
+        # The commit failed, nothing was stored: the items are read again with a durable
+        # queue, and lost with an in-memory one
+        logger.error(f"Storing a batch of {len(batches)} scraped queries failed")
+        durable_queue.rewind(items_queue)
+        time.sleep(STORE_RETRY_DELAY)
+        return
+    if seen_items is not None:
+        # Only now, items seen by a failed batch are still new when it's read again
+        for item_id in stored:
+            seen_items.add(item_id)
+    # The scraped items are stored, they can leave the queue
+    durable_queue.ack(items_queue)
+    if isinstance(new_items_queue, Outbox):
+        # The notifications are committed, the sinks can read them
+        new_items_queue.notify()
+
+
+def _new_items(data, query_id, item_filter, seen_items, trace, last_timestamps):
+    """
+    Get the items scraped for a query that are new and accepted by its filters.
 
+    Args:
+        last_timestamps (dict): query id -> timestamp of its last item in the current write
+            batch, updated
 
-def contains_banwords(title, banwords_str):
+    Returns:
+        list: (item, query id, trace) of the items, oldest first
+    """
+    # Only the extractor updates it, so it's read once and then tracked here
+    last_query_timestamp = last_timestamps.get(query_id)
+    if last_query_timestamp is None:
+        last_query_timestamp = db.get_last_timestamp(query_id)
+
+    items = []
+    for item in reversed(data):
+
+        # If already in db, pass
+        if (
+            last_query_timestamp is not None
+            and last_query_timestamp >= item.raw_timestamp
+        ):
+            items_filtered.inc(reason="old")
+            continue
+
+        last_query_timestamp = last_timestamps[query_id] = item.raw_timestamp
+        # In case of multiple queries, we need to check if the item is already in the db
+        if (
+            item.id in seen_items
+            if seen_items is not None
+            else db.is_item_in_db_by_id(item.id) is True
+        ):
+            # We update the timestamp
+            db.update_last_timestamp(query_id, item.raw_timestamp)
+            items_filtered.inc(reason="seen")
+        # If a filter rejects the item (banwords, allowlist, query rules), we just update the timestamp
+        elif (rule := item_filter.rejects(item)) is not None:
+            db.update_last_timestamp(query_id, item.raw_timestamp)
+            items_filtered.inc(reason=rule)
+        else:
+            items.append((item, query_id, trace))
+    return items
+
+
+def _queue_item(
+    item,
+    query_id,
+    trace,
+    new_items_queue,
+    relist_detector,
+    photo_matcher,
+    stored,
+):
+    """
+    Store a new item accepted by the filters and queue its notification, unless it was
+    already notified.
+
+    Args:
+        stored (set): The ids of the items stored by the current write batch, updated
+    """
+    # Another query of the batch found it too
+    if item.id in stored:
+        db.update_last_timestamp(query_id, item.raw_timestamp)
+        items_filtered.inc(reason="seen")
+    # If the seller listed the same item again, it was already notified
+    elif relist_detector.check(item) is not None:
+        db.update_last_timestamp(query_id, item.raw_timestamp)
+        items_filtered.inc(reason="relist")
+    # If the photo was already notified with another listing
+    elif photo_matcher.check(item) is not None:
+        db.update_last_timestamp(query_id, item.raw_timestamp)
+        items_filtered.inc(reason="photo")
+    else:
+        # The sinks render the message themselves, from the item fields
+        notification = wire.encode_notification(
+            (
+                item_fields(item),
+                item.url,
+                "Open Vinted",
+                None,
+                None,
+                (
+                    query_id,
+                    {
+                        "listed": item.raw_timestamp,
+                        **trace,
+                        "filtered": time.time(),
+                    },
+                ),
+            )
+        )
+        # notification = wire.encode_notification((item_fields(item), item.url, "Open Vinted", item.buy_url, "Open buy page"))
+        if isinstance(new_items_queue, Outbox):
+            # The notifications are written with the item, in the same transaction
+            sinks = new_items_queue.active_sinks()
+        else:
+            # The dispatcher sends the items by priority
+            priority, boost = query_priorities.rate(query_id, item)
+            new_items_queue.put(
+                wire.encode_dispatch(notification, time.time(), priority, boost)
+            )
+            sinks = []
+        # Add the item to the db
+        db.add_item_to_db(
+            id=item.id,
+            timestamp=item.raw_timestamp,
+            price=item.price,
+            title=item.title,
+            photo_url=item.photo,
+            query_id=query_id,
+            currency=item.currency,
+            notification=notification if sinks else None,
+            sinks=sinks,
+        )
+        stored.add(item.id)
+        items_notified.inc()
+
+
+def contains_banwords(title, banwords_str, whole_word=False, ignore_accents=False):
     """
     Check if a title contains any banwords.
 
+    The banwords are compiled into a matcher once per banwords string and cached.
+
     Args:
         title (str): The title to check
         banwords_str (str): List of banwords separated by 3 pipe character
+        whole_word (bool, optional): Only match whole words
+        ignore_accents (bool, optional): Ignore accents in both the title and the banwords
     Returns:
         bool: True if the title contains any banwords, False otherwise
     """
-
-    # Split the banwords string into a list using pipe as delimiter
-    banwords = [
-        word.strip().lower() for word in banwords_str.split("|||") if word.strip()
-    ]
-
-    # If the list is empty, return False
-    if not banwords:
-        return False
-
-    # Check if any banword is in the title (case-insensitive)
-    title_lower = title.lower()
-    for word in banwords:
-        if word in title_lower:
-            return True
-
-    return False
+    return compile_banwords(banwords_str, whole_word, ignore_accents).matches(title)
 
 
 def check_version():
@@ -1,15 +1,213 @@
+import functools
+import inspect
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
 from traceback import print_exc
 
+import metrics
+from logger import get_logger
+
+# Get logger for this module
+logger = get_logger(__name__)
+
 DB_PATH = "./data/vinted_notifications.db"
 
+# Client of the database writer process, see use_writer()
+_writer = None
+# Holds the write batch opened by write_batch() in the current thread
+_local = threading.local()
+# Write operations by name, so the writer process can run them
+_WRITE_OPERATIONS = {}
+# Duration of each read and write operation and of the commits, see metrics.py
+_operation_seconds = metrics.histogram(
+    "vinted_db_operation_seconds",
+    "Duration of a database read or write operation",
+    ("operation",),
+    buckets=metrics.FAST_BUCKETS,
+)
+_commit_seconds = metrics.histogram(
+    "vinted_db_commit_seconds",
+    "Duration of the commit of a write transaction",
+    buckets=metrics.FAST_BUCKETS,
+)
+
 
 def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_read_connection()
     conn.execute("PRAGMA foreign_keys = ON")
     return conn
 
 
+def get_read_connection():
+    """
+    Open a connection for reading.
+
+    When writes go through the writer process, the connection is opened read-only so this
+    process never takes the database write lock.
+
+    Returns:
+        sqlite3.Connection: The connection
+    """
+    if _writer is not None:
+        return sqlite3.connect(f"{Path(DB_PATH).resolve().as_uri()}?mode=ro", uri=True)
+    return sqlite3.connect(DB_PATH)
+
+
+def use_writer(writer_client):
+    """
+    Send every write made by this process to the database writer process.
+
+    Args:
+        writer_client (db_writer.WriterClient): The client connected to the writer process
+    """
+    global _writer
+    _writer = writer_client
+
+
+def _write_operation(function):
+    # Register a function running write statements on a cursor, so the writer process can run it by name
+    _WRITE_OPERATIONS[function.__name__] = function
+    return function
+
+
+def _read_operation(function):
+    # Time a read function under its name. A generator is timed while it runs, not while its
+    # caller handles the rows.
+    if inspect.isgeneratorfunction(function):
+
+        @functools.wraps(function)
+        def timed_generator(*args, **kwargs):
+            rows = function(*args, **kwargs)
+            elapsed = 0
+            try:
+                while True:
+                    start = time.perf_counter()
+                    try:
+                        row = next(rows)
+                    except StopIteration:
+                        return
+                    finally:
+                        elapsed += time.perf_counter() - start
+                    yield row
+            finally:
+                rows.close()
+                _operation_seconds.observe(elapsed, operation=function.__name__)
+
+        return timed_generator
+
+    @functools.wraps(function)
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _operation_seconds.observe(
+                time.perf_counter() - start, operation=function.__name__
+            )
+
+    return timed
+
+
+def run_write_operations(operations, conn=None):
+    """
+    Run write operations in a single transaction.
+
+    Each operation runs in its own savepoint, so a failing operation doesn't undo the others.
+    This is used directly when there is no writer process, and by the writer process itself.
+
+    Args:
+        operations (list): (operation name, args) tuples
+        conn (sqlite3.Connection, optional): An autocommit connection to use. A new one is opened if not provided.
+
+    Returns:
+        list: A bool per operation, True if it was applied
+    """
+    own_conn = conn is None
+    results = []
+    try:
+        if own_conn:
+            conn = get_db_connection()
+            conn.isolation_level = None
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        for name, args in operations:
+            cursor.execute("SAVEPOINT operation")
+            start = time.perf_counter()
+            try:
+                _WRITE_OPERATIONS[name](cursor, *args)
+                results.append(True)
+            except Exception:
+                # Whatever the operation raised, the others of the batch are still applied
+                logger.exception(f"Write operation {name} failed")
+                cursor.execute("ROLLBACK TO operation")
+                results.append(False)
+            cursor.execute("RELEASE operation")
+            _operation_seconds.observe(time.perf_counter() - start, operation=name)
+        start = time.perf_counter()
+        cursor.execute("COMMIT")
+        _commit_seconds.observe(time.perf_counter() - start)
+        return results
+    except sqlite3.Error:
+        print_exc()
+        if conn is not None and conn.in_transaction:
+            conn.rollback()
+        return [False] * len(operations)
+    finally:
+        if own_conn and conn:
+            conn.close()
+
+
+def _write(operation, *args):
+    """
+    Run a write operation.
+
+    The operation is added to the write batch if one is open, sent to the writer process if
+    this process uses one, or run right away in its own transaction otherwise.
+
+    Returns:
+        bool: True if the operation was applied (or queued in a write batch), False otherwise
+    """
+    batch = getattr(_local, "batch", None)
+    if batch is not None:
+        batch.append((operation.__name__, args))
+        return True
+    if _writer is not None:
+        return _writer.execute([(operation.__name__, args)])[0]
+    return run_write_operations([(operation.__name__, args)])[0]
+
+
+@contextmanager
+def write_batch():
+    """
+    Group the writes made in the block into a single transaction.
+
+    With a writer process, the whole batch is also sent as a single message. Writes in the
+    block are applied when the block exits, so reads inside the block don't see them yet.
+
+    Yields:
+        list: Filled when the block exits with a bool per write of the batch, True if it was
+            applied. A nested batch gets the list of the outer one.
+    """
+    if getattr(_local, "batch", None) is not None:
+        # Nested batches join the outer one
+        yield _local.results
+        return
+    _local.batch = []
+    _local.results = results = []
+    try:
+        yield results
+    finally:
+        operations, _local.batch = _local.batch, None
+        if operations:
+            if _writer is not None:
+                results[:] = _writer.execute(operations)
+            else:
+                results[:] = run_write_operations(operations)
+
+
 def create_or_update_sqlite_db(db_path):
     conn = None
     try:
@@ -28,10 +226,11 @@ def create_or_update_sqlite_db(db_path):
             conn.close()
 
 
+@_read_operation
 def is_item_in_db_by_id(id):
     conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_read_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT COUNT() FROM items WHERE item=?", (id,))
         if cursor.fetchone()[0]:
@@ -44,10 +243,33 @@ def is_item_in_db_by_id(id):
             conn.close()
 
 
+@_read_operation
+def iter_item_ids():
+    """
+    Yield the ids of all the stored items, without loading them all in memory.
+
+    Yields:
+        int: An item id
+    """
+    conn = None
+    try:
+        conn = get_read_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT item FROM items")
+        for row in cursor:
+            yield row[0]
+    except sqlite3.Error:
+        print_exc()
+    finally:
+        if conn:
+            conn.close()
+
+
+@_read_operation
 def get_last_timestamp(query_id):
     conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_read_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT last_item FROM queries WHERE id=?", (query_id,))
         result = cursor.fetchone()
@@ -63,49 +285,312 @@ def get_last_timestamp(query_id):
 
 
 def update_last_timestamp(query_id, timestamp):
+    _write(_update_last_timestamp, query_id, timestamp)
+
+
+@_write_operation
+def _update_last_timestamp(cursor, query_id, timestamp):
+    cursor.execute("UPDATE queries SET last_item=? WHERE id=?", (timestamp, query_id))
+
+
+def add_item_to_db(
+    id,
+    title,
+    query_id,
+    price,
+    timestamp,
+    photo_url,
+    currency="EUR",
+    notification=None,
+    sinks=(),
+):
+    """
+    Add a new item.
+
+    Args:
+        notification (bytes, optional): The notification of the item, added to the outbox of each sink
+            in the same transaction, so there is never an item without its notification or the reverse
+        sinks (list, optional): The names of the sinks to notify
+    """
+    _write(
+        _add_item,
+        id,
+        title,
+        query_id,
+        price,
+        timestamp,
+        photo_url,
+        currency,
+        notification,
+        list(sinks),
+    )
+
+
+@_write_operation
+def _add_item(
+    cursor,
+    id,
+    title,
+    query_id,
+    price,
+    timestamp,
+    photo_url,
+    currency,
+    notification=None,
+    sinks=(),
+):
+    # Insert into db the id and the query_id related to the item
+    cursor.execute(
+        "INSERT INTO items (item, title, price, currency, timestamp, photo_url, query_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (id, title, price, currency, timestamp, photo_url, query_id),
+    )
+    # Update the last item for the query
+    cursor.execute("UPDATE queries SET last_item=? WHERE id=?", (timestamp, query_id))
+    now = time.time()
+    cursor.executemany(
+        "INSERT OR IGNORE INTO outbox (sink, item, message, created_at) VALUES (?, ?, ?, ?)",
+        [(sink, str(id), notification, now) for sink in sinks],
+    )
+
+
+@_read_operation
+def get_outbox_entries(sink, after=0, limit=100):
+    """
+    Get the notifications of a sink that are due, oldest first.
+
+    Args:
+        sink (str): The sink name
+        after (int, optional): Only the entries with a greater id
+        limit (int, optional): The maximum number of entries
+
+    Returns:
+        list: (id, message, attempts) tuples
+    """
     conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_read_connection()
         cursor = conn.cursor()
         cursor.execute(
-            "UPDATE queries SET last_item=? WHERE id=?", (timestamp, query_id)
+            "SELECT id, message, attempts FROM outbox WHERE sink=? AND id>? AND next_attempt<=? ORDER BY id LIMIT ?",
+            (sink, after, time.time(), limit),
         )
-        conn.commit()
-    except Exception:
+        return cursor.fetchall()
+    except sqlite3.Error:
         print_exc()
+        return []
     finally:
         if conn:
             conn.close()
 
 
-def add_item_to_db(id, title, query_id, price, timestamp, photo_url, currency="EUR"):
+@_read_operation
+def get_next_outbox_attempt(sink, after=0):
+    """
+    Args:
+        sink (str): The sink name
+        after (int, optional): Only the entries with a greater id
+
+    Returns:
+        float: When the next notification of a sink waiting for a retry is due, None if there is none
+    """
     conn = None
     try:
-        conn = get_db_connection()
+        conn = get_read_connection()
         cursor = conn.cursor()
-        # Insert into db the id and the query_id related to the item
         cursor.execute(
-            "INSERT INTO items (item, title, price, currency, timestamp, photo_url, query_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (id, title, price, currency, timestamp, photo_url, query_id),
+            "SELECT MIN(next_attempt) FROM outbox WHERE sink=? AND id>? AND attempts>0",
+            (sink, after),
         )
-        # Update the last item for the query
+        return cursor.fetchone()[0]
+    except sqlite3.Error:
+        print_exc()
+    finally:
+        if conn:
+            conn.close()
+
+
+@_read_operation
+def get_outbox_stats():
+    """
+    Returns:
+        dict: For each sink with notifications waiting, their number, how many are retried
+            and how many seconds the oldest one has been waiting. The entries of the
+            destinations of a sink ("telegram:<chat id>") are counted with it.
+    """
+    conn = None
+    try:
+        conn = get_read_connection()
+        cursor = conn.cursor()
         cursor.execute(
-            "UPDATE queries SET last_item=? WHERE id=?", (timestamp, query_id)
+            "SELECT CASE WHEN instr(sink, ':') THEN substr(sink, 1, instr(sink, ':') - 1) ELSE sink END name, "
+            "COUNT(*), SUM(attempts>0), MIN(created_at) FROM outbox GROUP BY name"
         )
-        conn.commit()
-    except Exception:
+        now = time.time()
+        return {
+            sink: {"waiting": waiting, "retrying": retrying, "lag": now - oldest}
+            for sink, waiting, retrying, oldest in cursor.fetchall()
+        }
+    except sqlite3.Error:
+        print_exc()
+        return {}
+    finally:
+        if conn:
+            conn.close()
+
+
+@_read_operation
+def count_outbox_entries(prefix):
+    """
+    Args:
+        prefix (str): The start of the sink names, e.g. "telegram:" for the chats of the bot
+
+    Returns:
+        dict: sink -> number of notifications waiting, for the sinks with some
+    """
+    conn = None
+    try:
+        conn = get_read_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT sink, COUNT(*) FROM outbox WHERE substr(sink, 1, ?)=? GROUP BY sink",
+            (len(prefix), prefix),
+        )
+        return dict(cursor.fetchall())
+    except sqlite3.Error:
+        print_exc()
+        return {}
+    finally:
+        if conn:
+            conn.close()
+
+
+def add_to_outbox(entries):
+    """
+    Add notifications to the outbox, in a single transaction. An item already waiting for
+    the same sink isn't added again.
+
+    Args:
+        entries (list): (sink, item, message) tuples
+
+    Returns:
+        bool: True if they were added
+    """
+    return _write(_add_to_outbox, list(entries))
+
+
+@_write_operation
+def _add_to_outbox(cursor, entries):
+    now = time.time()
+    cursor.executemany(
+        "INSERT OR IGNORE INTO outbox (sink, item, message, created_at) VALUES (?, ?, ?, ?)",
+        [(sink, item, message, now) for sink, item, message in entries],
+    )
+
+
+def remove_from_outbox(entry_ids):
+    _write(_remove_from_outbox, list(entry_ids))
+
+
+@_write_operation
+def _remove_from_outbox(cursor, entry_ids):
+    cursor.executemany("DELETE FROM outbox WHERE id=?", [(i,) for i in entry_ids])
+
+
+def retry_outbox_entry(entry_id, next_attempt):
+    _write(_retry_outbox_entry, entry_id, next_attempt)
+
+
+@_write_operation
+def _retry_outbox_entry(cursor, entry_id, next_attempt):
+    cursor.execute(
+        "UPDATE outbox SET attempts=attempts+1, next_attempt=? WHERE id=?",
+        (next_attempt, entry_id),
+    )
+
+
+def clear_outbox(sink):
+    _write(_clear_outbox, sink)
+
+
+@_write_operation
+def _clear_outbox(cursor, sink):
+    # With the entries of its destinations
+    cursor.execute(
+        "DELETE FROM outbox WHERE sink=? OR substr(sink, 1, ?)=?",
+        (sink, len(sink) + 1, sink + ":"),
+    )
+
+
+@_read_operation
+def get_item_signatures(since, limit):
+    """
+    Get the title signatures of the recent listings, see relists.py.
+
+    Args:
+        since (float): Only the listings seen after this timestamp
+        limit (int): The maximum number of listings, the most recent are kept
+
+    Returns:
+        list: (item, user_id, price, title, signature, listed_at, relist_of) tuples, oldest first
+    """
+    conn = None
+    try:
+        conn = get_read_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT * FROM (SELECT item, user_id, price, title, signature, listed_at, relist_of FROM item_signatures "
+            "WHERE listed_at>=? ORDER BY listed_at DESC LIMIT ?) ORDER BY listed_at",
+            (since, limit),
+        )
+        return cursor.fetchall()
+    except sqlite3.Error:
         print_exc()
+        return []
     finally:
         if conn:
             conn.close()
 
 
+def add_item_signature(item, user_id, price, title, signature, listed_at, relist_of):
+    _write(
+        _add_item_signature,
+        item,
+        user_id,
+        price,
+        title,
+        signature,
+        listed_at,
+        relist_of,
+    )
+
+
+@_write_operation
+def _add_item_signature(
+    cursor, item, user_id, price, title, signature, listed_at, relist_of
+):
+    cursor.execute(
+        "INSERT OR REPLACE INTO item_signatures (item, user_id, price, title, signature, listed_at, relist_of) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (item, user_id, price, title, signature, listed_at, relist_of),
+    )
+
+
+def prune_item_signatures(before):
+    _write(_prune_item_signatures, before)
+
+
+@_write_operation
+def _prune_item_signatures(cursor, before):
+    cursor.execute("DELETE FROM item_signatures WHERE listed_at<?", (before,))
+
+
+@_read_operation
 def get_queries():
     conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_read_connection()
         cursor = conn.cursor()
-        cursor.execute("SELECT id, query, last_item, query_name FROM queries")
+        cursor.execute("SELECT id, query, last_item, query_name, priority FROM queries")
         return cursor.fetchall()
     except Exception:
         print_exc()
@@ -114,10 +599,11 @@ def get_queries():
             conn.close()
 
 
+@_read_operation
 def is_query_in_db(processed_query):
     conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_read_connection()
         cursor = conn.cursor()
         # replace spaces in searched_text by % to match any query containing the searched text
 
@@ -136,31 +622,27 @@ def is_query_in_db(processed_query):
 
 
 def add_query_to_db(query, name=None):
-    conn = None
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        if name:
-            cursor.execute(
-                "INSERT INTO queries (query, last_item, query_name) VALUES (?, NULL, ?)",
-                (query, name),
-            )
-        else:
-            cursor.execute(
-                "INSERT INTO queries (query, last_item) VALUES (?, NULL)", (query,)
-            )
-        conn.commit()
-    except Exception:
-        print_exc()
-    finally:
-        if conn:
-            conn.close()
+    _write(_add_query, query, name)
+
+
+@_write_operation
+def _add_query(cursor, query, name):
+    if name:
+        cursor.execute(
+            "INSERT INTO queries (query, last_item, query_name) VALUES (?, NULL, ?)",
+            (query, name),
+        )
+    else:
+        cursor.execute(
+            "INSERT INTO queries (query, last_item) VALUES (?, NULL)", (query,)
+        )
 
 
+@_read_operation
 def get_query_id_by_rowid(rowid):
     conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_read_connection()
         cursor = conn.cursor()
         query = f"SELECT id FROM (SELECT id, ROW_NUMBER() OVER (ORDER BY ROWID) rn FROM queries) t WHERE rn={rowid}"
         cursor.execute(query)
@@ -177,40 +659,38 @@ def get_query_id_by_rowid(rowid):
 
 
 def remove_query_from_db(query_number):
-    conn = None
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        # Delete items associated with this query using query_id
-        cursor.execute("DELETE FROM items WHERE query_id=?", (query_number,))
-        # Delete the query
-        cursor.execute("DELETE FROM queries WHERE id=?", (query_number,))
-        conn.commit()
-    except Exception:
-        print_exc()
-    finally:
-        if conn:
-            conn.close()
+    _write(_remove_query, query_number)
+
+
+@_write_operation
+def _remove_query(cursor, query_number):
+    # Delete items associated with this query using query_id
+    cursor.execute("DELETE FROM items WHERE query_id=?", (query_number,))
+    # Delete the filter rules of this query
+    cursor.execute("DELETE FROM filter_rules WHERE query_id=?", (query_number,))
+    _bump_filter_rules_version(cursor)
+    # Delete the Telegram routes of this query
+    cursor.execute("DELETE FROM telegram_routes WHERE query_id=?", (query_number,))
+    # Delete the query
+    cursor.execute("DELETE FROM queries WHERE id=?", (query_number,))
 
 
 def remove_all_queries_from_db():
-    conn = None
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        # Delete all items first to maintain foreign key integrity
-        cursor.execute("DELETE FROM items")
-        # Then delete all queries
-        cursor.execute("DELETE FROM queries")
-        conn.commit()
-    except Exception:
-        print_exc()
-    finally:
-        if conn:
-            conn.close()
+    _write(_remove_all_queries)
+
+
+@_write_operation
+def _remove_all_queries(cursor):
+    # Delete all items and query filter rules first to maintain foreign key integrity
+    cursor.execute("DELETE FROM items")
+    cursor.execute("DELETE FROM filter_rules WHERE query_id IS NOT NULL")
+    _bump_filter_rules_version(cursor)
+    cursor.execute("DELETE FROM telegram_routes WHERE query_id IS NOT NULL")
+    # Then delete all queries
+    cursor.execute("DELETE FROM queries")
 
 
-def update_query_in_db(query_id, query, name):
+def update_query_in_db(query_id, query, name, priority=0):
     """
     Update an existing query in the database.
 
@@ -218,60 +698,95 @@ def update_query_in_db(query_id, query, name):
         query_id (int): The ID of the query to update
         query (str): The new query URL
         name (str, optional): The new name for the query
+        priority (int, optional): The dispatch priority of its items, see priorities.py
 
     Returns:
         bool: True if the query was updated successfully, False otherwise
     """
+    return _write(_update_query, query_id, query, name, priority)
+
+
+@_write_operation
+def _update_query(cursor, query_id, query, name, priority):
+    cursor.execute(
+        "UPDATE queries SET query=?, query_name=?, priority=? WHERE id=?",
+        (query, name, priority, query_id),
+    )
+
+
+@_read_operation
+def get_query_priorities():
+    """
+    Returns:
+        dict: The dispatch priority of each query, by query id
+    """
     conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_read_connection()
         cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE queries SET query=?, query_name=? WHERE id=?",
-            (query, name, query_id),
-        )
-        conn.commit()
-        return True
-    except Exception:
+        cursor.execute("SELECT id, priority FROM queries")
+        return dict(cursor.fetchall())
+    except sqlite3.Error:
         print_exc()
-        return False
+        return {}
     finally:
         if conn:
             conn.close()
 
 
-def add_to_allowlist(country):
+@_read_operation
+def get_recent_prices(query_id, limit):
+    """
+    Get the prices of the last items found by a query.
+
+    Args:
+        query_id (int): The query id
+        limit (int): The maximum number of prices
+
+    Returns:
+        list: The prices, oldest first
+    """
     conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_read_connection()
         cursor = conn.cursor()
-        cursor.execute("INSERT INTO allowlist VALUES (?)", (country,))
-        conn.commit()
-    except Exception:
+        cursor.execute(
+            "SELECT price FROM items WHERE query_id=? AND price IS NOT NULL "
+            "ORDER BY timestamp DESC LIMIT ?",
+            (query_id, limit),
+        )
+        return [float(row[0]) for row in reversed(cursor.fetchall())]
+    except (sqlite3.Error, ValueError):
         print_exc()
+        return []
     finally:
         if conn:
             conn.close()
 
 
+def add_to_allowlist(country):
+    _write(_add_to_allowlist, country)
+
+
+@_write_operation
+def _add_to_allowlist(cursor, country):
+    cursor.execute("INSERT INTO allowlist VALUES (?)", (country,))
+
+
 def remove_from_allowlist(country):
-    conn = None
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM allowlist WHERE country=?", (country,))
-        conn.commit()
-    except Exception:
-        print_exc()
-    finally:
-        if conn:
-            conn.close()
+    _write(_remove_from_allowlist, country)
 
 
+@_write_operation
+def _remove_from_allowlist(cursor, country):
+    cursor.execute("DELETE FROM allowlist WHERE country=?", (country,))
+
+
+@_read_operation
 def get_allowlist():
     conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_read_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM allowlist")
         # Get list of countries
@@ -286,23 +801,113 @@ def get_allowlist():
 
 
 def clear_allowlist():
+    _write(_clear_allowlist)
+
+
+@_write_operation
+def _clear_allowlist(cursor):
+    cursor.execute("DELETE FROM allowlist")
+
+
+@_read_operation
+def get_filter_rules():
+    """
+    Get all the filter rules.
+
+    Returns:
+        list: (id, query_id, rule, value) tuples. query_id is None for rules applying to every query.
+    """
     conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_read_connection()
         cursor = conn.cursor()
-        cursor.execute("DELETE FROM allowlist")
-        conn.commit()
-    except Exception:
+        cursor.execute("SELECT id, query_id, rule, value FROM filter_rules ORDER BY id")
+        return cursor.fetchall()
+    except sqlite3.Error:
+        print_exc()
+        return []
+    finally:
+        if conn:
+            conn.close()
+
+
+def add_filter_rule(query_id, rule, value):
+    return _write(_add_filter_rule, query_id, rule, value)
+
+
+@_write_operation
+def _add_filter_rule(cursor, query_id, rule, value):
+    cursor.execute(
+        "INSERT INTO filter_rules (query_id, rule, value) VALUES (?, ?, ?)",
+        (query_id, rule, value),
+    )
+    _bump_filter_rules_version(cursor)
+
+
+def remove_filter_rule(rule_id):
+    return _write(_remove_filter_rule, rule_id)
+
+
+@_write_operation
+def _remove_filter_rule(cursor, rule_id):
+    cursor.execute("DELETE FROM filter_rules WHERE id=?", (rule_id,))
+    _bump_filter_rules_version(cursor)
+
+
+def _bump_filter_rules_version(cursor):
+    cursor.execute(
+        "UPDATE parameters SET value = CAST(value AS INTEGER) + 1 WHERE key='filter_rules_version'"
+    )
+
+
+@_read_operation
+def get_telegram_routes():
+    """
+    Get all the Telegram routes.
+
+    Returns:
+        list: (id, query_id, chat_id) tuples. query_id is None for routes getting every item.
+    """
+    conn = None
+    try:
+        conn = get_read_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, query_id, chat_id FROM telegram_routes ORDER BY id")
+        return cursor.fetchall()
+    except sqlite3.Error:
         print_exc()
+        return []
     finally:
         if conn:
             conn.close()
 
 
+def add_telegram_route(query_id, chat_id):
+    return _write(_add_telegram_route, query_id, chat_id)
+
+
+@_write_operation
+def _add_telegram_route(cursor, query_id, chat_id):
+    cursor.execute(
+        "INSERT INTO telegram_routes (query_id, chat_id) VALUES (?, ?)",
+        (query_id, chat_id),
+    )
+
+
+def remove_telegram_route(route_id):
+    return _write(_remove_telegram_route, route_id)
+
+
+@_write_operation
+def _remove_telegram_route(cursor, route_id):
+    cursor.execute("DELETE FROM telegram_routes WHERE id=?", (route_id,))
+
+
+@_read_operation
 def get_parameter(key):
     conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_read_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT value FROM parameters WHERE key=?", (key,))
         result = cursor.fetchone()
@@ -315,71 +920,194 @@ def get_parameter(key):
 
 
 def set_parameter(key, value):
+    _write(_set_parameter, key, value)
+
+
+@_write_operation
+def _set_parameter(cursor, key, value):
+    cursor.execute("UPDATE parameters SET value=? WHERE key=?", (value, key))
+
+
+@_read_operation
+def get_all_parameters():
     conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_read_connection()
         cursor = conn.cursor()
-        cursor.execute("UPDATE parameters SET value=? WHERE key=?", (value, key))
-        conn.commit()
+        cursor.execute("SELECT key, value FROM parameters")
+        return {row[0]: row[1] for row in cursor.fetchall()}
     except Exception:
         print_exc()
+        return {}
     finally:
         if conn:
             conn.close()
 
 
-def get_all_parameters():
+@_read_operation
+def iter_items(limit=50, query_id=None, before=None):
+    """
+    Yield the most recent items, newest first, one row at a time.
+
+    Items are paginated with a keyset cursor on (timestamp, item), so a page deep in
+    the history costs the same as the first one and rows are never all held in memory.
+
+    Args:
+        limit (int): The maximum number of items to yield
+        query_id (int, optional): Only yield items found by this query
+        before (tuple, optional): The (timestamp, item) of the last row of the previous page
+
+    Yields:
+        tuple: (item, title, price, currency, timestamp, query, photo_url, query_name)
+    """
     conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_read_connection()
         cursor = conn.cursor()
-        cursor.execute("SELECT key, value FROM parameters")
-        return {row[0]: row[1] for row in cursor.fetchall()}
-    except Exception:
+        sql = (
+            "SELECT i.item, i.title, i.price, i.currency, i.timestamp, q.query, i.photo_url, q.query_name "
+            "FROM items i JOIN queries q ON i.query_id = q.id WHERE 1"
+        )
+        args = []
+        if query_id is not None:
+            sql += " AND i.query_id = ?"
+            args.append(query_id)
+        if before is not None:
+            sql += " AND (i.timestamp, i.item) < (?, ?)"
+            args.extend(before)
+        sql += " ORDER BY i.timestamp DESC, i.item DESC LIMIT ?"
+        args.append(limit)
+        cursor.execute(sql, args)
+        yield from cursor
+    except sqlite3.Error:
         print_exc()
-        return {}
     finally:
         if conn:
             conn.close()
 
 
-def get_items(limit=50, query=None):
+def get_items(limit=50, query=None, before=None):
+    """
+    Get the most recent items, newest first.
+
+    Args:
+        limit (int): The maximum number of items to return
+        query (str, optional): Only return items found by this query URL
+        before (tuple, optional): The (timestamp, item) of the last row of the previous page
+
+    Returns:
+        list: Rows as yielded by iter_items
+    """
+    query_id = None
+    if query:
+        # Get the query_id for the given query
+        query_id = get_query_id(query)
+        if query_id is None:
+            return []
+    return list(iter_items(limit=limit, query_id=query_id, before=before))
+
+
+@_read_operation
+def get_query_id(query):
     conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_read_connection()
         cursor = conn.cursor()
-        if query:
-            # Get the query_id for the given query
-            cursor.execute("SELECT id FROM queries WHERE query=?", (query,))
-            result = cursor.fetchone()
-            if result:
-                query_id = result[0]
-                # Get items with the matching query_id
-                cursor.execute(
-                    "SELECT i.item, i.title, i.price, i.currency, i.timestamp, q.query, i.photo_url, q.query_name FROM items i JOIN queries q ON i.query_id = q.id WHERE i.query_id=? ORDER BY i.timestamp DESC LIMIT ?",
-                    (query_id, limit),
-                )
-            else:
-                return []
-        else:
-            # Join with queries table to get the query text
-            cursor.execute(
-                "SELECT i.item, i.title, i.price, i.currency, i.timestamp, q.query, i.photo_url, q.query_name FROM items i JOIN queries q ON i.query_id = q.id ORDER BY i.timestamp DESC LIMIT ?",
-                (limit,),
-            )
-        return cursor.fetchall()
-    except Exception:
+        cursor.execute("SELECT id FROM queries WHERE query=?", (query,))
+        result = cursor.fetchone()
+        return result[0] if result else None
+    except sqlite3.Error:
         print_exc()
-        return []
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+
+def _fts_match_expression(text):
+    """
+    Turn free text typed by a user into a safe FTS5 match expression.
+
+    Every word is quoted so FTS5 operators typed by the user are matched literally,
+    and the last word is used as a prefix so results show up while typing.
+
+    Args:
+        text (str): The text to search for
+
+    Returns:
+        str: The match expression, or None if the text contains no words
+    """
+    words = [word.replace('"', '""') for word in text.split()]
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+@_read_operation
+def search_items(text, limit=50, cursor=None, query_id=None):
+    """
+    Search the stored items by title using the FTS5 index.
+
+    Results are ranked by relevance (bm25) and paginated with a keyset cursor, so
+    fetching a later page costs the same as fetching the first one.
+
+    Args:
+        text (str): The text to search for
+        limit (int): The maximum number of items to return
+        cursor (tuple, optional): The (rank, rowid) cursor returned with the previous page
+        query_id (int, optional): Only return items found by this query
+
+    Returns:
+        tuple: (items, next_cursor)
+            - items (list): Rows with the same columns as get_items
+            - next_cursor (tuple): The cursor for the next page, or None if this is the last page
+    """
+    match = _fts_match_expression(text)
+    if match is None:
+        return [], None
+
+    conn = None
+    try:
+        conn = get_read_connection()
+        cursor_db = conn.cursor()
+        sql = (
+            "SELECT i.item, i.title, i.price, i.currency, i.timestamp, q.query, i.photo_url, q.query_name, "
+            "f.rank, f.rowid FROM items_fts f JOIN items i ON i.id = f.rowid JOIN queries q ON i.query_id = q.id "
+            "WHERE items_fts MATCH ?"
+        )
+        args = [match]
+        if cursor is not None:
+            sql += " AND (f.rank > ? OR (f.rank = ? AND f.rowid > ?))"
+            args.extend([cursor[0], cursor[0], cursor[1]])
+        if query_id is not None:
+            sql += " AND i.query_id = ?"
+            args.append(query_id)
+        # Fetch one extra row to know if there is a next page
+        sql += " ORDER BY f.rank, f.rowid LIMIT ?"
+        args.append(limit + 1)
+        cursor_db.execute(sql, args)
+        rows = cursor_db.fetchall()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = (rows[-1][8], rows[-1][9])
+        return [row[:8] for row in rows], next_cursor
+    except sqlite3.Error:
+        print_exc()
+        return [], None
     finally:
         if conn:
             conn.close()
 
 
+@_read_operation
 def get_total_items_count():
     conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_read_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT COUNT(*) FROM items")
         return cursor.fetchone()[0]
@@ -391,10 +1119,11 @@ def get_total_items_count():
             conn.close()
 
 
+@_read_operation
 def get_total_queries_count():
     conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_read_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT COUNT(*) FROM queries")
         return cursor.fetchone()[0]
@@ -406,10 +1135,11 @@ def get_total_queries_count():
             conn.close()
 
 
+@_read_operation
 def get_last_found_item():
     conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_read_connection()
         cursor = conn.cursor()
         cursor.execute(
             "SELECT i.item, i.title, i.price, i.currency, i.timestamp, q.query, i.photo_url FROM items i JOIN queries q ON i.query_id = q.id ORDER BY i.timestamp DESC LIMIT 1"
@@ -423,10 +1153,11 @@ def get_last_found_item():
             conn.close()
 
 
+@_read_operation
 def get_items_per_day():
     conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_read_connection()
         cursor = conn.cursor()
 
         # Get total items
@@ -0,0 +1,156 @@
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+
+import db
+import metrics
+import profiling
+from logger import get_logger
+
+# Get logger for this module
+logger = get_logger(__name__)
+
+# Maximum number of messages committed in a single transaction
+MAX_BATCH_SIZE = 200
+# Seconds a client waits for the writer to acknowledge a write
+ACK_TIMEOUT = 30
+
+
+class DatabaseWriter:
+    """
+    Owns every write to the SQLite database.
+
+    Processes send their writes as commands over a single queue. The writer drains the
+    queue, commits everything it got in one transaction and acknowledges each message on
+    the ack queue of the client that sent it. Since only the writer takes the write lock,
+    the other processes can keep read-only connections and never hit "database is locked".
+
+    Attributes:
+        requests (multiprocessing.Queue): The commands sent by the clients.
+        acks (dict): The acknowledgement queue of each client, by client name.
+    """
+
+    def __init__(self, client_names):
+        """
+        Initialize the queues shared with the clients.
+
+        The writer must be created before the processes using it are started.
+
+        Args:
+            client_names (list): The names of the processes that will send writes.
+        """
+        self.requests = multiprocessing.Queue()
+        self.acks = {name: multiprocessing.Queue() for name in client_names}
+
+    def client(self, name):
+        """
+        Get a client to send writes to this writer.
+
+        Args:
+            name (str): The client name given when the writer was created.
+
+        Returns:
+            WriterClient: The client.
+        """
+        return WriterClient(name, self.requests, self.acks[name])
+
+    def run(self):
+        """
+        Apply the writes sent by the clients until the process is stopped.
+        """
+        conn = db.get_db_connection()
+        conn.isolation_level = None
+        # WAL lets the read-only connections read while the writer commits
+        conn.execute("PRAGMA journal_mode=WAL")
+
+        while True:
+            messages = [self.requests.get()]
+            while len(messages) < MAX_BATCH_SIZE:
+                try:
+                    messages.append(self.requests.get_nowait())
+                except queue.Empty:
+                    break
+
+            operations = [operation for _, _, ops in messages for operation in ops]
+            results = db.run_write_operations(operations, conn)
+            failed = results.count(False)
+            if failed:
+                logger.error(f"{failed}/{len(operations)} database writes failed")
+
+            # Acknowledge every message with the results of its operations
+            for name, message_id, ops in messages:
+                self.acks[name].put((message_id, results[: len(ops)]))
+                results = results[len(ops) :]
+
+
+class WriterClient:
+    """
+    Sends the writes of a process to the database writer and waits for their acknowledgement.
+
+    The client is thread-safe, threads of the same process take turns.
+    """
+
+    def __init__(self, name, requests, acks):
+        self.name = name
+        self.requests = requests
+        self.acks = acks
+        # The pid is part of the message id, so a restarted process never takes the ack of its predecessor
+        self._message_ids = ((os.getpid(), i) for i in itertools.count())
+        self._lock = threading.Lock()
+
+    def execute(self, operations):
+        """
+        Send write operations as a single message and wait until they are committed.
+
+        Args:
+            operations (list): (operation name, args) tuples, see db.run_write_operations
+
+        Returns:
+            list: A bool per operation, True if it was applied
+        """
+        with self._lock:
+            message_id = next(self._message_ids)
+            self.requests.put((self.name, message_id, operations))
+            while True:
+                try:
+                    ack_id, results = self.acks.get(timeout=ACK_TIMEOUT)
+                except queue.Empty:
+                    logger.error(
+                        f"Database writer didn't acknowledge {len(operations)} writes from {self.name}"
+                    )
+                    return [False] * len(operations)
+                # Acks of messages we stopped waiting for are dropped
+                if ack_id == message_id:
+                    return results
+
+
+def attach(writer, name):
+    """
+    Route the writes of the current process to the writer, if there is one.
+
+    Args:
+        writer (DatabaseWriter): The writer, or None if writes are made directly.
+        name (str): The client name of the current process.
+    """
+    if writer is not None:
+        db.use_writer(writer.client(name))
+
+
+def db_writer_process(writer):
+    """
+    Process function for the database writer.
+
+    Args:
+        writer (DatabaseWriter): The writer to run
+    """
+    logger.info("Database writer process started")
+    metrics.start("db_writer")
+    profiling.start("db_writer")
+    try:
+        writer.run()
+    except (KeyboardInterrupt, SystemExit):
+        logger.info("Database writer process stopped")
+    except Exception:
+        logger.exception("Error in database writer process")
@@ -0,0 +1,386 @@
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+import durable_queue
+import latency
+import metrics
+import profiling
+import stats
+import wire
+from logger import get_logger
+from outbox import OutboxQueue
+from priorities import NORMAL, PRIORITY_NAMES, priority_name
+
+# Get logger for this module
+logger = get_logger(__name__)
+
+# Overflow policies, what a sink buffer does with new messages once it's full
+DROP_OLDEST = "drop_oldest"
+SPILL_TO_DISK = "spill_to_disk"
+
+# Folder of the spilled messages, one file per sink
+SPILL_DIR = "./data/spill"
+# Messages handed to a sink at once, the others wait in the dispatcher buffer
+IN_FLIGHT = 20
+# Messages read from the input queue in a pass, the next pass reads the rest
+MAX_READ = 500
+# Messages handed to a sink in a pass, so a sink that keeps taking them doesn't hold up the others
+FLUSH_BATCH = 100
+# Seconds between two stats snapshots
+STATS_INTERVAL = 5
+# Seconds before trying again to hand messages to a sink that hasn't taken the previous ones
+RETRY_INTERVAL = 0.05
+# Messages waiting for each sink, see metrics.py
+queue_depth = metrics.gauge(
+    "vinted_queue_depth", "Messages waiting in a queue", ("queue",)
+)
+
+
+class Sink:
+    """
+    A destination of the new items, like the Telegram bot or the RSS feed.
+
+    The main process sets the active flag while the sink's process should run. The dispatcher
+    only delivers to active sinks, so a stopped plugin doesn't find a backlog when it starts.
+
+    Attributes:
+        name (str): The sink name.
+        queue (Queue): The queue the sink reads its messages from.
+        active (Event): Set while the sink takes messages.
+        capacity (int): The number of messages buffered by the dispatcher for this sink.
+        overflow (str): What to do once the buffer is full, DROP_OLDEST or SPILL_TO_DISK.
+    """
+
+    def __init__(
+        self,
+        name,
+        capacity=1000,
+        overflow=DROP_OLDEST,
+        local=False,
+        durable=False,
+        outbox=False,
+    ):
+        """
+        Args:
+            local (bool): The sink runs in the dispatcher's process, use in-memory queue and flag
+            durable (bool): Keep the messages handed to the sink on disk until it acknowledges them
+            outbox (bool): The sink reads its notifications from the outbox, without the dispatcher
+        """
+        self.name = name
+        self.capacity = capacity
+        self.overflow = overflow
+        if local:
+            self.queue = queue.Queue(IN_FLIGHT)
+            self.active = threading.Event()
+        else:
+            if outbox:
+                self.queue = OutboxQueue(name)
+            elif durable:
+                self.queue = durable_queue.DurableQueue(f"sink_{name}", IN_FLIGHT)
+            else:
+                self.queue = multiprocessing.Queue(IN_FLIGHT)
+            self.active = multiprocessing.Event()
+
+
+class SpillFile:
+    """
+    Messages written to disk once a sink buffer is full, read back in order.
+
+    The file is kept when the dispatcher stops, so the spilled messages are delivered after a restart.
+    The file is only emptied once everything was read back, so a restart can deliver some messages twice.
+    It's opened for each message, messages are only spilled while a sink is far behind.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        with open(path, "a+", encoding="utf-8") as f:
+            f.seek(0)
+            self.count = sum(1 for _ in f)
+        self.read_offset = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, record):
+        # The file is opened in append mode, writes always go to the end
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+        self.count += 1
+
+    def pop(self):
+        with open(self.path, encoding="utf-8") as f:
+            f.seek(self.read_offset)
+            record = json.loads(f.readline())
+            self.read_offset = f.tell()
+        self.count -= 1
+        if self.count == 0:
+            self.clear()
+        return record
+
+    def clear(self):
+        os.truncate(self.path, 0)
+        self.count = 0
+        self.read_offset = 0
+
+
+class _SinkBuffer:
+    # The dispatcher side of a sink: its buffer and counters
+    def __init__(self, sink):
+        self.sink = sink
+        # Heap of (queued at - boost, sequence, queued at, message, input id, priority), the
+        # first one is sent first. The sequence keeps the order of equal keys.
+        self.messages = []
+        self.sequence = itertools.count()
+        self.spill = None
+        if sink.overflow == SPILL_TO_DISK:
+            self.spill = SpillFile(os.path.join(SPILL_DIR, f"{sink.name}.jsonl"))
+        self.active = False
+        self.delivered = 0
+        self.dropped = 0
+        # Seconds between finding an item and handing it to the sink, by priority
+        self.waits = {priority: stats.Histogram() for priority in PRIORITY_NAMES}
+
+    @property
+    def waiting(self):
+        return len(self.messages) + (len(self.spill) if self.spill else 0)
+
+    def update_state(self):
+        active = self.sink.active.is_set()
+        if self.active and not active:
+            # The sink stopped: what it didn't take is discarded, including what it never read
+            discarded = self.waiting
+            self.messages.clear()
+            if self.spill:
+                self.spill.clear()
+            while True:
+                try:
+                    self.sink.queue.get_nowait()
+                    discarded += 1
+                except queue.Empty:
+                    break
+            durable_queue.ack(self.sink.queue)
+            if discarded:
+                logger.info(
+                    f"Sink {self.sink.name} stopped, discarded {discarded} messages"
+                )
+        self.active = active
+
+    def put(self, message, queued_at, priority=NORMAL, boost=0, input_id=None):
+        if not self.active:
+            return
+        record = self._record(message, queued_at, priority, boost, input_id)
+        # Once messages are spilled, new ones go after them to keep the order
+        if len(self.messages) < self.sink.capacity and not self.spill:
+            heapq.heappush(self.messages, record)
+        elif self.spill is not None:
+            # The messages are kept readable on disk
+            self.spill.append(
+                (queued_at, wire.decode_notification(message), priority, boost)
+            )
+        else:
+            oldest = min(self.messages, key=lambda waiting: waiting[2])
+            self.messages.remove(oldest)
+            self.messages.append(record)
+            heapq.heapify(self.messages)
+            self.dropped += 1
+            if self.dropped % 100 == 1:
+                logger.warning(
+                    f"Sink {self.sink.name} is full, dropped {self.dropped} messages"
+                )
+
+    def _record(self, message, queued_at, priority, boost, input_id=None):
+        return (
+            queued_at - boost,
+            next(self.sequence),
+            queued_at,
+            message,
+            input_id,
+            priority,
+        )
+
+    def flush(self):
+        # True if messages the sink could take are left for the next pass
+        if not self.active:
+            return False
+        # Refill the buffer from the disk
+        while self.spill and len(self.messages) < self.sink.capacity:
+            self._unspill()
+        handed = 0
+        while self.messages and handed < FLUSH_BATCH:
+            try:
+                self.sink.queue.put_nowait(
+                    latency.stamp(self.messages[0][3], "dispatched")
+                )
+            except queue.Full:
+                return False
+            _, _, queued_at, _, _, priority = heapq.heappop(self.messages)
+            handed += 1
+            self.delivered += 1
+            self.waits.get(priority, self.waits[NORMAL]).observe(
+                time.time() - queued_at
+            )
+            if self.spill:
+                self._unspill()
+        return bool(self.messages)
+
+    def _unspill(self):
+        record = self.spill.pop()
+        # Messages spilled by an older version have no priority
+        queued_at, message, priority, boost = record + [NORMAL, 0][len(record) - 2 :]
+        heapq.heappush(
+            self.messages,
+            self._record(wire.encode_notification(message), queued_at, priority, boost),
+        )
+
+    def stats(self):
+        try:
+            in_flight = self.sink.queue.qsize()
+        except NotImplementedError:
+            # Not available on macOS
+            in_flight = None
+        return {
+            "active": self.active,
+            "overflow": self.sink.overflow,
+            "capacity": self.sink.capacity,
+            "waiting": self.waiting,
+            "spilled": len(self.spill) if self.spill else 0,
+            "in_flight": in_flight,
+            # Seconds the oldest waiting message has been waiting
+            "lag": (
+                time.time() - min(record[2] for record in self.messages)
+                if self.messages
+                else 0
+            ),
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            # Time in queue of the delivered messages, by priority
+            "waits": {
+                priority_name(priority): histogram.snapshot()
+                for priority, histogram in self.waits.items()
+            },
+        }
+
+
+class Dispatcher:
+    """
+    Copies each new item to every active sink.
+
+    The items waiting for a sink are sent by priority: an item goes before the ones queued
+    less than its boost seconds after it, see priorities.py. The time each item waited is
+    counted by priority.
+    """
+
+    def __init__(self, input_queue, sinks):
+        """
+        Args:
+            input_queue (Queue): The queue of new items
+            sinks (list): The sinks to deliver to
+        """
+        self.input_queue = input_queue
+        self.durable = isinstance(input_queue, durable_queue.DurableQueue)
+        self.buffers = [_SinkBuffer(sink) for sink in sinks]
+        self.next_stats = 0
+        # Id of the last input message acknowledged
+        self.acked = 0
+        # The last pass left messages to read or to hand to a sink
+        self.behind = False
+
+    def _read(self, block=True, timeout=None):
+        queued_at, priority, boost, message = wire.decode_dispatch(
+            self.input_queue.get(block, timeout)
+        )
+        input_id = self.input_queue.last_read if self.durable else None
+        return message, queued_at, priority, boost, input_id
+
+    def _ack(self):
+        # The input messages are acknowledged once no buffer holds them in memory anymore.
+        # Spilled messages are safe on disk, and have no input id once read back.
+        held = [
+            record[4]
+            for buffer in self.buffers
+            for record in buffer.messages
+            if record[4] is not None
+        ]
+        up_to = min(held) - 1 if held else self.input_queue.last_read
+        if up_to > self.acked:
+            self.input_queue.ack(up_to)
+            self.acked = up_to
+
+    def run_once(self, max_wait=STATS_INTERVAL):
+        """
+        Wait for new items and deliver them.
+
+        Args:
+            max_wait (float): The maximum number of seconds to wait for new items
+        """
+        # Wake up soon if a sink has messages it couldn't take yet
+        pending = any(buffer.active and buffer.messages for buffer in self.buffers)
+        # (message, queued at, priority, boost, input id), the id is only known for a durable input queue
+        messages = []
+        try:
+            if self.behind:
+                # The last pass stopped at a limit, carry on without waiting
+                messages.append(self._read(block=False))
+            else:
+                messages.append(
+                    self._read(
+                        timeout=min(RETRY_INTERVAL, max_wait) if pending else max_wait
+                    )
+                )
+            while len(messages) < MAX_READ:
+                messages.append(self._read(block=False))
+        except queue.Empty:
+            pass
+        self.behind = len(messages) == MAX_READ
+
+        for buffer in self.buffers:
+            buffer.update_state()
+            # The messages read together are ordered before the sink takes the first ones
+            for message, queued_at, priority, boost, input_id in messages:
+                buffer.put(message, queued_at, priority, boost, input_id)
+            if buffer.flush():
+                self.behind = True
+
+        if self.durable:
+            self._ack()
+
+        if time.monotonic() >= self.next_stats:
+            for buffer in self.buffers:
+                queue_depth.set(buffer.waiting, queue=f"sink_{buffer.sink.name}")
+            stats.publish(
+                "dispatcher",
+                {
+                    "sinks": {
+                        buffer.sink.name: buffer.stats() for buffer in self.buffers
+                    }
+                },
+            )
+            self.next_stats = time.monotonic() + STATS_INTERVAL
+
+
+def dispatcher_function(input_queue, sinks):
+    """
+    Process function for the dispatcher.
+
+    Args:
+        input_queue (Queue): The queue of new items
+        sinks (list): The sinks to deliver to
+    """
+    logger.info("Dispatcher process started")
+    metrics.start("dispatcher")
+    profiling.start("dispatcher")
+    try:
+        dispatcher = Dispatcher(input_queue, sinks)
+        while True:
+            dispatcher.run_once()
+    except (KeyboardInterrupt, SystemExit):
+        logger.info("Dispatcher process stopped")
+    except Exception:
+        logger.exception("Error in dispatcher process")
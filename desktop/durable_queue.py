@@ -0,0 +1,209 @@
+import multiprocessing
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from logger import get_logger
+
+# Get logger for this module
+logger = get_logger(__name__)
+
+# The queues database, apart from the main one so the queues don't wait for its writes
+QUEUES_DB = "./data/queues.db"
+# Seconds between two tries of a blocking put on a full queue
+PUT_RETRY_INTERVAL = 0.05
+
+
+class DurableQueue:
+    """
+    A queue between two processes, stored in SQLite so its messages survive a crash.
+
+    It has the methods of multiprocessing.Queue used by the application. A message stays in
+    the database until the consumer acknowledges it with ack(), once it was handled. A consumer
+    that restarts reads again every message it hadn't acknowledged, so a message can be
+    delivered twice but is never lost.
+
+    Each queue has a single producer process and a single consumer process.
+    """
+
+    def __init__(self, name, maxsize=0):
+        """
+        Args:
+            name (str): The queue name, the messages left by a previous run under this name are replayed
+            maxsize (int, optional): The number of unacknowledged messages above which put fails, 0 for no limit
+        """
+        self.name = name
+        self.maxsize = maxsize
+        # Released at every put, so the consumer sleeps until there is a message
+        self._available = multiprocessing.Semaphore(0)
+        self._conn = None
+        self._pid = None
+        # Id of the last message read by this process
+        self._last_read = 0
+        with self._lock:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS messages
+                (
+                    id    INTEGER PRIMARY KEY AUTOINCREMENT,
+                    queue TEXT NOT NULL,
+                    body  BLOB NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS messages_queue ON messages (queue, id);
+                """)
+            left = self._count()
+        if left:
+            logger.info(f"Replaying {left} messages of the {name} queue")
+
+    def __getstate__(self):
+        # The connection is opened again by the process receiving the queue
+        state = self.__dict__.copy()
+        state["_conn"] = state["_pid"] = None
+        state.pop("_thread_lock", None)
+        return state
+
+    @property
+    def _lock(self):
+        # A connection per process, opened on first use: a forked process can't use its parent's
+        if self._pid != os.getpid():
+            os.makedirs(os.path.dirname(QUEUES_DB), exist_ok=True)
+            self._conn = sqlite3.connect(
+                QUEUES_DB, isolation_level=None, check_same_thread=False, timeout=30
+            )
+            # Every commit survives a crash of the application, only a power loss can undo the last ones
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._thread_lock = threading.Lock()
+            self._pid = os.getpid()
+            self._last_read = 0
+        return self._thread_lock
+
+    def _count(self):
+        return self._conn.execute(
+            "SELECT COUNT(*) FROM messages WHERE queue = ?", (self.name,)
+        ).fetchone()[0]
+
+    def put(self, message, block=True, timeout=None):
+        """
+        Add a message at the end of the queue.
+
+        Raises:
+            queue.Full: The queue has maxsize unacknowledged messages after waiting timeout seconds
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                if not self.maxsize or self._count() < self.maxsize:
+                    self._conn.execute(
+                        "INSERT INTO messages (queue, body) VALUES (?, ?)",
+                        (self.name, message),
+                    )
+                    break
+            if not block or (deadline is not None and time.monotonic() >= deadline):
+                raise queue.Full
+            time.sleep(PUT_RETRY_INTERVAL)
+        self._available.release()
+
+    def put_nowait(self, message):
+        self.put(message, block=False)
+
+    def get(self, block=True, timeout=None):
+        """
+        Read the next message, it stays in the queue until ack() is called.
+
+        Raises:
+            queue.Empty: No message came in timeout seconds
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT id, body FROM messages WHERE queue = ? AND id > ? ORDER BY id LIMIT 1",
+                    (self.name, self._last_read),
+                ).fetchone()
+            if row is not None:
+                self._last_read = row[0]
+                # Take the token of this message, messages replayed after a restart have none
+                self._available.acquire(False)
+                return row[1]
+            if not block:
+                raise queue.Empty
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise queue.Empty
+            self._available.acquire(timeout=remaining)
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    @property
+    def last_read(self):
+        """
+        The id of the last message read, to acknowledge up to it later.
+        """
+        return self._last_read
+
+    def ack(self, up_to=None):
+        """
+        Remove the handled messages from the queue.
+
+        Args:
+            up_to (int, optional): Acknowledge the messages up to this id, every message read if not provided
+        """
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM messages WHERE queue = ? AND id <= ?",
+                (self.name, self._last_read if up_to is None else up_to),
+            )
+
+    def rewind(self):
+        """
+        Read again, from the first one, the messages that weren't acknowledged.
+        """
+        with self._lock:
+            self._last_read = 0
+
+    def qsize(self):
+        """
+        Returns:
+            int: The number of unacknowledged messages
+        """
+        with self._lock:
+            return self._count()
+
+
+def ack(message_queue):
+    """
+    Acknowledge every message read from a queue, nothing to do for an in-memory queue.
+
+    Args:
+        message_queue (Queue): A DurableQueue, an OutboxQueue or an in-memory queue
+    """
+    if hasattr(message_queue, "ack"):
+        message_queue.ack()
+
+
+def rewind(message_queue):
+    """
+    Read again the messages read from a queue and not acknowledged, as after a restart. They
+    are lost with an in-memory queue.
+
+    Args:
+        message_queue (Queue): A DurableQueue or an in-memory queue
+    """
+    if hasattr(message_queue, "rewind"):
+        message_queue.rewind()
+
+
+def retry(message_queue, message):
+    """
+    Hand a message that couldn't be handled back to the queue, to try again later. Only the
+    outbox retries, the message is dropped with the other queues.
+
+    Args:
+        message_queue (Queue): The queue the message was read from
+        message (bytes): The message
+    """
+    if hasattr(message_queue, "retry"):
+        message_queue.retry(message)
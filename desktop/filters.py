@@ -0,0 +1,367 @@
+import re
+import unicodedata
+from collections import OrderedDict
+from functools import lru_cache
+
+import db
+from logger import get_logger
+
+# Get logger for this module
+logger = get_logger(__name__)
+
+
+def strip_accents(text):
+    """
+    Remove the accents of a text, "é" becomes "e".
+
+    Args:
+        text (str): The text
+
+    Returns:
+        str: The text without accents
+    """
+    if text.isascii():
+        return text
+    return "".join(
+        char
+        for char in unicodedata.normalize("NFKD", text)
+        if not unicodedata.combining(char)
+    )
+
+
+def _trie_pattern(node):
+    # Turn a character trie into a regex where words sharing a prefix share a branch.
+    # The re module tries alternatives one by one, so "ab|ac" is slower than "a(?:b|c)".
+    alternatives = [
+        re.escape(char) + _trie_pattern(child)
+        for char, child in sorted(node.items())
+        if char
+    ]
+    optional = "" in node
+    if not alternatives:
+        return ""
+    if len(alternatives) == 1 and not optional:
+        return alternatives[0]
+    return "(?:" + "|".join(alternatives) + ")" + ("?" if optional else "")
+
+
+class BanwordMatcher:
+    """
+    Finds banwords in titles with a single compiled regex.
+
+    The banwords are merged into a trie shaped regex, so matching a title costs
+    about the same with 10 or 1000 banwords.
+
+    Attributes:
+        words (list): The banwords, lowercased.
+        whole_word (bool): Only match whole words, "tee" doesn't match "teeth".
+        ignore_accents (bool): Ignore accents, "pere" matches "père" and the other way around.
+    """
+
+    def __init__(self, words, whole_word=False, ignore_accents=False):
+        self.whole_word = whole_word
+        self.ignore_accents = ignore_accents
+        self.words = [word.strip().lower() for word in words if word.strip()]
+        if ignore_accents:
+            self.words = [strip_accents(word) for word in self.words]
+
+        self.regex = None
+        if self.words:
+            trie = {}
+            for word in self.words:
+                node = trie
+                for char in word:
+                    node = node.setdefault(char, {})
+                node[""] = {}
+            pattern = _trie_pattern(trie)
+            if whole_word:
+                pattern = rf"(?<!\w){pattern}(?!\w)"
+            self.regex = re.compile(pattern)
+
+    def matches(self, title):
+        """
+        Check if a title contains any banword.
+
+        Args:
+            title (str): The title to check
+
+        Returns:
+            bool: True if the title contains a banword, False otherwise
+        """
+        if self.regex is None:
+            return False
+        title = title.lower()
+        if self.ignore_accents:
+            title = strip_accents(title)
+        return self.regex.search(title) is not None
+
+    def matches_none(self, item):
+        # Predicate form for the item filters
+        return not self.matches(item.title)
+
+
+@lru_cache(maxsize=8)
+def compile_banwords(banwords_str, whole_word=False, ignore_accents=False):
+    """
+    Get the matcher for a banwords string, built once per banwords version.
+
+    Args:
+        banwords_str (str): List of banwords separated by 3 pipe character
+        whole_word (bool): Only match whole words
+        ignore_accents (bool): Ignore accents
+
+    Returns:
+        BanwordMatcher: The matcher
+    """
+    return BanwordMatcher(banwords_str.split("|||"), whole_word, ignore_accents)
+
+
+# Rule costs, the cheapest rules run first
+COST_FIELD = 0
+COST_TEXT = 1
+COST_NETWORK = 10
+
+
+def _split_values(values):
+    # "Nike, Adidas" -> {"nike", "adidas"}
+    return {
+        part.strip().lower()
+        for value in values
+        for part in value.split(",")
+        if part.strip()
+    }
+
+
+def _price(item):
+    try:
+        return float(item.price)
+    except (TypeError, ValueError):
+        return None
+
+
+def _price_min(values):
+    minimum = max(float(value) for value in values)
+    return lambda item: _price(item) is None or _price(item) >= minimum
+
+
+def _price_max(values):
+    maximum = min(float(value) for value in values)
+    return lambda item: _price(item) is None or _price(item) <= maximum
+
+
+def _brand_include(values):
+    brands = _split_values(values)
+    return lambda item: (item.brand_title or "").lower() in brands
+
+
+def _brand_exclude(values):
+    brands = _split_values(values)
+    return lambda item: (item.brand_title or "").lower() not in brands
+
+
+def _size_include(values):
+    sizes = _split_values(values)
+    return lambda item: (item.size_title or "").lower() in sizes
+
+
+def _size_exclude(values):
+    sizes = _split_values(values)
+    return lambda item: (item.size_title or "").lower() not in sizes
+
+
+def _title_regex(values):
+    regexes = [re.compile(value, re.IGNORECASE) for value in values]
+    return lambda item: all(regex.search(item.title) for regex in regexes)
+
+
+def _title_exclude_regex(values):
+    regex = re.compile("|".join(f"(?:{value})" for value in values), re.IGNORECASE)
+    return lambda item: regex.search(item.title) is None
+
+
+def _seller_exclude(values):
+    sellers = _split_values(values)
+    return lambda item: (
+        str(item.user_id) not in sellers
+        and (item.user_login or "").lower() not in sellers
+    )
+
+
+# Rule type -> (cost, builder). A builder gets all the values of its rule type and returns the predicate.
+RULE_TYPES = {
+    "price_min": (COST_FIELD, _price_min),
+    "price_max": (COST_FIELD, _price_max),
+    "brand_include": (COST_FIELD, _brand_include),
+    "brand_exclude": (COST_FIELD, _brand_exclude),
+    "size_include": (COST_FIELD, _size_include),
+    "size_exclude": (COST_FIELD, _size_exclude),
+    "seller_exclude": (COST_FIELD, _seller_exclude),
+    "title_regex": (COST_TEXT, _title_regex),
+    "title_exclude_regex": (COST_TEXT, _title_exclude_regex),
+    # Built by ItemFilters, it needs the country lookup
+    "seller_country": (COST_NETWORK, None),
+}
+
+
+def validate_rule(rule, value):
+    """
+    Check that a rule can be compiled.
+
+    Args:
+        rule (str): The rule type
+        value (str): The rule value
+
+    Returns:
+        str: An error message, or None if the rule is valid
+    """
+    if rule not in RULE_TYPES:
+        return f"Unknown rule: {rule}"
+    if not value.strip():
+        return "No value provided"
+    if rule == "seller_country":
+        if any(len(country) != 2 for country in _split_values([value])):
+            return "Invalid country code"
+        return None
+    try:
+        RULE_TYPES[rule][1]([value])
+    except ValueError as e:
+        return f"Invalid value: {e}"
+    except re.error as e:
+        return f"Invalid regex: {e}"
+    return None
+
+
+class ItemFilter:
+    """
+    The compiled filter of a query: its rules as predicates, cheapest first.
+
+    Rules that need a network lookup run last, so they only run for the items
+    that passed every cheap rule.
+    """
+
+    def __init__(self, rules):
+        """
+        Args:
+            rules (list): (cost, name, predicate) tuples. A predicate returns True if the item passes.
+        """
+        self.rules = sorted(rules, key=lambda rule: rule[0])
+
+    def rejects(self, item):
+        """
+        Run the rules on an item.
+
+        Args:
+            item (Item): The item to check
+
+        Returns:
+            str: The name of the first rule rejecting the item, or None if it passes
+        """
+        for _, name, predicate in self.rules:
+            if not predicate(item):
+                return name
+        return None
+
+
+class ItemFilters:
+    """
+    Compiles the filter rules of every query and caches them by rule version.
+
+    The rules stored in the database are merged with the banwords and the country
+    allowlist, which apply to every query.
+    """
+
+    def __init__(self, country_lookup, country_cache_size=10_000):
+        """
+        Args:
+            country_lookup (callable): Gets the country code of a user id, "XX" if unknown
+            country_cache_size (int): The number of seller countries kept in memory
+        """
+        self.country_lookup = country_lookup
+        self.country_cache_size = country_cache_size
+        self.countries = OrderedDict()
+        self.version = None
+        self.filters = {}
+
+    def _seller_country(self, item):
+        if item.user_id is None:
+            return "XX"
+        country = self.countries.get(item.user_id)
+        if country is None:
+            country = self.country_lookup(item.user_id)
+            # Unknown countries are asked again next time
+            if country != "XX":
+                self.countries[item.user_id] = country
+                if len(self.countries) > self.country_cache_size:
+                    self.countries.popitem(last=False)
+        return country
+
+    def _country_rule(self, allowed):
+        allowed = {country.upper() for country in allowed} | {"XX"}
+        return lambda item: self._seller_country(item) in allowed
+
+    def refresh(self):
+        """
+        Recompile the filters if the rules, banwords or allowlist changed.
+
+        This is meant to be called once per batch of items.
+        """
+        version = (
+            db.get_parameter("filter_rules_version"),
+            db.get_parameter("banwords") or "",
+            db.get_parameter("banwords_whole_word") == "True",
+            db.get_parameter("banwords_ignore_accents") == "True",
+            tuple(db.get_allowlist() or ()),
+        )
+        if version == self.version:
+            return
+        self.version = version
+        _, banwords_str, whole_word, ignore_accents, allowlist = version
+
+        # Rules applying to every query, then rules by query
+        values_by_query = {None: {}}
+        for _, query_id, rule, value in db.get_filter_rules():
+            if rule not in RULE_TYPES:
+                logger.error(f"Ignoring unknown filter rule: {rule}")
+                continue
+            values_by_query.setdefault(query_id, {}).setdefault(rule, []).append(value)
+
+        banwords = compile_banwords(banwords_str, whole_word, ignore_accents)
+        self.filters = {}
+        for query_id, values_by_rule in values_by_query.items():
+            values = {
+                rule: list(rule_values)
+                for rule, rule_values in values_by_query[None].items()
+            }
+            if query_id is not None:
+                for rule, rule_values in values_by_rule.items():
+                    values.setdefault(rule, []).extend(rule_values)
+
+            rules = []
+            if banwords.regex is not None:
+                rules.append((COST_TEXT, "banwords", banwords.matches_none))
+            if allowlist:
+                rules.append((COST_NETWORK, "allowlist", self._country_rule(allowlist)))
+            for rule, rule_values in values.items():
+                cost, builder = RULE_TYPES[rule]
+                try:
+                    if rule == "seller_country":
+                        predicate = self._country_rule(_split_values(rule_values))
+                    else:
+                        predicate = builder(rule_values)
+                except (ValueError, re.error) as e:
+                    logger.error(f"Ignoring invalid {rule} rule: {e}")
+                    continue
+                rules.append((cost, rule, predicate))
+            self.filters[query_id] = ItemFilter(rules)
+
+    def get(self, query_id):
+        """
+        Get the compiled filter of a query.
+
+        Args:
+            query_id (int): The query id
+
+        Returns:
+            ItemFilter: The filter
+        """
+        return self.filters.get(query_id) or self.filters[None]
@@ -0,0 +1,109 @@
+import time
+
+import stats
+import wire
+from logger import get_logger
+
+# Get logger for this module
+logger = get_logger(__name__)
+
+# The stages of an item, in order, with the process that times them:
+# listed: the photo upload, from the Vinted API
+# fetch_start, fetch_end: the search request of the query, scraper
+# enqueued: the items are sent to the extractor, scraper
+# picked: the extractor reads them, extractor
+# filtered: the extractor decides to notify the item, extractor
+# dispatched: the dispatcher hands it to the sink, dispatcher
+# sent: Telegram confirms the message or the RSS feed publishes it, sink
+STAGES = (
+    "listed",
+    "fetch_start",
+    "fetch_end",
+    "enqueued",
+    "picked",
+    "filtered",
+    "dispatched",
+    "sent",
+)
+# Seconds between two snapshots of a sink latencies
+PUBLISH_INTERVAL = 5
+
+
+def stamp(notification, stage):
+    """
+    Add the time of a stage to the trace of a notification.
+
+    Args:
+        notification (bytes): A message made by wire.encode_notification
+        stage (str): The stage, one of STAGES
+
+    Returns:
+        bytes: The message with the stage time, unchanged if it has no trace
+    """
+    values = wire.decode_notification(notification)
+    if len(values) < 6:
+        return notification
+    values[5][1][stage] = time.time()
+    return wire.encode_notification(values)
+
+
+class LatencyRecorder:
+    """
+    Aggregates the traces of the items a sink sent, by query and by stage.
+
+    The time of a stage is counted from the previous stage in the trace, so a stage that
+    didn't happen (no dispatcher with the outbox) is counted in the next one. "total" goes
+    from the listing to the sending. The histograms are published with the stats module,
+    under latency_<sink>.
+    """
+
+    def __init__(self, sink):
+        """
+        Args:
+            sink (str): The sink name
+        """
+        self.sink = sink
+        # query id -> stage -> Histogram
+        self.queries = {}
+        self.next_publish = 0
+
+    def observe(self, trace):
+        """
+        Count the stages of a sent item.
+
+        Args:
+            trace (tuple): (query id, {stage: time}), from the notification
+        """
+        query_id, times = trace
+        times["sent"] = time.time()
+        histograms = self.queries.setdefault(query_id, {})
+        previous = None
+        for stage in STAGES:
+            if stage not in times:
+                continue
+            if previous is not None:
+                histograms.setdefault(stage, stats.Histogram()).observe(
+                    max(0, times[stage] - times[previous])
+                )
+            previous = stage
+        if "listed" in times:
+            histograms.setdefault("total", stats.Histogram()).observe(
+                max(0, times["sent"] - times["listed"])
+            )
+        if time.monotonic() >= self.next_publish:
+            self.publish()
+
+    def publish(self):
+        stats.publish(
+            f"latency_{self.sink}",
+            {
+                "queries": {
+                    str(query_id): {
+                        stage: histogram.snapshot()
+                        for stage, histogram in histograms.items()
+                    }
+                    for query_id, histograms in self.queries.items()
+                }
+            },
+        )
+        self.next_publish = time.monotonic() + PUBLISH_INTERVAL
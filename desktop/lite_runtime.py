@@ -0,0 +1,240 @@
+import asyncio
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import make_server
+
+import core
+import db
+import metrics
+import profiling
+import supervisor
+from dispatcher import SPILL_TO_DISK, Dispatcher, Sink
+from logger import get_logger
+from seen_items import SeenItems
+from supervisor import MAX_BACKOFF, MIN_BACKOFF
+
+# Get logger for this module
+logger = get_logger(__name__)
+
+# Seconds a blocking step waits for data, which is also how long stopping can take
+STEP_TIMEOUT = 1
+# Threads running the blocking steps and the web servers
+THREADS = 16
+
+
+class LiteRuntime:
+    """
+    Runs the whole application in a single process, as tasks of one event loop.
+
+    The stages talk through in-memory queues instead of multiprocessing queues, so
+    the libraries are loaded once and no message is pickled. The blocking stages
+    (scraping, the database, the queues) run in threads with asyncio.to_thread, one
+    step at a time, so the loop stays free for the Telegram bot.
+    """
+
+    def __init__(self):
+        self.items_queue = queue.Queue()
+        self.new_items_queue = queue.Queue()
+        self.sinks = {
+            "telegram": Sink("telegram", overflow=SPILL_TO_DISK, local=True),
+            "rss": Sink("rss", local=True),
+        }
+        self.telegram_bot = None
+        self.rss_feed = None
+        self.rss_server = None
+        self.rss_task = None
+        # Set by the commands of the web UI, wakes the monitor up
+        self.wake = None
+        # Set when the configuration or the queries changed, wakes the scraper up
+        self.scraper_wake = None
+        self.scrape_now = False
+
+    async def run(self):
+        """
+        Run every stage until the runtime is cancelled.
+        """
+        # Enough threads for every blocking step at once, the default depends on the number of CPUs
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=THREADS)
+        )
+        loop = asyncio.get_running_loop()
+        self.wake = asyncio.Event()
+        self.scraper_wake = asyncio.Event()
+        # The web UI runs in a thread of this process, its commands wake the monitor up
+        supervisor.handle_locally(
+            lambda command, *args: self._command(loop, command, *args)
+        )
+        tasks = [
+            self._scraper(),
+            self._extractor(),
+            self._dispatcher(),
+            self._monitor(),
+            self._serve(self._web_ui_server(), "Web UI"),
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            await self._stop_telegram()
+            await self._stop_rss()
+
+    async def _scraper(self):
+        last_run = time.monotonic()
+        while True:
+            # Read at every wake up, so a new delay applies at once
+            delay = int(db.get_parameter("query_refresh_delay"))
+            remaining = last_run + delay - time.monotonic()
+            if remaining > 0 and not self.scrape_now:
+                try:
+                    await asyncio.wait_for(self.scraper_wake.wait(), remaining)
+                except TimeoutError:
+                    pass
+                self.scraper_wake.clear()
+                continue
+            self.scrape_now = False
+            last_run = time.monotonic()
+            try:
+                await asyncio.to_thread(core.process_items, self.items_queue)
+            except Exception:
+                logger.exception("Error scraping items")
+
+    async def _extractor(self):
+        seen_items = await asyncio.to_thread(SeenItems.from_db)
+        while True:
+            try:
+                await asyncio.to_thread(
+                    core.clear_item_queue,
+                    self.items_queue,
+                    self.new_items_queue,
+                    seen_items,
+                    STEP_TIMEOUT,
+                )
+            except Exception:
+                logger.exception("Error extracting items")
+
+    async def _dispatcher(self):
+        dispatcher = Dispatcher(self.new_items_queue, list(self.sinks.values()))
+        while True:
+            try:
+                await asyncio.to_thread(dispatcher.run_once, STEP_TIMEOUT)
+            except Exception:
+                logger.exception("Error dispatching items")
+
+    def _web_ui_server(self):
+        from web_ui_plugin.web_ui import app
+
+        return make_server("0.0.0.0", 8000, app, threaded=True)
+
+    async def _serve(self, server, name):
+        logger.info(f"{name} listening on port {server.server_port}")
+        try:
+            await asyncio.to_thread(server.serve_forever)
+        finally:
+            # Returns at once if the server was already shut down
+            server.shutdown()
+
+    ### PLUGINS ###
+
+    def _command(self, loop, command, *args):
+        # Called from the web UI threads
+        if command == "status":
+            return {
+                "telegram": {"running": self.telegram_bot is not None},
+                "rss": {"running": self.rss_feed is not None},
+            }
+        if command == "queries_changed":
+            self.scrape_now = True
+            loop.call_soon_threadsafe(self.scraper_wake.set)
+        elif command == "reload_config":
+            loop.call_soon_threadsafe(self.scraper_wake.set)
+        else:
+            loop.call_soon_threadsafe(self.wake.set)
+        return {"status": "ok"}
+
+    async def _monitor(self):
+        # The statuses saved in the database are applied at start and after every command.
+        # A plugin that failed to start is tried again with a growing delay.
+        backoff = 0
+        while True:
+            failed = False
+            try:
+                telegram_should_run = (
+                    db.get_parameter("telegram_process_running") == "True"
+                    and db.get_parameter("telegram_token")
+                    and db.get_parameter("telegram_chat_id")
+                )
+                if telegram_should_run and self.telegram_bot is None:
+                    await self._start_telegram()
+                elif not telegram_should_run and self.telegram_bot is not None:
+                    await self._stop_telegram()
+
+                rss_should_run = db.get_parameter("rss_process_running") == "True"
+                if rss_should_run and self.rss_feed is None:
+                    self._start_rss()
+                elif not rss_should_run and self.rss_feed is not None:
+                    await self._stop_rss()
+            except Exception:
+                logger.exception("Error monitoring plugins")
+                failed = True
+
+            backoff = min(MAX_BACKOFF, max(MIN_BACKOFF, backoff * 2)) if failed else 0
+            try:
+                await asyncio.wait_for(self.wake.wait(), backoff or None)
+            except TimeoutError:
+                pass
+            self.wake.clear()
+
+    async def _start_telegram(self):
+        from telegram_bot_plugin.telegram_bot import LeRobot
+
+        logger.info("Starting telegram bot.")
+        bot = LeRobot(self.sinks["telegram"].queue)
+        await bot.start()
+        self.telegram_bot = bot
+        self.sinks["telegram"].active.set()
+
+    async def _stop_telegram(self):
+        self.sinks["telegram"].active.clear()
+        if self.telegram_bot is None:
+            return
+        logger.info("Stopping telegram bot.")
+        bot, self.telegram_bot = self.telegram_bot, None
+        await bot.stop()
+
+    def _start_rss(self):
+        from rss_feed_plugin.rss_feed import RSSFeed
+
+        logger.info("Starting RSS feed.")
+        feed = RSSFeed(self.sinks["rss"].queue)
+        try:
+            server = make_server("0.0.0.0", int(db.get_parameter("rss_port")), feed.app)
+        except Exception:
+            feed.stop()
+            raise
+        self.rss_feed, self.rss_server = feed, server
+        self.rss_task = asyncio.create_task(self._serve(server, "RSS feed"))
+        self.sinks["rss"].active.set()
+
+    async def _stop_rss(self):
+        self.sinks["rss"].active.clear()
+        if self.rss_feed is None:
+            return
+        logger.info("Stopping RSS feed.")
+        feed, server = self.rss_feed, self.rss_server
+        self.rss_feed = self.rss_server = None
+        feed.stop()
+        await asyncio.to_thread(server.shutdown)
+
+
+def run():
+    """
+    Run the application in lite mode until it's interrupted.
+    """
+    logger.info("Starting in lite mode, every component runs in this process")
+    metrics.start("lite")
+    profiling.start("lite")
+    try:
+        asyncio.run(LiteRuntime().run())
+    except (KeyboardInterrupt, SystemExit):
+        logger.info("Lite runtime stopped")
@@ -0,0 +1,192 @@
+import html
+import string
+from functools import lru_cache
+
+from logger import get_logger
+
+# Get logger for this module
+logger = get_logger(__name__)
+
+# The variables available in the message template
+FIELDS = ("title", "price", "brand", "image")
+
+_CONVERSIONS = {"s": str, "r": repr, "a": ascii}
+
+
+def item_fields(item):
+    """
+    Get the template variables of an item.
+
+    These are what the extractor sends to the sinks, each sink renders its own variant.
+
+    Args:
+        item (Item): The item
+
+    Returns:
+        dict: The value of each template variable
+    """
+    return {
+        "title": item.title,
+        "price": str(item.price) + " " + item.currency,
+        "brand": item.brand_title,
+        "image": None if item.photo is None else item.photo,
+    }
+
+
+def _placeholder(field, spec, conversion):
+    # Rebuild the text of a placeholder we can't fill
+    return (
+        "{"
+        + field
+        + ("!" + conversion if conversion else "")
+        + (":" + spec if spec else "")
+        + "}"
+    )
+
+
+def _parse(template):
+    # [(literal, field, spec, conversion)], unknown placeholders are kept as text
+    try:
+        parsed = list(string.Formatter().parse(template))
+    except ValueError as e:
+        logger.error(f"Invalid message template, sending it as is: {e}")
+        return [(template, None, None, None)]
+
+    parts = []
+    for literal, field, spec, conversion in parsed:
+        if field is not None and (
+            field not in FIELDS
+            or "{" in spec
+            or conversion not in (None, *_CONVERSIONS)
+        ):
+            logger.warning(f"Unknown variable in message template: {field}")
+            literal += _placeholder(field, spec, conversion)
+            field = None
+        parts.append((literal, field, spec, conversion))
+    return parts
+
+
+def _strip_tags(parts):
+    # Remove the HTML tags of the template, and the variables inside them ("<a href="{image}">")
+    stripped = []
+    in_tag = False
+    for literal, field, spec, conversion in parts:
+        text = []
+        for char in literal:
+            if char == "<":
+                in_tag = True
+            elif char == ">" and in_tag:
+                in_tag = False
+            elif not in_tag:
+                text.append(char)
+        stripped.append(
+            (html.unescape("".join(text)), None if in_tag else field, spec, conversion)
+        )
+    return stripped
+
+
+def _field(field, spec, conversion, escape):
+    # Render one variable of the template
+    convert = _CONVERSIONS.get(conversion)
+
+    def render(fields):
+        value = fields[field]
+        if convert is not None:
+            value = convert(value)
+        value = format(value, spec) if spec else str(value)
+        return html.escape(value) if escape else value
+
+    return render
+
+
+def _compile(parts, escape):
+    # Split the template once into its first literal, then (variable, literal after it)
+    # pairs: rendering only joins them. None of the template is run as code.
+    first = ""
+    names = []
+    fields = []
+    literals = []
+    plain = True
+    for literal, field, spec, conversion in parts:
+        if literals:
+            literals[-1] += literal
+        else:
+            first += literal
+        if field is not None:
+            names.append(field)
+            fields.append(_field(field, spec, conversion, escape))
+            literals.append("")
+            plain = plain and not spec and conversion is None
+
+    if not plain:
+        rest = list(zip(fields, literals))
+
+        def render(values):
+            text = [first]
+            for field, literal in rest:
+                text += (field(values), literal)
+            return "".join(text)
+
+        return render
+
+    # Only "{title}" like variables, the usual case: they are rendered inline, a function
+    # call per variable would take as long as the rest of the rendering
+    rest = list(zip(names, literals))
+    html_escape = html.escape
+
+    def render(values):
+        text = [first]
+        if escape:
+            for name, literal in rest:
+                text += (html_escape(str(values[name])), literal)
+        else:
+            for name, literal in rest:
+                text += (str(values[name]), literal)
+        return "".join(text)
+
+    return render
+
+
+class CompiledTemplate:
+    """
+    A message template parsed once, rendered for each sink.
+
+    Attributes:
+        template (str): The template text.
+        html (callable): Renders fields as Telegram HTML, the values are escaped.
+        text (callable): Renders fields as plain text, without the HTML tags of the template.
+    """
+
+    def __init__(self, template):
+        self.template = template
+        parts = _parse(template)
+        self.html = _compile(parts, escape=True)
+        self.text = _compile(_strip_tags(parts), escape=False)
+
+    def rss_entry(self, fields):
+        """
+        Render fields for an RSS entry.
+
+        Args:
+            fields (dict): The template variables, see item_fields
+
+        Returns:
+            tuple: (title, description)
+        """
+        # The description is HTML, where line breaks must be tags
+        description = self.html(fields).replace("\n", "<br>\n")
+        return fields.get("title") or "New Vinted Item", description
+
+
+@lru_cache(maxsize=4)
+def compile_template(template):
+    """
+    Get the compiled version of a message template, built once per template version.
+
+    Args:
+        template (str): The template text
+
+    Returns:
+        CompiledTemplate: The compiled template
+    """
+    return CompiledTemplate(template or "")
@@ -0,0 +1,259 @@
+import os
+import threading
+import time
+
+import stats
+from logger import get_logger
+
+# Get logger for this module
+logger = get_logger(__name__)
+
+# Seconds between two snapshots of the metrics of a process
+PUBLISH_INTERVAL = 5
+# Upper bounds in seconds of the buckets of the short durations, like the database operations
+FAST_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+# Name -> metric, the metrics of this process
+_registry = {}
+# The metrics are updated by several threads of a process
+_lock = threading.Lock()
+# Name of this process in the snapshots, set by start()
+_process = None
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        # Label values -> value
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def samples(self):
+        return [
+            [dict(zip(self.labels, key)), value] for key, value in self.values.items()
+        ]
+
+
+class Counter(_Metric):
+    """
+    A count that only goes up, like the number of requests.
+    """
+
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down, like a queue depth.
+    """
+
+    type = "gauge"
+
+    def set(self, value, **labels):
+        with _lock:
+            self.values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    """
+    A distribution of durations, in seconds.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=stats.LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with _lock:
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = stats.Histogram(self.buckets)
+            histogram.observe(value)
+
+    def samples(self):
+        return [
+            [
+                dict(zip(self.labels, key)),
+                {
+                    "buckets": list(histogram.buckets),
+                    "counts": list(histogram.counts),
+                    "count": histogram.count,
+                    "sum": histogram.total,
+                },
+            ]
+            for key, histogram in self.values.items()
+        ]
+
+
+def _register(metric_class, name, documentation, labels=(), **kwargs):
+    with _lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = metric_class(
+                name, documentation, labels, **kwargs
+            )
+        return metric
+
+
+def counter(name, documentation, labels=()):
+    """
+    Get a counter of this process, created on first use.
+
+    Args:
+        name (str): The metric name, e.g. "vinted_items_notified_total"
+        documentation (str): What it counts, shown in /metrics
+        labels (tuple, optional): The names of its labels
+
+    Returns:
+        Counter: The counter
+    """
+    return _register(Counter, name, documentation, labels)
+
+
+def gauge(name, documentation, labels=()):
+    """
+    Get a gauge of this process, created on first use. See counter().
+    """
+    return _register(Gauge, name, documentation, labels)
+
+
+def histogram(name, documentation, labels=(), buckets=stats.LATENCY_BUCKETS):
+    """
+    Get a histogram of this process, created on first use. See counter().
+
+    Args:
+        buckets (tuple, optional): The upper bounds of its buckets, in seconds
+    """
+    return _register(Histogram, name, documentation, labels, buckets=buckets)
+
+
+def _resident_memory():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        # The peak instead, on macOS which has no /proc, in bytes there
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        return None
+
+
+def publish():
+    """
+    Write the snapshot of the metrics of this process, read by the web UI for /metrics.
+    """
+    memory = _resident_memory()
+    if memory is not None:
+        gauge("process_resident_memory_bytes", "Resident memory size in bytes").set(
+            memory
+        )
+    with _lock:
+        snapshot = {
+            name: {
+                "type": metric.type,
+                "help": metric.documentation,
+                "samples": metric.samples(),
+            }
+            for name, metric in _registry.items()
+        }
+    stats.publish(f"metrics_{_process}", {"metrics": snapshot})
+
+
+def _publish_forever():
+    while True:
+        try:
+            publish()
+        except Exception:
+            logger.exception("Error publishing metrics")
+        time.sleep(PUBLISH_INTERVAL)
+
+
+def start(process):
+    """
+    Publish the metrics of this process every PUBLISH_INTERVAL seconds.
+
+    A forked process inherits the metrics of its parent, they are reset so each process
+    only publishes its own.
+
+    Args:
+        process (str): The process name, the "process" label of its metrics
+    """
+    global _process
+    _process = process
+    with _lock:
+        for metric in _registry.values():
+            metric.values.clear()
+    threading.Thread(target=_publish_forever, daemon=True, name="metrics").start()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels):
+    return (
+        "{"
+        + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items())
+        + "}"
+    )
+
+
+def _number(value):
+    return "+Inf" if value == float("inf") else repr(float(value))
+
+
+def render(max_age=3 * PUBLISH_INTERVAL):
+    """
+    Merge the last snapshots of the running processes in the Prometheus text format.
+
+    Args:
+        max_age (float, optional): Ignore the snapshots of the processes that stopped publishing
+
+    Returns:
+        str: The metrics, each sample labelled with its process
+    """
+    # name -> (type, help, lines)
+    families = {}
+    for process, snapshot in sorted(stats.read_all("metrics_", max_age).items()):
+        for name, metric in snapshot["metrics"].items():
+            family = families.setdefault(name, (metric["type"], metric["help"], []))
+            lines = family[2]
+            for labels, value in metric["samples"]:
+                labels = {"process": process, **labels}
+                if metric["type"] != "histogram":
+                    lines.append(f"{name}{_labels(labels)} {_number(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(
+                    value["buckets"] + [float("inf")], value["counts"]
+                ):
+                    cumulative += count
+                    bucket_labels = {**labels, "le": _number(bound)}
+                    lines.append(f"{name}_bucket{_labels(bucket_labels)} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {_number(value['sum'])}")
+                lines.append(f"{name}_count{_labels(labels)} {value['count']}")
+
+    output = []
+    for name, (metric_type, documentation, lines) in sorted(families.items()):
+        output.append(f"# HELP {name} {_escape(documentation)}")
+        output.append(f"# TYPE {name} {metric_type}")
+        output.extend(lines)
+    return "\n".join(output) + "\n"
@@ -0,0 +1,43 @@
+BEGIN TRANSACTION;
+
+-- Full-text index over item titles. It reads its content from the items table.
+CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5
+(
+    title,
+    content = 'items',
+    content_rowid = 'rowid',
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+
+-- Keep the index in sync with the items table
+CREATE TRIGGER IF NOT EXISTS items_fts_insert
+    AFTER INSERT
+    ON items
+BEGIN
+    INSERT INTO items_fts (rowid, title) VALUES (new.rowid, new.title);
+END;
+
+CREATE TRIGGER IF NOT EXISTS items_fts_delete
+    AFTER DELETE
+    ON items
+BEGIN
+    INSERT INTO items_fts (items_fts, rowid, title) VALUES ('delete', old.rowid, old.title);
+END;
+
+CREATE TRIGGER IF NOT EXISTS items_fts_update
+    AFTER UPDATE OF title
+    ON items
+BEGIN
+    INSERT INTO items_fts (items_fts, rowid, title) VALUES ('delete', old.rowid, old.title);
+    INSERT INTO items_fts (rowid, title) VALUES (new.rowid, new.title);
+END;
+
+-- Index the items that are already stored
+INSERT INTO items_fts (items_fts)
+VALUES ('rebuild');
+
+UPDATE parameters
+SET value = '1.0.5.5'
+WHERE key = 'version';
+
+COMMIT;
@@ -0,0 +1,11 @@
+BEGIN TRANSACTION;
+
+-- Indexes backing the keyset pagination of the items pages
+CREATE INDEX IF NOT EXISTS idx_items_timestamp ON items (timestamp, item);
+CREATE INDEX IF NOT EXISTS idx_items_query_timestamp ON items (query_id, timestamp, item);
+
+UPDATE parameters
+SET value = '1.0.5.6'
+WHERE key = 'version';
+
+COMMIT;
@@ -0,0 +1,11 @@
+BEGIN TRANSACTION;
+
+-- Send all database writes through a dedicated writer process
+INSERT OR IGNORE INTO parameters (key, value)
+VALUES ('db_writer_enabled', 'False');
+
+UPDATE parameters
+SET value = '1.0.5.7'
+WHERE key = 'version';
+
+COMMIT;
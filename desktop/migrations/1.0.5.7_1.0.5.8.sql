@@ -0,0 +1,10 @@
+BEGIN TRANSACTION;
+
+-- Index backing the item id lookups of the extractor
+CREATE INDEX IF NOT EXISTS idx_items_item ON items (item);
+
+UPDATE parameters
+SET value = '1.0.5.8'
+WHERE key = 'version';
+
+COMMIT;
@@ -0,0 +1,12 @@
+BEGIN TRANSACTION;
+
+-- Banwords matching options
+INSERT OR IGNORE INTO parameters (key, value)
+VALUES ('banwords_whole_word', 'False'),
+       ('banwords_ignore_accents', 'False');
+
+UPDATE parameters
+SET value = '1.0.5.9'
+WHERE key = 'version';
+
+COMMIT;
@@ -0,0 +1,21 @@
+BEGIN TRANSACTION;
+
+-- Filter rules, by query. Rules without a query apply to every query.
+CREATE TABLE IF NOT EXISTS filter_rules
+(
+    id       INTEGER PRIMARY KEY AUTOINCREMENT,
+    query_id INTEGER,
+    rule     TEXT NOT NULL,
+    value    TEXT NOT NULL,
+    FOREIGN KEY (query_id) REFERENCES queries (id)
+);
+
+-- Incremented on every rule change, so the extractor knows when to recompile them
+INSERT OR IGNORE INTO parameters (key, value)
+VALUES ('filter_rules_version', '0');
+
+UPDATE parameters
+SET value = '1.0.6'
+WHERE key = 'version';
+
+COMMIT;
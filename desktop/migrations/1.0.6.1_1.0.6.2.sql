@@ -0,0 +1,25 @@
+BEGIN TRANSACTION;
+
+-- Notifications waiting to be sent, one per sink, written in the transaction of their item.
+-- The sink and the item make the idempotency key: a notification can't be queued twice for a sink.
+CREATE TABLE IF NOT EXISTS outbox
+(
+    id           INTEGER PRIMARY KEY AUTOINCREMENT,
+    sink         TEXT    NOT NULL,
+    item         TEXT    NOT NULL,
+    message      BLOB    NOT NULL,
+    created_at   REAL    NOT NULL,
+    attempts     INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL    NOT NULL DEFAULT 0,
+    UNIQUE (sink, item)
+);
+
+-- Send the notifications through the outbox, see outbox.py
+INSERT OR IGNORE INTO parameters (key, value)
+VALUES ('outbox_enabled', 'False');
+
+UPDATE parameters
+SET value = '1.0.6.2'
+WHERE key = 'version';
+
+COMMIT;
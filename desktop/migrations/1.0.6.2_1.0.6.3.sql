@@ -0,0 +1,25 @@
+BEGIN TRANSACTION;
+
+-- Title signatures of the recent listings, to find the items a seller listed again, see relists.py
+CREATE TABLE IF NOT EXISTS item_signatures
+(
+    item      TEXT PRIMARY KEY,
+    user_id   TEXT NOT NULL,
+    price     REAL,
+    title     TEXT NOT NULL,
+    signature BLOB NOT NULL,
+    listed_at REAL NOT NULL,
+    relist_of TEXT
+);
+
+CREATE INDEX IF NOT EXISTS item_signatures_listed_at ON item_signatures (listed_at);
+
+-- Hours during which a relisted item isn't notified again, 0 to disable
+INSERT OR IGNORE INTO parameters (key, value)
+VALUES ('relist_window_hours', '0');
+
+UPDATE parameters
+SET value = '1.0.6.3'
+WHERE key = 'version';
+
+COMMIT;
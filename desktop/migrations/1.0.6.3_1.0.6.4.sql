@@ -0,0 +1,15 @@
+BEGIN TRANSACTION;
+
+-- Don't notify the items whose photo was already notified with another listing, see photo_hashes.py
+INSERT OR IGNORE INTO parameters (key, value)
+VALUES ('photo_dedup_enabled', 'False');
+
+-- Milliseconds a batch of items can wait for its photos to be compared
+INSERT OR IGNORE INTO parameters (key, value)
+VALUES ('photo_dedup_budget_ms', '500');
+
+UPDATE parameters
+SET value = '1.0.6.4'
+WHERE key = 'version';
+
+COMMIT;
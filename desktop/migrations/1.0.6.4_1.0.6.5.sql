@@ -0,0 +1,11 @@
+BEGIN TRANSACTION;
+
+-- Dispatch priority of the items of each query: 1 high, 0 normal, -1 low, see priorities.py
+ALTER TABLE queries
+    ADD COLUMN priority INTEGER NOT NULL DEFAULT 0;
+
+UPDATE parameters
+SET value = '1.0.6.5'
+WHERE key = 'version';
+
+COMMIT;
@@ -0,0 +1,15 @@
+BEGIN TRANSACTION;
+
+-- Seconds the Telegram bot groups the items of a burst into digests, 0 sends every item alone
+INSERT OR IGNORE INTO parameters (key, value)
+VALUES ('telegram_digest_window', '0');
+
+-- Items per digest message, each with its own button
+INSERT OR IGNORE INTO parameters (key, value)
+VALUES ('telegram_digest_max_items', '10');
+
+UPDATE parameters
+SET value = '1.0.6.6'
+WHERE key = 'version';
+
+COMMIT;
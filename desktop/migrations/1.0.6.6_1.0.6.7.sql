@@ -0,0 +1,18 @@
+BEGIN TRANSACTION;
+
+-- Telegram chats the items of a query are sent to. Routes without a query get every item,
+-- the items of a query without any route go to telegram_chat_id.
+CREATE TABLE IF NOT EXISTS telegram_routes
+(
+    id       INTEGER PRIMARY KEY AUTOINCREMENT,
+    query_id INTEGER,
+    chat_id  TEXT NOT NULL,
+    FOREIGN KEY (query_id) REFERENCES queries (id),
+    UNIQUE (query_id, chat_id)
+);
+
+UPDATE parameters
+SET value = '1.0.6.7'
+WHERE key = 'version';
+
+COMMIT;
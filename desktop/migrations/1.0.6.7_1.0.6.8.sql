@@ -0,0 +1,75 @@
+BEGIN TRANSACTION;
+
+-- The full-text index was keyed on the implicit rowid of items, which a VACUUM can renumber.
+-- Rebuild items with a declared INTEGER PRIMARY KEY, keeping the current rowids, and key the
+-- index on it.
+DROP TRIGGER IF EXISTS items_fts_insert;
+DROP TRIGGER IF EXISTS items_fts_delete;
+DROP TRIGGER IF EXISTS items_fts_update;
+DROP TABLE IF EXISTS items_fts;
+
+CREATE TABLE items_new
+(
+    id        INTEGER PRIMARY KEY,
+    item      NUMERIC,
+    title     TEXT,
+    price     NUMERIC,
+    currency  TEXT,
+    timestamp NUMERIC,
+    photo_url TEXT,
+    query_id  INTEGER,
+    FOREIGN KEY (query_id) REFERENCES queries (id)
+);
+
+INSERT INTO items_new (id, item, title, price, currency, timestamp, photo_url, query_id)
+SELECT rowid, item, title, price, currency, timestamp, photo_url, query_id
+FROM items;
+
+DROP TABLE items;
+ALTER TABLE items_new RENAME TO items;
+
+-- Dropped with the old table
+CREATE INDEX IF NOT EXISTS idx_items_timestamp ON items (timestamp, item);
+CREATE INDEX IF NOT EXISTS idx_items_query_timestamp ON items (query_id, timestamp, item);
+CREATE INDEX IF NOT EXISTS idx_items_item ON items (item);
+
+-- Full-text index over item titles. It reads its content from the items table.
+CREATE VIRTUAL TABLE items_fts USING fts5
+(
+    title,
+    content = 'items',
+    content_rowid = 'id',
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+
+-- Keep the index in sync with the items table
+CREATE TRIGGER items_fts_insert
+    AFTER INSERT
+    ON items
+BEGIN
+    INSERT INTO items_fts (rowid, title) VALUES (new.id, new.title);
+END;
+
+CREATE TRIGGER items_fts_delete
+    AFTER DELETE
+    ON items
+BEGIN
+    INSERT INTO items_fts (items_fts, rowid, title) VALUES ('delete', old.id, old.title);
+END;
+
+CREATE TRIGGER items_fts_update
+    AFTER UPDATE OF title
+    ON items
+BEGIN
+    INSERT INTO items_fts (items_fts, rowid, title) VALUES ('delete', old.id, old.title);
+    INSERT INTO items_fts (rowid, title) VALUES (new.id, new.title);
+END;
+
+INSERT INTO items_fts (items_fts)
+VALUES ('rebuild');
+
+UPDATE parameters
+SET value = '1.0.6.8'
+WHERE key = 'version';
+
+COMMIT;
@@ -0,0 +1,11 @@
+BEGIN TRANSACTION;
+
+-- Keep the queues between the processes on disk, see durable_queue.py
+INSERT OR IGNORE INTO parameters (key, value)
+VALUES ('durable_queues', 'False');
+
+UPDATE parameters
+SET value = '1.0.6.1'
+WHERE key = 'version';
+
+COMMIT;
@@ -0,0 +1,144 @@
+import multiprocessing
+import queue
+import time
+
+import db
+from logger import get_logger
+
+# Get logger for this module
+logger = get_logger(__name__)
+
+# Notifications read from the database at once
+BATCH_SIZE = 100
+# Seconds before sending a notification again after a failure, doubled at each failure
+MIN_RETRY_DELAY = 5
+MAX_RETRY_DELAY = 600
+# Failures after which a notification is given up
+MAX_ATTEMPTS = 10
+
+
+class OutboxQueue:
+    """
+    The outbox entries of a sink, read like a queue by the sink process.
+
+    The extractor adds the entries in the transaction of their items, see db.add_item_to_db.
+    The sink reads them with get() and removes the sent ones with ack(). An entry passed to
+    retry() is read again after a delay. Entries that weren't acknowledged when the sink
+    stopped, or crashed, are read again when it starts.
+    """
+
+    def __init__(self, sink):
+        """
+        Args:
+            sink (str): The sink name
+        """
+        self.sink = sink
+        # Released by the extractor after a commit, so the sink sleeps until there are entries
+        self._available = multiprocessing.Semaphore(0)
+        # (id, message, attempts) of the entries fetched and not read yet
+        self._fetched = []
+        # The same for the entries read since the last ack
+        self._read = []
+        self._last_read = 0
+
+    def notify(self):
+        """
+        Wake the sink up, called once new entries are committed.
+        """
+        self._available.release()
+
+    def get(self, block=True, timeout=None):
+        """
+        Read the next notification, it stays in the outbox until ack() is called.
+
+        Raises:
+            queue.Empty: No notification came in timeout seconds
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._fetched:
+            self._fetched = db.get_outbox_entries(
+                self.sink, self._last_read, BATCH_SIZE
+            )
+            if self._fetched:
+                break
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if not block or (remaining is not None and remaining <= 0):
+                raise queue.Empty
+            # Also wake up when the next failed notification is due
+            next_attempt = db.get_next_outbox_attempt(self.sink, self._last_read)
+            if next_attempt is not None:
+                until_retry = max(0, next_attempt - time.time())
+                remaining = (
+                    until_retry if remaining is None else min(remaining, until_retry)
+                )
+            self._available.acquire(timeout=remaining)
+
+        entry = self._fetched.pop(0)
+        self._read.append(entry)
+        self._last_read = entry[0]
+        self._available.acquire(False)
+        return entry[1]
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def retry(self, message):
+        """
+        Send a notification read since the last ack again later, with a growing delay.
+
+        Args:
+            message (bytes): The notification, as returned by get()
+        """
+        for entry in self._read:
+            entry_id, entry_message, attempts = entry
+            if entry_message is not message:
+                continue
+            if attempts + 1 >= MAX_ATTEMPTS:
+                # Removed by the next ack
+                logger.error(
+                    f"Giving up a {self.sink} notification after {MAX_ATTEMPTS} attempts"
+                )
+                return
+            delay = min(MAX_RETRY_DELAY, MIN_RETRY_DELAY * 2**attempts)
+            db.retry_outbox_entry(entry_id, time.time() + delay)
+            self._read.remove(entry)
+            logger.warning(
+                f"Sending a {self.sink} notification failed, retrying in {delay}s"
+            )
+            return
+
+    def ack(self):
+        """
+        Remove the notifications read since the last ack from the outbox, except those retried.
+        """
+        if self._read:
+            db.remove_from_outbox([entry[0] for entry in self._read])
+            self._read = []
+        if not self._fetched:
+            # Start again from the oldest entry, to find the retried ones that are due
+            self._last_read = 0
+
+
+class Outbox:
+    """
+    Takes the new items in place of the new items queue: the extractor adds a notification
+    for each running sink with the item, then wakes the sinks up once it's committed.
+    """
+
+    def __init__(self, sinks):
+        """
+        Args:
+            sinks (list): The sinks, made with outbox=True
+        """
+        self.sinks = sinks
+
+    def active_sinks(self):
+        """
+        Returns:
+            list: The names of the sinks taking notifications
+        """
+        return [sink.name for sink in self.sinks if sink.active.is_set()]
+
+    def notify(self):
+        for sink in self.sinks:
+            sink.queue.notify()
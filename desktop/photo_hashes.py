@@ -0,0 +1,262 @@
+import io
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import requests
+
+import db
+from logger import get_logger
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Get logger for this module
+logger = get_logger(__name__)
+
+# Photos downloaded and hashed at once
+WORKERS = 8
+# Seconds before giving up a photo download
+DOWNLOAD_TIMEOUT = 5
+# Photos bigger than this are not hashed
+MAX_PHOTO_BYTES = 2 * 1024 * 1024
+# Hashes kept by photo URL, the least recently used are forgotten first
+CACHE_SIZE = 10_000
+# Hashes of the notified listings compared to the new ones, the oldest are forgotten first
+MAX_HASHES = 20_000
+# Different bits out of 64 up to which two photos are the same
+MAX_DISTANCE = 6
+# Width and height of the grayscale image the hash is computed from, one more column to compare
+HASH_SIZE = 8
+
+
+def photo_hash(data):
+    """
+    Compute the difference hash (dHash) of a photo: each bit tells if a pixel of the
+    shrunk grayscale photo is brighter than the next one on its row.
+
+    It stays the same when the photo is resized, recompressed or slightly retouched.
+
+    Args:
+        data (bytes): The photo file
+
+    Returns:
+        int: The 64 bits hash
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        # JPEG photos are decoded at a lower scale, which is much faster
+        image.draft("L", (HASH_SIZE * 4, HASH_SIZE * 4))
+        pixels = list(
+            image.convert("L")
+            .resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.BILINEAR)
+            .getdata()
+        )
+    value = 0
+    for row in range(HASH_SIZE):
+        start = row * (HASH_SIZE + 1)
+        for column in range(start, start + HASH_SIZE):
+            value = (value << 1) | (pixels[column] > pixels[column + 1])
+    return value
+
+
+def distance(first, second):
+    """
+    Returns:
+        int: The number of different bits of two hashes
+    """
+    return (first ^ second).bit_count()
+
+
+class HashIndex:
+    """
+    Finds a hash close to a given one without comparing it to all of them.
+
+    The hashes are split in CHUNKS chunks, and each chunk is indexed. If two hashes differ by
+    at most max_distance bits, one of their chunks differs by at most max_distance // CHUNKS
+    bits, so only the hashes sharing a chunk with one of these few variants are compared.
+    """
+
+    CHUNKS = 4
+    CHUNK_BITS = 64 // CHUNKS
+
+    def __init__(self):
+        # hash -> value
+        self.values = {}
+        # One dict per chunk: chunk bits -> hashes
+        self.chunks = [{} for _ in range(self.CHUNKS)]
+
+    def __len__(self):
+        return len(self.values)
+
+    def _split(self, value_hash):
+        mask = (1 << self.CHUNK_BITS) - 1
+        return [
+            (value_hash >> (index * self.CHUNK_BITS)) & mask
+            for index in range(self.CHUNKS)
+        ]
+
+    def add(self, value_hash, value):
+        if value_hash not in self.values:
+            for chunk, bits in zip(self.chunks, self._split(value_hash)):
+                chunk.setdefault(bits, set()).add(value_hash)
+        self.values[value_hash] = value
+
+    def remove(self, value_hash):
+        if self.values.pop(value_hash, None) is None:
+            return
+        for chunk, bits in zip(self.chunks, self._split(value_hash)):
+            bucket = chunk[bits]
+            bucket.discard(value_hash)
+            if not bucket:
+                del chunk[bits]
+
+    def find(self, value_hash, max_distance):
+        """
+        Returns:
+            The value of a hash at most max_distance away, None if there is none
+        """
+        exact = self.values.get(value_hash)
+        if exact is not None:
+            return exact
+        flips = [0]
+        if max_distance // self.CHUNKS >= 1:
+            flips += [1 << bit for bit in range(self.CHUNK_BITS)]
+        for chunk, bits in zip(self.chunks, self._split(value_hash)):
+            for flip in flips:
+                for candidate in chunk.get(bits ^ flip, ()):
+                    if distance(value_hash, candidate) <= max_distance:
+                        return self.values[candidate]
+        return None
+
+
+class PhotoMatcher:
+    """
+    Finds the new items whose photo was already notified with another listing.
+
+    The photos of a batch are downloaded and hashed by a thread pool once the filters
+    accepted its items, see prefetch(). check() then waits for the photo of an item only
+    until the deadline of its batch: a photo that isn't ready is not compared, the item is
+    notified, and its hash is remembered once it's computed.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        # Seconds a batch can wait for its photos
+        self.budget = 0
+        self.deadline = 0
+        self.pool = None
+        self.session = requests.Session()
+        # Photo URL -> future of its hash, None if it couldn't be computed
+        self.cache = OrderedDict()
+        self.index = HashIndex()
+        # (hash, item id) of the listings in the index, oldest first
+        self.hashes = deque()
+        # The index is updated by the pool threads too
+        self.lock = threading.Lock()
+        self.warned = False
+
+    def refresh(self):
+        """
+        Apply the settings before a new batch.
+        """
+        self.enabled = db.get_parameter("photo_dedup_enabled") == "True"
+        if self.enabled and Image is None:
+            if not self.warned:
+                logger.warning(
+                    "Duplicate photo detection needs Pillow, install it with: pip install Pillow"
+                )
+                self.warned = True
+            self.enabled = False
+        if self.enabled and self.pool is None:
+            self.pool = ThreadPoolExecutor(
+                max_workers=WORKERS, thread_name_prefix="photo"
+            )
+        self.budget = int(db.get_parameter("photo_dedup_budget_ms") or 0) / 1000
+
+    def prefetch(self, items):
+        """
+        Start downloading and hashing the photos of the items of a batch, and the budget
+        of the batch. The filters ran before, so their time isn't taken from the budget.
+
+        Args:
+            items (list): The items that may be notified
+        """
+        self.deadline = time.monotonic() + self.budget
+        for item in items:
+            self._hash_future(item.photo)
+
+    def _hash_future(self, url):
+        if not url:
+            return None
+        future = self.cache.get(url)
+        if future is not None:
+            self.cache.move_to_end(url)
+            return future
+        future = self.pool.submit(self._download_hash, url)
+        self.cache[url] = future
+        if len(self.cache) > CACHE_SIZE:
+            self.cache.popitem(last=False)
+        return future
+
+    def _download_hash(self, url):
+        try:
+            with self.session.get(url, timeout=DOWNLOAD_TIMEOUT, stream=True) as r:
+                r.raise_for_status()
+                data = r.raw.read(MAX_PHOTO_BYTES + 1, decode_content=True)
+            if len(data) > MAX_PHOTO_BYTES:
+                logger.debug(f"Photo too big to hash: {url}")
+                return None
+            return photo_hash(data)
+        except Exception:
+            logger.debug(f"Error hashing photo {url}", exc_info=True)
+            return None
+
+    def _remember(self, item_id, value_hash):
+        with self.lock:
+            self.index.add(value_hash, item_id)
+            self.hashes.append((value_hash, item_id))
+            while len(self.hashes) > MAX_HASHES:
+                old_hash, old_item = self.hashes.popleft()
+                # Unless the same photo was notified again since
+                if self.index.values.get(old_hash) == old_item:
+                    self.index.remove(old_hash)
+
+    def check(self, item):
+        """
+        Check if the photo of an item was notified with another listing, and remember it
+        otherwise.
+
+        Args:
+            item (Item): The item, already accepted by the other checks
+
+        Returns:
+            str: The id of the listing with the same photo, None otherwise
+        """
+        if not self.enabled:
+            return None
+        future = self._hash_future(item.photo)
+        if future is None:
+            return None
+        item_id = str(item.id)
+        try:
+            value_hash = future.result(max(0, self.deadline - time.monotonic()))
+        except FutureTimeoutError:
+            # Too late for this batch, the photo is compared with the next items
+            def remember_later(done):
+                if done.result() is not None:
+                    self._remember(item_id, done.result())
+
+            future.add_done_callback(remember_later)
+            return None
+        if value_hash is None:
+            return None
+        with self.lock:
+            match = self.index.find(value_hash, MAX_DISTANCE)
+        if match is None or match == item_id:
+            self._remember(item_id, value_hash)
+            return None
+        return match
@@ -0,0 +1,89 @@
+import statistics
+from collections import deque
+
+import db
+
+# Priorities of the queries
+LOW = -1
+NORMAL = 0
+HIGH = 1
+PRIORITY_NAMES = {HIGH: "high", NORMAL: "normal", LOW: "low"}
+
+# Seconds of waiting a priority is worth: a high priority item goes before the normal ones
+# queued up to 2 minutes after it, and a low priority item after those queued up to 2 minutes
+# before it. An item waiting longer than that goes first anyway, so no item starves.
+PRIORITY_BOOST = {HIGH: 120, NORMAL: 0, LOW: -120}
+# Seconds of waiting an item half the usual price of its query is worth, a price twice as high costs as much
+PRICE_BOOST = 60
+# Prices remembered per query to know its usual price
+PRICE_HISTORY = 200
+# Prices needed before the usual price of a query is trusted
+MIN_PRICES = 10
+
+
+def priority_name(priority):
+    """
+    Returns:
+        str: "high", "normal" or "low"
+    """
+    return PRIORITY_NAMES.get(priority, PRIORITY_NAMES[NORMAL])
+
+
+class QueryPriorities:
+    """
+    Rates the new items for the dispatcher, from the priority of their query and their price.
+
+    An item gets its query priority, and a boost in seconds: the dispatcher sends the items
+    by queued time minus boost, so an item with a 60 seconds boost goes before the items
+    queued up to 60 seconds after it. The price part compares the item to the median price
+    of the last items notified for its query.
+    """
+
+    def __init__(self):
+        # query id -> priority
+        self.priorities = {}
+        # query id -> prices of its last notified items
+        self.prices = {}
+
+    def refresh(self):
+        """
+        Read the priorities of the queries, called once per batch of items.
+        """
+        self.priorities = db.get_query_priorities()
+
+    def _history(self, query_id):
+        history = self.prices.get(query_id)
+        if history is None:
+            history = deque(
+                db.get_recent_prices(query_id, PRICE_HISTORY), PRICE_HISTORY
+            )
+            self.prices[query_id] = history
+        return history
+
+    def rate(self, query_id, item):
+        """
+        Rate a new item and remember its price.
+
+        Args:
+            query_id (int): The query that found the item
+            item (Item): The item
+
+        Returns:
+            tuple: (priority, boost in seconds)
+        """
+        priority = self.priorities.get(query_id, NORMAL)
+        boost = PRIORITY_BOOST.get(priority, 0)
+        try:
+            price = float(item.price)
+        except (TypeError, ValueError):
+            return priority, boost
+
+        history = self._history(query_id)
+        if len(history) >= MIN_PRICES:
+            usual = statistics.median(history)
+            if usual > 0 and price > 0:
+                # +1 at half the usual price, -1 at twice the usual price
+                ratio = max(0.5, min(2, price / usual))
+                boost += -PRICE_BOOST * (ratio - 1) / (0.5 if ratio < 1 else 1)
+        history.append(price)
+        return priority, boost
@@ -0,0 +1,184 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from logger import get_logger
+
+# Get logger for this module
+logger = get_logger(__name__)
+
+# Folder of the profiling requests and of the profiles
+PROFILES_DIR = "./data/profiles"
+# Seconds between two checks for a profiling request, the only cost while profiling is off
+POLL_INTERVAL = 1
+# Seconds between two samples of the stacks of a profiled process
+SAMPLE_INTERVAL = 0.01
+# Longest profile, in seconds
+MAX_SECONDS = 300
+# Profiles kept per process, the oldest are removed
+MAX_PROFILES = 10
+
+
+def _path(name):
+    return os.path.join(PROFILES_DIR, name)
+
+
+def request(process, seconds):
+    """
+    Ask a process to profile itself. It starts within POLL_INTERVAL seconds.
+
+    Args:
+        process (str): The process name, as given to start()
+        seconds (int): How long to profile, up to MAX_SECONDS
+    """
+    os.makedirs(PROFILES_DIR, exist_ok=True)
+    path = _path(f"{process}.request")
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        f.write(str(max(1, min(MAX_SECONDS, int(seconds)))))
+    os.replace(path + ".tmp", path)
+
+
+def pending():
+    """
+    Returns:
+        dict: process name -> "requested" or "running", for the profiles not finished yet
+    """
+    try:
+        names = os.listdir(PROFILES_DIR)
+    except OSError:
+        return {}
+    states = {}
+    for name in names:
+        process, _, state = name.rpartition(".")
+        if state == "request":
+            states.setdefault(process, "requested")
+        elif state == "running":
+            states[process] = "running"
+    return states
+
+
+def list_profiles():
+    """
+    Returns:
+        list: (file name, process, finished at, size in bytes) of the profiles, newest first
+    """
+    try:
+        names = os.listdir(PROFILES_DIR)
+    except OSError:
+        return []
+    profiles = []
+    for name in names:
+        if not name.endswith(".folded"):
+            continue
+        try:
+            status = os.stat(_path(name))
+        except OSError:
+            continue
+        profiles.append((name, name.rsplit("-", 2)[0], status.st_mtime, status.st_size))
+    return sorted(profiles, key=lambda profile: profile[2], reverse=True)
+
+
+def _frame_name(code, names):
+    name = names.get(code)
+    if name is None:
+        file_name = os.path.basename(code.co_filename)
+        name = names[code] = f"{code.co_name} ({file_name}:{code.co_firstlineno})"
+    return name
+
+
+def sample(seconds, interval=SAMPLE_INTERVAL):
+    """
+    Sample the stacks of every thread of this process, except the calling one.
+
+    The samples are wall clock: a thread waiting for the network or a queue is counted
+    where it waits.
+
+    Args:
+        seconds (float): How long to sample
+        interval (float, optional): Seconds between two samples
+
+    Returns:
+        Counter: Collapsed stack "thread;outer function;...;inner function" -> samples
+    """
+    own = threading.get_ident()
+    # Code object -> frame name, most frames are seen again and again
+    names = {}
+    stacks = Counter()
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        threads = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame.f_code, names))
+                frame = frame.f_back
+            stack.append(threads.get(ident, str(ident)))
+            stacks[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def _write_profile(process, stacks):
+    # Collapsed stacks, one "stack count" per line, read by flamegraph.pl and speedscope
+    name = f"{process}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.folded"
+    with open(_path(name) + ".tmp", "w", encoding="utf-8") as f:
+        f.writelines(f"{stack} {count}\n" for stack, count in stacks.most_common())
+    os.replace(_path(name) + ".tmp", _path(name))
+
+    old_profiles = [profile for profile in list_profiles() if profile[1] == process]
+    for profile in old_profiles[MAX_PROFILES:]:
+        try:
+            os.remove(_path(profile[0]))
+        except OSError:
+            pass
+    return name
+
+
+def _profile(process):
+    path = _path(f"{process}.request")
+    try:
+        with open(path, encoding="utf-8") as f:
+            seconds = f.read()
+        os.replace(path, _path(f"{process}.running"))
+    except OSError:
+        return
+    try:
+        seconds = max(1, min(MAX_SECONDS, int(seconds)))
+        logger.info(f"Profiling the {process} process for {seconds} seconds")
+        name = _write_profile(process, sample(seconds))
+        logger.info(f"Profile of the {process} process saved as {name}")
+    finally:
+        os.remove(_path(f"{process}.running"))
+
+
+def _watch(process):
+    path = _path(f"{process}.request")
+    while True:
+        try:
+            if os.path.exists(path):
+                _profile(process)
+        except Exception:
+            logger.exception(f"Error profiling the {process} process")
+        time.sleep(POLL_INTERVAL)
+
+
+def start(process):
+    """
+    Profile this process whenever request() asks for it.
+
+    Args:
+        process (str): The process name
+    """
+    # Left by a profile the process didn't finish before it stopped
+    try:
+        os.remove(_path(f"{process}.running"))
+    except OSError:
+        pass
+    threading.Thread(
+        target=_watch, args=(process,), daemon=True, name="profiler"
+    ).start()
@@ -18,6 +18,8 @@ class Item:
         price (float): The price of the item.
         photo (str): The URL of the item's photo.
         url (str): The URL of the item on Vinted.
+        user_id (int): The id of the seller, or None if not available.
+        user_login (str): The login of the seller, or None if not available.
         created_at_ts (datetime): The timestamp when the item was created.
         raw_timestamp (int): The raw timestamp value from the API.
     """
@@ -42,6 +44,9 @@ class Item:
         self.price = data["price"]["amount"]
         self.photo = data["photo"]["url"]
         self.url = data["url"]
+        user = data.get("user") or {}
+        self.user_id = user.get("id")
+        self.user_login = user.get("login")
         # We keep everything before the "items"
         self.buy_url = (
             data["url"].split("items")[0]
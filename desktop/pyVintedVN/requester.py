@@ -4,16 +4,23 @@ import sys
 import os
 import db
 import random
+from urllib.parse import urlparse
 import requests
 from requests.exceptions import HTTPError
 
 # Add the parent directory to sys.path to import logger
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import metrics
 from logger import get_logger
 
 # Get logger for this module
 logger = get_logger(__name__)
 
+# Requests to Vinted by status code ("error" if there was no response) and proxy
+http_requests = metrics.counter(
+    "vinted_http_requests_total", "Requests to Vinted", ("status", "proxy")
+)
+
 
 class Requester:
     """
@@ -121,7 +128,7 @@ class Requester:
         new_session = False
         while tried < self.MAX_RETRIES:
             tried += 1
-            with self.session.get(url, params=params) as response:
+            with self._counted_get(url, params) as response:
                 if response.status_code in (401, 404) and tried < self.MAX_RETRIES:
                     print(f"Cookies invalid, retrying {tried}/{self.MAX_RETRIES}")
                     if self.debug:
@@ -162,6 +169,23 @@ class Requester:
             f"Failed to get a valid response after {self.MAX_RETRIES} attempts"
         )
 
+    def _proxy_name(self):
+        # The proxy address without its credentials, "direct" without a proxy
+        proxy = self.session.proxies.get("https") or self.session.proxies.get("http")
+        if not proxy:
+            return "direct"
+        parsed = urlparse(proxy if "//" in proxy else f"//{proxy}")
+        return f"{parsed.hostname}:{parsed.port}" if parsed.port else parsed.hostname
+
+    def _counted_get(self, url, params):
+        try:
+            response = self.session.get(url, params=params)
+        except requests.RequestException:
+            http_requests.inc(status="error", proxy=self._proxy_name())
+            raise
+        http_requests.inc(status=response.status_code, proxy=self._proxy_name())
+        return response
+
     def post(self, url, params=None):
         """
         Make a POST request.
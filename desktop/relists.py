@@ -0,0 +1,274 @@
+import re
+import struct
+import time
+import zlib
+from collections import OrderedDict
+
+import db
+from filters import strip_accents
+from logger import get_logger
+
+# Get logger for this module
+logger = get_logger(__name__)
+
+# MinHash values per title, split in LSH_BANDS bands of LSH_ROWS values. Two titles with a
+# Jaccard similarity of s share a band with a probability of 1 - (1 - s^4)^8: 0.99 at 0.8, 0.65 at 0.5.
+NUM_HASHES = 32
+LSH_BANDS = 8
+LSH_ROWS = NUM_HASHES // LSH_BANDS
+# Estimated similarity of two titles above which they are compared word by word
+SIMILARITY_THRESHOLD = 0.5
+# Relative price difference between a listing and its relist
+PRICE_TOLERANCE = 0.2
+# Characters per title shingle
+SHINGLE_SIZE = 3
+# Listings kept in memory, the oldest are forgotten first
+MAX_ENTRIES = 50_000
+# Seconds between two removals of the expired signatures from the database
+PRUNE_INTERVAL = 60 * 60
+
+_WORD = re.compile(r"[^\W_]+")
+_SIGNATURE_FORMAT = f"<{NUM_HASHES}I"
+
+
+def normalize_title(title):
+    """
+    Lowercase a title, remove its accents, punctuation and emojis.
+
+    Args:
+        title (str): The title
+
+    Returns:
+        str: The words of the title separated by a space
+    """
+    return " ".join(_WORD.findall(strip_accents((title or "").lower())))
+
+
+def title_signature(text):
+    """
+    Compute the MinHash signature of a normalized title, over its character shingles.
+
+    Each shingle is hashed once: the hash picks one of the NUM_HASHES bins and the bin keeps
+    its lowest value (one permutation hashing). An empty bin takes the value of the next
+    non-empty one, so short titles still have comparable signatures.
+
+    Args:
+        text (str): The title, as returned by normalize_title
+
+    Returns:
+        tuple: NUM_HASHES integers
+    """
+    bins = [None] * NUM_HASHES
+    data = text.encode()
+    for i in range(max(1, len(data) - SHINGLE_SIZE + 1)):
+        hashed = zlib.crc32(data[i : i + SHINGLE_SIZE])
+        index = hashed % NUM_HASHES
+        value = hashed // NUM_HASHES
+        if bins[index] is None or value < bins[index]:
+            bins[index] = value
+    # Fill the empty bins from the next ones, the last non-empty bin is found first
+    filled = next((value for value in reversed(bins) if value is not None), 0)
+    for index in range(NUM_HASHES - 1, -1, -1):
+        if bins[index] is None:
+            bins[index] = filled
+        else:
+            filled = bins[index]
+    return tuple(bins)
+
+
+def similarity(first, second):
+    """
+    Estimate the Jaccard similarity of two titles from their signatures.
+
+    Returns:
+        float: Between 0 and 1
+    """
+    return sum(a == b for a, b in zip(first, second)) / NUM_HASHES
+
+
+def _typo(first, second):
+    # True if the words differ by one added, removed or replaced character
+    if abs(len(first) - len(second)) > 1:
+        return False
+    if len(first) > len(second):
+        first, second = second, first
+    for i, (a, b) in enumerate(zip(first, second)):
+        if a != b:
+            skip = 1 if len(first) == len(second) else 0
+            return first[i + skip :] == second[i + 1 :]
+    return True
+
+
+def same_item(first, second):
+    """
+    Compare two normalized titles word by word.
+
+    Words can be added, removed, moved or have a typo, but a word replaced by another one,
+    like a color or a size, makes them different items.
+
+    Returns:
+        bool: True if the titles can describe the same item
+    """
+    first_words, second_words = set(first.split()), set(second.split())
+    only_first = first_words - second_words
+    only_second = second_words - first_words
+    for word in list(only_first):
+        typo = next((other for other in only_second if _typo(word, other)), None)
+        if typo is not None:
+            only_first.discard(word)
+            only_second.discard(typo)
+    return not (only_first and only_second)
+
+
+def _price(item):
+    try:
+        return float(item.price)
+    except (TypeError, ValueError):
+        return None
+
+
+class RelistDetector:
+    """
+    Finds the items a seller deleted and listed again under a new id.
+
+    An item is a relist of a listing of the same seller from the last window seconds if its
+    title (with its size) is nearly the same and its price is close. The listings are indexed
+    by seller and LSH band, so an item is only compared to the few listings sharing a band
+    with it. The index is kept in memory and saved to the item_signatures table, to be
+    reloaded after a restart.
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        # Seconds a listing is remembered, 0 when the detection is disabled
+        self.window = 0
+        # item id -> (seller id, price, normalized title, signature, listed at, id of the listing it relists or None),
+        # oldest first
+        self.entries = OrderedDict()
+        # (seller id, band, band values) -> ids of the listings
+        self.buckets = {}
+        self.next_prune = 0
+
+    def refresh(self):
+        """
+        Apply the window setting, loading the index when the detection is enabled.
+
+        This is meant to be called once per batch of items.
+        """
+        window = int(db.get_parameter("relist_window_hours") or 0) * 60 * 60
+        if window == self.window:
+            return
+        enabled = not self.window
+        self.window = window
+        if window and enabled:
+            self.entries.clear()
+            self.buckets.clear()
+            self._load()
+
+    def _load(self):
+        since = time.time() - self.window
+        for (
+            item_id,
+            user_id,
+            price,
+            title,
+            signature,
+            listed_at,
+            relist_of,
+        ) in db.get_item_signatures(since, self.max_entries):
+            self._add(
+                item_id,
+                user_id,
+                price,
+                title,
+                struct.unpack(_SIGNATURE_FORMAT, signature),
+                listed_at,
+                relist_of,
+            )
+        logger.info(f"Loaded {len(self.entries)} listing signatures")
+
+    def _band_keys(self, user_id, signature):
+        return [
+            (user_id, band, signature[band * LSH_ROWS : (band + 1) * LSH_ROWS])
+            for band in range(LSH_BANDS)
+        ]
+
+    def _add(self, item_id, user_id, price, title, signature, listed_at, relist_of):
+        self.entries[item_id] = (user_id, price, title, signature, listed_at, relist_of)
+        for key in self._band_keys(user_id, signature):
+            self.buckets.setdefault(key, set()).add(item_id)
+
+    def _evict(self, now):
+        # The entries are in listing order, expired ones are at the start
+        while self.entries:
+            item_id, entry = next(iter(self.entries.items()))
+            if len(self.entries) <= self.max_entries and entry[4] >= now - self.window:
+                break
+            del self.entries[item_id]
+            for key in self._band_keys(entry[0], entry[3]):
+                bucket = self.buckets[key]
+                bucket.discard(item_id)
+                if not bucket:
+                    del self.buckets[key]
+        if now >= self.next_prune:
+            db.prune_item_signatures(now - self.window)
+            self.next_prune = now + PRUNE_INTERVAL
+
+    def check(self, item):
+        """
+        Check if an item relists an earlier listing of its seller, and remember it.
+
+        Args:
+            item (Item): The item, already accepted by the filters
+
+        Returns:
+            str: The id of the earlier listing if the item is a relist, None otherwise
+        """
+        if not self.window or item.user_id is None:
+            return None
+        item_id, user_id = str(item.id), str(item.user_id)
+        entry = self.entries.get(item_id)
+        if entry is not None:
+            # Seen by another query
+            return entry[5]
+
+        now = time.time()
+        price = _price(item)
+        title = normalize_title(f"{item.title} {item.size_title or ''}")
+        signature = title_signature(title)
+        candidates = set()
+        for key in self._band_keys(user_id, signature):
+            candidates.update(self.buckets.get(key, ()))
+
+        relist_of = None
+        for candidate in candidates:
+            _, candidate_price, candidate_title, candidate_signature, listed_at, _ = (
+                self.entries[candidate]
+            )
+            if listed_at < now - self.window:
+                continue
+            if (
+                price is not None
+                and candidate_price is not None
+                and abs(price - candidate_price)
+                > PRICE_TOLERANCE * max(price, candidate_price)
+            ):
+                continue
+            if similarity(
+                signature, candidate_signature
+            ) >= SIMILARITY_THRESHOLD and same_item(title, candidate_title):
+                relist_of = candidate
+                break
+
+        self._add(item_id, user_id, price, title, signature, now, relist_of)
+        db.add_item_signature(
+            item_id,
+            user_id,
+            price,
+            title,
+            struct.pack(_SIGNATURE_FORMAT, *signature),
+            now,
+            relist_of,
+        )
+        self._evict(now)
+        return relist_of
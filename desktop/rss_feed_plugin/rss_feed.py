@@ -1,22 +1,35 @@
 from flask import Flask, Response
 import threading
-import time
+from queue import Empty
 import db
+import db_writer
+import durable_queue
+import metrics
+import profiling
 import datetime
-import html
+from latency import LatencyRecorder
+from message_template import compile_template
+import wire
 from logger import get_logger
 from feedgen.feed import FeedGenerator
 
 # Get logger for this module
 logger = get_logger(__name__)
 
+# Seconds a queue read waits before checking if the feed was stopped
+QUEUE_TIMEOUT = 1
+# Maximum number of items added to the feed at once
+MAX_BATCH_SIZE = 100
+
 
 class RSSFeed:
     def __init__(self, queue):
         self.app = Flask(__name__)
         self.queue = queue
         self.items = []
-        self.max_items = db.get_parameter("rss_max_items")
+        self.max_items = int(db.get_parameter("rss_max_items"))
+        # Times the stages of the items published
+        self.latency = LatencyRecorder("rss")
 
         # Initialize feed generator
         self.fg = FeedGenerator()
@@ -29,50 +42,55 @@ class RSSFeed:
         self.app.route("/")(self.serve_rss)
 
         # Start thread to check queue
+        self.stopped = threading.Event()
         self.thread = threading.Thread(target=self.run_check_queue)
         self.thread.daemon = True
         self.thread.start()
 
     def run_check_queue(self):
-        while True:
+        while not self.stopped.is_set():
             try:
                 self.check_rss_queue()
-                time.sleep(0.1)  # Small sleep to prevent high CPU usage
             except Exception as e:
                 logger.error(f"Error checking RSS queue: {str(e)}", exc_info=True)
 
     def check_rss_queue(self):
-        if not self.queue.empty():
+        # Sleep until an item is queued, then take everything already queued
+        try:
+            messages = [self.queue.get(timeout=QUEUE_TIMEOUT)]
+        except Empty:
+            return
+        while len(messages) < MAX_BATCH_SIZE:
             try:
-                content, url, text, buy_url, buy_text = self.queue.get()
+                messages.append(self.queue.get_nowait())
+            except Empty:
+                break
 
+        template = compile_template(db.get_parameter("message_template"))
+        for message in messages:
+            try:
+                fields, url, text, buy_url, buy_text, *trace = wire.decode_notification(
+                    message
+                )
                 # Add item to the feed
-                self.add_item_to_feed(content, url)
+                self.add_item_to_feed(template, fields, url)
+                if trace:
+                    self.latency.observe(trace[0])
             except Exception as e:
                 logger.error(
                     f"Error processing item for RSS feed: {str(e)}", exc_info=True
                 )
+        durable_queue.ack(self.queue)
 
-    def add_item_to_feed(self, content, url):
-        # Extract title from content (assuming it's in the format from configuration_values.MESSAGE)
-        title = "New Vinted Item"
-        try:
-            # Try to extract title from the content
-            title_start = content.find("🆕 Title : ") + len("🆕 Title : ")
-            if title_start > len("🆕 Title : "):
-                title_end = content.find("\n", title_start)
-                if title_end > 0:
-                    title = content[title_start:title_end]
-        except Exception as e:
-            logger.debug(f"Error extracting title from content: {e}")
-            pass
+    def add_item_to_feed(self, template, fields, url):
+        title, content = template.rss_entry(fields)
 
         # Create a new entry
         fe = self.fg.add_entry()
         fe.id(url)
         fe.title(title)
         fe.link(href=url)
-        fe.description(html.escape(content))
+        fe.description(content)
         fe.published(datetime.datetime.now(datetime.timezone.utc))
 
         # Add to our items list (for tracking)
@@ -82,6 +100,12 @@ class RSSFeed:
         if len(self.items) > self.max_items:
             self.items.pop(0)
 
+    def stop(self):
+        """
+        Stop taking items from the queue, for feeds running in a shared process.
+        """
+        self.stopped.set()
+
     def serve_rss(self):
         return Response(self.fg.rss_str(), mimetype="application/rss+xml")
 
@@ -95,14 +119,18 @@ class RSSFeed:
             logger.error(f"Error starting RSS feed server: {str(e)}", exc_info=True)
 
 
-def rss_feed_process(queue):
+def rss_feed_process(queue, writer=None):
     """
     Process function for the RSS feed.
 
     Args:
         queue (Queue): The queue to get new items from
+        writer (DatabaseWriter, optional): The database writer, if writes go through one
     """
     logger.info("RSS feed process started")
+    db_writer.attach(writer, "rss")
+    metrics.start("rss")
+    profiling.start("rss")
     try:
         feed = RSSFeed(queue)
         feed.run()
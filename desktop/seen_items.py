@@ -0,0 +1,142 @@
+import math
+from collections import OrderedDict
+
+import db
+from logger import get_logger
+
+# Get logger for this module
+logger = get_logger(__name__)
+
+_MASK_64 = (1 << 64) - 1
+
+
+def _mix(value):
+    # splitmix64 finalizer, spreads consecutive item ids over the whole 64 bits
+    value = (value + 0x9E3779B97F4A7C15) & _MASK_64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & _MASK_64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & _MASK_64
+    return value ^ (value >> 31)
+
+
+class BloomFilter:
+    """
+    A Bloom filter over integer keys.
+
+    It never forgets a key that was added, and wrongly claims to contain a key
+    that wasn't added with a probability of about error_rate while it holds at
+    most capacity keys.
+
+    Attributes:
+        capacity (int): The number of keys the filter is sized for.
+        error_rate (float): The false positive rate at capacity.
+        size (int): The number of bits.
+        hash_count (int): The number of bits set per key.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        # Double hashing: the k positions are derived from two 32 bits hashes
+        hashed = _mix(key)
+        first, second = hashed & 0xFFFFFFFF, (hashed >> 32) | 1
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(
+            bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(key)
+        )
+
+    @property
+    def memory_bytes(self):
+        return len(self.bits)
+
+
+class SeenItems:
+    """
+    The ids of the items already stored, kept in the extractor process.
+
+    Lookups are answered from memory whenever possible:
+    - ids seen recently (cross-query duplicates are found within minutes) are kept in a bounded exact set
+    - ids the Bloom filter has never seen are new, which is the case for almost every item reaching this check
+    - only the remaining ids (old duplicates and false positives) are confirmed in the database
+
+    With the default error rate, 10M ids take 17.1 MiB for the Bloom filter (10 hashes,
+    0.1% false positives) plus about 13.5 MiB for 100k recent ids.
+
+    Note that items deleted with their query are still known as recent ids until they
+    are pushed out of the recent set.
+    """
+
+    def __init__(self, capacity=1_000_000, error_rate=0.001, recent_size=100_000):
+        self.error_rate = error_rate
+        self.recent_size = recent_size
+        self.bloom = BloomFilter(capacity, error_rate)
+        self.recent = OrderedDict()
+        self.count = 0
+
+    @classmethod
+    def from_db(cls, error_rate=0.001, recent_size=100_000):
+        """
+        Load the ids of all the items stored in the database.
+
+        The filter is sized for twice the current number of items, so it keeps its
+        error rate while the database grows.
+
+        Returns:
+            SeenItems: The loaded ids
+        """
+        total = db.get_total_items_count()
+        seen_items = cls(max(1_000_000, 2 * total), error_rate, recent_size)
+        seen_items._load()
+        logger.info(
+            f"Loaded {seen_items.count} item ids ({seen_items.bloom.memory_bytes / 2**20:.1f} MiB Bloom filter)"
+        )
+        return seen_items
+
+    def _load(self):
+        for item_id in db.iter_item_ids():
+            self.bloom.add(int(item_id))
+            self.count += 1
+
+    def add(self, item_id):
+        """
+        Remember an item that was just stored.
+
+        Args:
+            item_id (int): The item id
+        """
+        item_id = int(item_id)
+        self.recent[item_id] = None
+        if len(self.recent) > self.recent_size:
+            self.recent.popitem(last=False)
+        self.bloom.add(item_id)
+        self.count += 1
+
+        # Past its capacity, the filter's error rate goes up: resize it
+        if self.count > self.bloom.capacity:
+            logger.info(f"Resizing seen items filter for {2 * self.count} ids")
+            self.bloom = BloomFilter(2 * self.count, self.error_rate)
+            self.count = 0
+            self._load()
+            for recent_id in self.recent:
+                self.bloom.add(recent_id)
+
+    def __contains__(self, item_id):
+        item_id = int(item_id)
+        if item_id in self.recent:
+            return True
+        if item_id not in self.bloom:
+            return False
+        # The filter might be wrong, ask the database
+        return db.is_item_in_db_by_id(item_id) is True
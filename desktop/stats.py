@@ -0,0 +1,181 @@
+import bisect
+import json
+import os
+import time
+
+from logger import get_logger
+
+# Get logger for this module
+logger = get_logger(__name__)
+
+# Folder of the stats snapshots, one JSON file per publisher
+STATS_DIR = "./data/stats"
+# Upper bounds in seconds of the histogram buckets, the last bucket has no bound
+LATENCY_BUCKETS = (
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1,
+    2,
+    5,
+    10,
+    30,
+    60,
+    120,
+    300,
+    600,
+    1200,
+    3600,
+)
+
+
+def publish(name, values):
+    """
+    Write a stats snapshot, replacing the previous one of the same name.
+
+    The file is replaced in one step, so readers never see a partial snapshot.
+
+    Args:
+        name (str): The snapshot name, usually the publishing process
+        values (dict): The stats, must be JSON serializable
+    """
+    try:
+        os.makedirs(STATS_DIR, exist_ok=True)
+        path = os.path.join(STATS_DIR, f"{name}.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"updated": time.time(), **values}, f)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        logger.error(f"Error publishing {name} stats: {e}")
+
+
+def read(name, max_age=None):
+    """
+    Read the last stats snapshot of a publisher.
+
+    Args:
+        name (str): The snapshot name
+        max_age (float, optional): Ignore snapshots older than this many seconds
+
+    Returns:
+        dict: The stats with their "updated" timestamp, or None if there are none
+    """
+    try:
+        with open(os.path.join(STATS_DIR, f"{name}.json"), encoding="utf-8") as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if max_age is not None and time.time() - snapshot["updated"] > max_age:
+        return None
+    return snapshot
+
+
+def read_all(prefix, max_age=None):
+    """
+    Read the last stats snapshots of every publisher whose name starts with a prefix.
+
+    Args:
+        prefix (str): The start of the snapshot names, e.g. "metrics_"
+        max_age (float, optional): Ignore snapshots older than this many seconds
+
+    Returns:
+        dict: The snapshots by name, without the prefix
+    """
+    try:
+        names = os.listdir(STATS_DIR)
+    except OSError:
+        return {}
+    snapshots = {}
+    for file_name in names:
+        if file_name.startswith(prefix) and file_name.endswith(".json"):
+            name = file_name[: -len(".json")]
+            snapshot = read(name, max_age)
+            if snapshot is not None:
+                snapshots[name[len(prefix) :]] = snapshot
+    return snapshots
+
+
+class Histogram:
+    """
+    Counts durations in fixed buckets, to publish their distribution in little space.
+
+    The percentiles are the upper bound of the bucket they fall in, so they are
+    overestimated by at most a bucket.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """
+        Rebuild a histogram from its snapshot, to merge it with others.
+
+        Args:
+            snapshot (dict): As returned by snapshot()
+        """
+        histogram = cls()
+        histogram.counts = list(snapshot["buckets"].values())
+        histogram.count = snapshot["count"]
+        histogram.total = (snapshot["mean"] or 0) * snapshot["count"]
+        histogram.max = snapshot["max"]
+        return histogram
+
+    def merge(self, other):
+        """
+        Add the durations counted by another histogram with the same buckets.
+        """
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def observe(self, value):
+        """
+        Args:
+            value (float): A duration, in seconds
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, fraction):
+        """
+        Args:
+            fraction (float): Between 0 and 1, e.g. 0.99
+
+        Returns:
+            float: The value below which this fraction of the durations are, None if there are none
+        """
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: The count, mean, p50, p90, p99 and max, JSON serializable
+        """
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+            "buckets": dict(
+                zip([str(bound) for bound in self.buckets] + ["inf"], self.counts)
+            ),
+        }
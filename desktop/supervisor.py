@@ -0,0 +1,391 @@
+import multiprocessing
+import os
+import threading
+import time
+from multiprocessing.connection import Client, Listener, wait
+
+import metrics
+import stats
+from logger import get_logger
+
+# Get logger for this module
+logger = get_logger(__name__)
+
+# Seconds before restarting a crashed process, doubled at each crash in a row
+MIN_BACKOFF = 1
+MAX_BACKOFF = 60
+# A process running this many seconds is healthy again, its next crash restarts it after MIN_BACKOFF
+HEALTHY_AFTER = 60
+# Seconds a command waits for the supervisor
+COMMAND_TIMEOUT = 10
+# Restarts of the crashed processes, see metrics.py
+_restarts = metrics.counter(
+    "vinted_process_restarts_total", "Restarts of a crashed process", ("child",)
+)
+
+
+class Child:
+    """
+    A process run by the supervisor.
+
+    Attributes:
+        name (str): The process name, used in the commands.
+        target (callable): The process function.
+        args (tuple): The arguments of the process function.
+        should_run (bool): The process is restarted if it stops while this is set.
+        can_start (callable): Returns an error message if the process can't start, None otherwise.
+        on_change (callable): Called with should_run when it changes, before starting or after stopping.
+    """
+
+    def __init__(
+        self, name, target, args=(), should_run=True, can_start=None, on_change=None
+    ):
+        self.name = name
+        self.target = target
+        self.args = args
+        self.should_run = should_run
+        self.can_start = can_start
+        self.on_change = on_change
+        self.process = None
+        self.started_at = None
+        self.restart_at = None
+        self.backoff = 0
+        self.restarts = 0
+        self.exit_code = None
+
+    @property
+    def running(self):
+        return self.process is not None and self.process.is_alive()
+
+    def health(self):
+        return {
+            "should_run": self.should_run,
+            "running": self.running,
+            "pid": self.process.pid if self.running else None,
+            "uptime": time.time() - self.started_at if self.running else None,
+            "restarts": self.restarts,
+            "exit_code": self.exit_code,
+            "restart_at": self.restart_at,
+        }
+
+
+class Supervisor:
+    """
+    Starts the processes of the application and restarts them when they crash.
+
+    The supervisor sleeps until a process exits or a command arrives, nothing is polled.
+    Commands are sent by the other processes over a local authenticated socket, see
+    send_command(). The database stays the persisted state: the web UI saves a setting,
+    then tells the supervisor to apply it.
+    """
+
+    def __init__(self):
+        self.children = {}
+        self.handlers = {
+            "start": self._start_command,
+            "stop": self._stop_command,
+            "restart": self._restart_command,
+            "status": self.status,
+        }
+        self.lock = threading.RLock()
+        self.authkey = os.urandom(32)
+        self.listener = Listener(("127.0.0.1", 0), authkey=self.authkey)
+        # Written to wake the supervision loop up after a command
+        self._wakeup_reader, self._wakeup_writer = multiprocessing.Pipe(duplex=False)
+
+    @property
+    def channel(self):
+        """
+        The address and key of the control channel, passed to the processes sending commands.
+        """
+        return self.listener.address, self.authkey
+
+    def add(self, child):
+        self.children[child.name] = child
+
+    def handle(self, command, handler):
+        """
+        Add a command.
+
+        Args:
+            command (str): The command name
+            handler (callable): Called with the command arguments, returns the reply
+        """
+        self.handlers[command] = handler
+
+    def status(self):
+        """
+        Returns:
+            dict: The health of each process, by name
+        """
+        with self.lock:
+            return {name: child.health() for name, child in self.children.items()}
+
+    def _publish(self):
+        stats.publish("supervisor", {"processes": self.status()})
+
+    ### PROCESSES ###
+
+    def _spawn(self, child):
+        child.process = multiprocessing.Process(
+            target=child.target, args=child.args, name=child.name
+        )
+        child.process.start()
+        child.started_at = time.time()
+        child.restart_at = None
+
+    def _terminate(self, child):
+        if child.running:
+            child.process.terminate()
+            child.process.join()
+        child.process = None
+
+    def start(self, name):
+        """
+        Start a process and keep it running.
+
+        Args:
+            name (str): The process name
+
+        Returns:
+            str: An error message, or None if the process runs
+        """
+        with self.lock:
+            child = self.children[name]
+            error = child.can_start() if child.can_start else None
+            if error:
+                logger.warning(f"Can't start {name} process: {error}")
+                child.should_run = False
+                if child.on_change:
+                    child.on_change(False)
+                return error
+            child.should_run = True
+            child.backoff = 0
+            if child.on_change:
+                child.on_change(True)
+            if not child.running:
+                logger.info(f"Starting {name} process")
+                self._spawn(child)
+            self._wake()
+            return None
+
+    def stop(self, name):
+        """
+        Stop a process, it isn't restarted until the next start.
+
+        Args:
+            name (str): The process name
+        """
+        with self.lock:
+            child = self.children[name]
+            child.should_run = False
+            child.restart_at = None
+            if child.running:
+                logger.info(f"Stopping {name} process")
+            self._terminate(child)
+            if child.on_change:
+                child.on_change(False)
+            self._wake()
+
+    def restart(self, name):
+        """
+        Restart a process if it should run.
+
+        Args:
+            name (str): The process name
+        """
+        with self.lock:
+            child = self.children[name]
+            if child.should_run:
+                logger.info(f"Restarting {name} process")
+                self._terminate(child)
+                self._spawn(child)
+                self._wake()
+
+    def start_all(self):
+        """
+        Start every process that should run, in the order they were added.
+        """
+        with self.lock:
+            for child in self.children.values():
+                if child.should_run:
+                    self.start(child.name)
+        self._publish()
+
+    def stop_all(self):
+        """
+        Stop every process, in the reverse order they were added.
+        """
+        with self.lock:
+            for child in reversed(list(self.children.values())):
+                if child.running:
+                    child.process.terminate()
+                    child.process.join()
+
+    def _check_exits(self):
+        # Schedule the restart of the processes that stopped on their own
+        now = time.time()
+        changed = False
+        for child in self.children.values():
+            if child.process is None or child.process.is_alive():
+                continue
+            child.exit_code = child.process.exitcode
+            child.process.join()
+            child.process = None
+            changed = True
+            if not child.should_run:
+                continue
+            if now - child.started_at >= HEALTHY_AFTER:
+                child.backoff = 0
+            child.backoff = min(MAX_BACKOFF, max(MIN_BACKOFF, child.backoff * 2))
+            child.restart_at = now + child.backoff
+            logger.error(
+                f"{child.name} process exited with code {child.exit_code}, restarting in {child.backoff}s"
+            )
+        return changed
+
+    def _restart_due(self):
+        now = time.time()
+        changed = False
+        for child in self.children.values():
+            if (
+                child.should_run
+                and child.restart_at is not None
+                and child.restart_at <= now
+            ):
+                child.restarts += 1
+                _restarts.inc(child=child.name)
+                self._spawn(child)
+                changed = True
+        return changed
+
+    def run(self):
+        """
+        Supervise the processes until the main process is stopped.
+        """
+        threading.Thread(target=self._serve_commands, daemon=True).start()
+        while True:
+            with self.lock:
+                sentinels = [
+                    child.process.sentinel
+                    for child in self.children.values()
+                    if child.process is not None
+                ]
+                restarts = [
+                    child.restart_at
+                    for child in self.children.values()
+                    if child.restart_at is not None
+                ]
+            timeout = max(0, min(restarts) - time.time()) if restarts else None
+
+            ready = wait(sentinels + [self._wakeup_reader], timeout)
+            if self._wakeup_reader in ready:
+                while self._wakeup_reader.poll():
+                    self._wakeup_reader.recv()
+
+            with self.lock:
+                changed = self._check_exits()
+                changed = self._restart_due() or changed
+            if changed:
+                self._publish()
+
+    def _wake(self):
+        self._wakeup_writer.send(None)
+
+    ### COMMANDS ###
+
+    def _serve_commands(self):
+        while True:
+            try:
+                with self.listener.accept() as conn:
+                    command, args = conn.recv()
+                    handler = self.handlers.get(command)
+                    if handler is None:
+                        reply = {"error": f"Unknown command: {command}"}
+                    else:
+                        try:
+                            reply = handler(*args)
+                        except Exception as e:
+                            logger.exception(f"Error running command {command}")
+                            reply = {"error": str(e)}
+                    conn.send(reply)
+            except Exception:
+                logger.exception("Error in control channel")
+
+    def _check_name(self, name):
+        if name not in self.children:
+            raise ValueError(f"Unknown process: {name}")
+
+    def _start_command(self, name):
+        self._check_name(name)
+        error = self.start(name)
+        self._publish()
+        return {"error": error} if error else {"status": self.children[name].health()}
+
+    def _stop_command(self, name):
+        self._check_name(name)
+        self.stop(name)
+        self._publish()
+        return {"status": self.children[name].health()}
+
+    def _restart_command(self, name):
+        self._check_name(name)
+        self.restart(name)
+        self._publish()
+        return {"status": self.children[name].health()}
+
+
+# Control channel of the current process, see attach()
+_channel = None
+# Handles the commands in the current process instead, see handle_locally()
+_local_handler = None
+
+
+def attach(channel):
+    """
+    Send the commands of the current process to the supervisor.
+
+    Args:
+        channel (tuple): Supervisor.channel, or None if there is no supervisor
+    """
+    global _channel
+    _channel = channel
+
+
+def handle_locally(handler):
+    """
+    Handle the commands of the current process in the process itself, when the whole
+    application runs in one process.
+
+    Args:
+        handler (callable): Called with the command and its arguments, returns the reply
+    """
+    global _local_handler
+    _local_handler = handler
+
+
+def send_command(command, *args):
+    """
+    Send a command to the supervisor and wait for its reply.
+
+    Args:
+        command (str): The command, e.g. "start"
+        *args: The command arguments, e.g. the process name
+
+    Returns:
+        The reply of the command, or None if it couldn't be sent
+    """
+    if _local_handler is not None:
+        return _local_handler(command, *args)
+    if _channel is None:
+        return None
+    address, authkey = _channel
+    try:
+        with Client(address, authkey=authkey) as conn:
+            conn.send((command, args))
+            if conn.poll(COMMAND_TIMEOUT):
+                return conn.recv()
+            logger.error(f"Supervisor didn't reply to {command}")
+    except (OSError, EOFError) as e:
+        logger.error(f"Error sending {command} to the supervisor: {e}")
+    return None
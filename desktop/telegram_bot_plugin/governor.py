@@ -0,0 +1,104 @@
+import asyncio
+import time
+
+# Messages per second sent by the bot over all the chats, Telegram accepts about 30
+GLOBAL_RATE = 25
+# Messages per second in a private chat, Telegram accepts about 1
+PRIVATE_CHAT_RATE = 1
+# Messages per second in a group or a channel, Telegram accepts 20 per minute
+GROUP_CHAT_RATE = 19 / 60
+# Chats remembered, the ones idle the longest are forgotten first
+MAX_CHATS = 10_000
+
+
+class _Pacer:
+    """
+    Spaces out events by a fixed interval, handing out their times in advance.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        # Earliest time of the next event, on the monotonic clock
+        self.next = 0
+
+    def reserve(self, now):
+        """
+        Returns:
+            float: The time of the reserved event, now or later
+        """
+        at = max(now, self.next)
+        self.next = at + self.interval
+        return at
+
+    def postpone(self, until):
+        self.next = max(self.next, until)
+
+
+def chat_rate(chat_id):
+    """
+    Returns:
+        float: The messages per second Telegram accepts in a chat
+    """
+    # Groups and channels have negative ids, public channels can also be given by @username
+    if str(chat_id).startswith(("-", "@")):
+        return GROUP_CHAT_RATE
+    return PRIVATE_CHAT_RATE
+
+
+class SendGovernor:
+    """
+    Schedules the messages of the bot under the Telegram limits, so flood control is
+    never triggered instead of being waited out after the fact.
+
+    Each chat has its own pace, and every message also takes a slot of the global pace. A
+    message first waits for its chat slot, then for the next global slot: a chat waiting
+    for its slot doesn't hold global slots the other chats could use. A chat that still
+    gets a flood control error is postponed alone.
+
+    It's meant for one event loop, the slots are reserved without locking.
+    """
+
+    def __init__(self, global_rate=GLOBAL_RATE):
+        self.pacer = _Pacer(global_rate)
+        # chat id -> pacer, least recently used first
+        self.chats = {}
+
+    def _chat(self, chat_id):
+        pacer = self.chats.pop(chat_id, None)
+        if pacer is None:
+            pacer = _Pacer(chat_rate(chat_id))
+            if len(self.chats) >= MAX_CHATS:
+                # The chat idle the longest, its pace is over by now
+                del self.chats[next(iter(self.chats))]
+        self.chats[chat_id] = pacer
+        return pacer
+
+    async def acquire(self, chat_id):
+        """
+        Wait until a message can be sent to a chat.
+
+        Args:
+            chat_id (str): The chat
+
+        Returns:
+            float: The seconds waited
+        """
+        started = time.monotonic()
+        at = self._chat(chat_id).reserve(started)
+        if at > started:
+            await asyncio.sleep(at - started)
+        now = time.monotonic()
+        at = self.pacer.reserve(now)
+        if at > now:
+            await asyncio.sleep(at - now)
+        return time.monotonic() - started
+
+    def penalize(self, chat_id, seconds):
+        """
+        Hold the messages of a chat after a flood control error.
+
+        Args:
+            chat_id (str): The chat
+            seconds (float): The delay asked by Telegram
+        """
+        self._chat(chat_id).postpone(time.monotonic() + seconds)
@@ -3,12 +3,75 @@ from telegram.ext import ContextTypes
 from telegram.error import RetryAfter
 import db
 import core
+import durable_queue
+from latency import LatencyRecorder
+from message_template import compile_template
+import metrics
+from outbox import OutboxQueue
+from telegram_bot_plugin.governor import SendGovernor
+import wire
 import asyncio
+import html
+import time
+from queue import Empty, Queue
 from logger import get_logger
 
 # Get logger for this module
 logger = get_logger(__name__)
 
+# Seconds a queue read waits before trying again, so the reading thread never outlives the bot for long
+QUEUE_TIMEOUT = 1
+# Maximum number of items taken from the queue at once
+MAX_BATCH_SIZE = 100
+# Messages waiting for a chat above which no new item is read, until the chat caught up
+CHAT_QUEUE_CAPACITY = 1000
+# Outbox sink of the messages waiting for a chat, followed by the chat id
+CHAT_SINK_PREFIX = "telegram:"
+# Characters of an item title kept in a digest, and in its button
+DIGEST_TITLE_LENGTH = 80
+DIGEST_BUTTON_LENGTH = 40
+
+# Metrics of the messages sent
+send_seconds = metrics.histogram(
+    "vinted_telegram_send_seconds", "Time to send a Telegram message"
+)
+send_retries = metrics.counter(
+    "vinted_telegram_retries_total", "Telegram messages sent again after flood control"
+)
+send_failures = metrics.counter(
+    "vinted_telegram_failures_total", "Telegram messages that couldn't be sent"
+)
+digest_items = metrics.counter(
+    "vinted_telegram_digest_items_total", "Items sent grouped in a digest message"
+)
+queue_depth = metrics.gauge(
+    "vinted_queue_depth", "Messages waiting in a queue", ("queue",)
+)
+governor_wait = metrics.histogram(
+    "vinted_telegram_governor_wait_seconds",
+    "Time a Telegram message waited for its slot under the rate limits",
+)
+
+
+def _take(message_queue, limit):
+    # The messages already queued, up to limit
+    messages = []
+    while len(messages) < limit:
+        try:
+            messages.append(message_queue.get_nowait())
+        except Empty:
+            break
+    return messages
+
+
+async def _wait(event, timeout):
+    # Wait until the event is set or the timeout expires, then reset it
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+    except TimeoutError:
+        pass
+    event.clear()
+
 
 async def hello(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
@@ -26,50 +89,124 @@ async def hello(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             logger.error(f"Error sending error message: {str(e2)}")
 
 
-class LeRobot:
-    def __init__(self, queue):
-        from telegram import Bot
-        from telegram.ext import ApplicationBuilder, CommandHandler
+def _shorten(text, length):
+    text = str(text or "")
+    return text if len(text) <= length else text[: length - 1] + "…"
 
-        try:
 
-            self.bot = Bot(db.get_parameter("telegram_token"))
-            self.app = (
-                ApplicationBuilder().token(db.get_parameter("telegram_token")).build()
-            )
+def digest_message(items):
+    """
+    Render the items of a digest: one line per item, and one button per item.
 
-            # Create the item queue to send to telegram
-            self.new_items_queue = queue
-
-            # Handler verify if bot is running
-            self.app.add_handler(CommandHandler("hello", hello))
-            # Keyword handlers
-            self.app.add_handler(CommandHandler("add_query", self.add_query))
-            self.app.add_handler(CommandHandler("remove_query", self.remove_query))
-            self.app.add_handler(CommandHandler("queries", self.queries))
-            # Allowlist handlers
-            self.app.add_handler(
-                CommandHandler("clear_allowlist", self.clear_allowlist)
-            )
-            self.app.add_handler(CommandHandler("add_country", self.add_country))
-            self.app.add_handler(CommandHandler("remove_country", self.remove_country))
-            self.app.add_handler(CommandHandler("allowlist", self.allowlist))
+    Args:
+        items (list): (fields, url) of each item, the fields from item_fields
 
-            # TODO : Help command
+    Returns:
+        tuple: (HTML content, buttons)
+    """
+    lines = [f"<b>{len(items)} new items</b>"]
+    buttons = []
+    for number, (fields, url) in enumerate(items, 1):
+        details = " · ".join(
+            html.escape(str(fields[field]))
+            for field in ("price", "brand")
+            if fields.get(field)
+        )
+        title = html.escape(_shorten(fields.get("title"), DIGEST_TITLE_LENGTH))
+        lines.append(f"{number}. {title}" + (f" · {details}" if details else ""))
+        buttons.append(
+            [
+                InlineKeyboardButton(
+                    text=f"{number}. {_shorten(fields.get('title'), DIGEST_BUTTON_LENGTH)}",
+                    url=url,
+                )
+            ]
+        )
+    return "\n".join(lines), buttons
 
-            # TODO : Manage removals after current items have been processed.
 
-            job_queue = self.app.job_queue
-            # Set the commands
-            job_queue.run_once(self.set_commands, when=1)
-            # Every day we check for a new version
-            job_queue.run_repeating(self.check_version, interval=86400, first=1)
-            # Every second we check for new posts to send to telegram
-            job_queue.run_once(self.check_telegram_queue, when=1)
+class LeRobot:
+    def __init__(self, queue):
+        from telegram.ext import ApplicationBuilder, CommandHandler
 
-            self.app.run_polling()
-        except Exception as e:
-            logger.error(f"Error initializing bot: {str(e)}", exc_info=True)
+        self.app = (
+            ApplicationBuilder().token(db.get_parameter("telegram_token")).build()
+        )
+        # The bot of the application is initialized once with it, its HTTP connections
+        # are pooled and kept alive for every message
+        self.bot = self.app.bot
+        # The settings used to send, see refresh_settings()
+        self.chat_id = None
+        # query id -> the chats routed for it, None for the chats getting every item
+        self.routes = {}
+        self.template = None
+        self.digest_window = 0
+        self.digest_size = 1
+        self.refresh_settings()
+
+        # Create the item queue to send to telegram
+        self.new_items_queue = queue
+        # With a durable queue, the messages waiting for each chat are kept in the outbox too
+        self.durable = isinstance(queue, (durable_queue.DurableQueue, OutboxQueue))
+        # Set by stop(), ends the queue job
+        self.stopping = False
+        # Times the stages of the items sent
+        self.latency = LatencyRecorder("telegram")
+        # Keeps the messages under the Telegram rate limits
+        self.governor = SendGovernor()
+        # chat id -> the queue of its messages, each sent to by its own task
+        self.chat_queues = {}
+        self.chat_tasks = {}
+        # chat id -> set when messages are queued for the chat, wakes its task up
+        self.chat_events = {}
+
+        # Handler verify if bot is running
+        self.app.add_handler(CommandHandler("hello", hello))
+        # Keyword handlers
+        self.app.add_handler(CommandHandler("add_query", self.add_query))
+        self.app.add_handler(CommandHandler("remove_query", self.remove_query))
+        self.app.add_handler(CommandHandler("queries", self.queries))
+        # Allowlist handlers
+        self.app.add_handler(CommandHandler("clear_allowlist", self.clear_allowlist))
+        self.app.add_handler(CommandHandler("add_country", self.add_country))
+        self.app.add_handler(CommandHandler("remove_country", self.remove_country))
+        self.app.add_handler(CommandHandler("allowlist", self.allowlist))
+
+        # TODO : Help command
+
+        # TODO : Manage removals after current items have been processed.
+
+        job_queue = self.app.job_queue
+        # Set the commands
+        job_queue.run_once(self.set_commands, when=1)
+        # Every day we check for a new version
+        job_queue.run_repeating(self.check_version, interval=86400, first=1)
+        # Send the new posts to telegram
+        job_queue.run_once(self.check_telegram_queue, when=1)
+
+    def run(self):
+        """
+        Run the bot in its own event loop until the process is stopped.
+        """
+        self.app.run_polling()
+
+    async def start(self):
+        """
+        Start the bot in the running event loop, for bots sharing their loop with other tasks.
+        """
+        self.stopping = False
+        await self.app.initialize()
+        await self.app.start()
+        await self.app.updater.start_polling()
+
+    async def stop(self):
+        """
+        Stop a bot started with start().
+        """
+        self.stopping = True
+        await self.app.updater.stop()
+        await self.app.stop()
+        await self.app.shutdown()
 
     ### QUERIES ###
 
@@ -250,13 +387,68 @@ class LeRobot:
 
     ### TELEGRAM SPECIFIC FUNCTIONS ###
 
-    async def send_new_post(self, content, url, text, buy_url=None, buy_text=None):
-        try:
-            async with self.bot:
-                chat_ID = str(db.get_parameter("telegram_chat_id"))
-                buttons = [[InlineKeyboardButton(text=text, url=url)]]
-                if buy_url and buy_text:
-                    buttons.append([InlineKeyboardButton(text=buy_text, url=buy_url)])
+    def refresh_settings(self):
+        """
+        Read the sending settings, once per batch of items instead of once per message.
+        """
+        parameters = db.get_all_parameters()
+        self.chat_id = parameters.get("telegram_chat_id") or ""
+        self.routes = {}
+        for _, query_id, chat_id in db.get_telegram_routes():
+            self.routes.setdefault(query_id, []).append(chat_id)
+        self.template = compile_template(parameters.get("message_template"))
+        self.digest_window = int(parameters.get("telegram_digest_window") or 0)
+        self.digest_size = (
+            int(parameters.get("telegram_digest_max_items") or 1)
+            if self.digest_window
+            else 1
+        )
+
+    def destinations(self, query_id):
+        """
+        Returns:
+            list: The chats the items of a query are sent to
+        """
+        chats = (self.routes.get(query_id) if query_id is not None else None) or [
+            self.chat_id
+        ]
+        # Without duplicates, and without the configured chat if it's not set
+        return [
+            chat for chat in dict.fromkeys(chats + self.routes.get(None, [])) if chat
+        ]
+
+    async def send_new_post(
+        self, content, url, text, buy_url=None, buy_text=None, chat_id=None
+    ):
+        """
+        Args:
+            chat_id (str, optional): The chat, the configured one by default
+
+        Returns:
+            bool: True if the message was sent
+        """
+        buttons = [[InlineKeyboardButton(text=text, url=url)]]
+        if buy_url and buy_text:
+            buttons.append([InlineKeyboardButton(text=buy_text, url=buy_url)])
+        return await self.send(chat_id or self.chat_id, content, buttons)
+
+    async def send(self, chat_ID, content, buttons):
+        """
+        Send a message when the rate limits allow it, and again if flood control still
+        rejects it.
+
+        Args:
+            chat_ID (str): The chat
+            content (str): The message, in Telegram HTML
+            buttons (list): The rows of inline buttons
+
+        Returns:
+            bool: True if the message was sent
+        """
+        while True:
+            governor_wait.observe(await self.governor.acquire(chat_ID))
+            started = time.monotonic()
+            try:
                 await self.bot.send_message(
                     chat_ID,
                     content,
@@ -265,16 +457,20 @@ class LeRobot:
                     write_timeout=40,
                     reply_markup=InlineKeyboardMarkup(buttons),
                 )
-        except RetryAfter as e:
-            retry_after = e.retry_after
-            logger.error(
-                f"Flood control exceeded. Retrying in {retry_after + 2} seconds"
-            )
-            await asyncio.sleep(retry_after + 2)
-            # Retry sending the message
-            await self.send_new_post(content, url, text, buy_url, buy_text)
-        except Exception as e:
-            logger.error(f"Error sending new post: {str(e)}", exc_info=True)
+                send_seconds.observe(time.monotonic() - started)
+                return True
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                logger.error(
+                    f"Flood control exceeded for chat {chat_ID}. Retrying in {retry_after + 2} seconds"
+                )
+                send_retries.inc()
+                # Only this chat waits, the others keep their pace
+                self.governor.penalize(chat_ID, retry_after + 2)
+            except Exception as e:
+                logger.error(f"Error sending new post: {str(e)}", exc_info=True)
+                send_failures.inc()
+                return False
 
     async def check_version(self, context: ContextTypes.DEFAULT_TYPE):
         try:
@@ -291,16 +487,215 @@ class LeRobot:
             logger.error(f"Error checking for new version: {str(e)}", exc_info=True)
 
     async def check_telegram_queue(self, context: ContextTypes.DEFAULT_TYPE):
+        loop = asyncio.get_running_loop()
         try:
-            while 1:
-                if not self.new_items_queue.empty():
-                    content, url, text, buy_url, buy_text = self.new_items_queue.get()
-                    await self.send_new_post(content, url, text, buy_url, buy_text)
-                else:
-                    await asyncio.sleep(0.1)
-                    pass
-        except Exception as e:
-            logger.error(f"Error checking telegram queue: {str(e)}", exc_info=True)
+            # The chats with messages a previous run didn't send
+            for chat_id in self.chat_backlogs():
+                self.chat_queue(chat_id)
+            while not self.stopping:
+                if any(
+                    waiting >= CHAT_QUEUE_CAPACITY
+                    for waiting in self.chat_backlogs().values()
+                ):
+                    # A chat can't keep up: the new items wait upstream, in the dispatcher
+                    # buffer or the outbox, instead of being dropped here
+                    await asyncio.sleep(QUEUE_TIMEOUT)
+                    continue
+                # The blocking get runs in a thread, so the event loop keeps serving commands while we wait
+                try:
+                    messages = [
+                        await loop.run_in_executor(
+                            None, self.new_items_queue.get, True, QUEUE_TIMEOUT
+                        )
+                    ]
+                except Empty:
+                    continue
+                # Take everything already queued
+                while len(messages) < MAX_BATCH_SIZE:
+                    try:
+                        messages.append(self.new_items_queue.get_nowait())
+                    except Empty:
+                        break
+
+                self.refresh_settings()
+                self.route(messages)
+        except Exception:
+            logger.exception("Error checking telegram queue")
+
+    def route(self, messages):
+        """
+        Queue notifications read from the queue of the bot for their chats, then acknowledge
+        them.
+
+        With a durable queue, they are written to the outbox of each chat before the
+        acknowledgement, so a notification is never only in memory.
+
+        Args:
+            messages (list): The notifications, made by wire.encode_notification
+        """
+        # (chat id, item url, message)
+        routed = []
+        for message in messages:
+            notification = wire.decode_notification(message)
+            query_id = notification[5][0] if len(notification) > 5 else None
+            for chat_id in self.destinations(query_id):
+                routed.append((chat_id, notification[1], message))
+
+        if self.durable:
+            if not db.add_to_outbox(
+                (CHAT_SINK_PREFIX + chat_id, url, message)
+                for chat_id, url, message in routed
+            ):
+                logger.error("Couldn't queue the notifications for their chats")
+                # The outbox sends them again later, a durable queue replays them on restart
+                for message in messages:
+                    durable_queue.retry(self.new_items_queue, message)
+                return
+        else:
+            for chat_id, _, message in routed:
+                self.chat_queue(chat_id).put_nowait(message)
+        durable_queue.ack(self.new_items_queue)
+
+        for chat_id in dict.fromkeys(chat_id for chat_id, _, _ in routed):
+            self.chat_queue(chat_id)
+            self.chat_events[chat_id].set()
+
+    def chat_queue(self, chat_id):
+        """
+        Get the queue of the messages waiting for a chat, starting the task sending them the
+        first time.
+
+        Returns:
+            Queue: An OutboxQueue with a durable queue, an in-memory queue otherwise
+        """
+        chat_queue = self.chat_queues.get(chat_id)
+        if chat_queue is None:
+            if self.durable:
+                chat_queue = OutboxQueue(CHAT_SINK_PREFIX + chat_id)
+            else:
+                chat_queue = Queue()
+            self.chat_queues[chat_id] = chat_queue
+            self.chat_events[chat_id] = asyncio.Event()
+            self.chat_tasks[chat_id] = asyncio.create_task(
+                self.send_chat_queue(chat_id, chat_queue)
+            )
+        return chat_queue
+
+    def chat_backlogs(self):
+        """
+        Returns:
+            dict: chat id -> number of messages waiting for it
+        """
+        if self.durable:
+            backlogs = {
+                sink[len(CHAT_SINK_PREFIX) :]: waiting
+                for sink, waiting in db.count_outbox_entries(CHAT_SINK_PREFIX).items()
+            }
+        else:
+            backlogs = {
+                chat_id: chat_queue.qsize()
+                for chat_id, chat_queue in self.chat_queues.items()
+            }
+        for chat_id in self.chat_queues:
+            queue_depth.set(backlogs.get(chat_id, 0), queue=f"telegram_{chat_id}")
+        return backlogs
+
+    async def send_chat_queue(self, chat_id, chat_queue):
+        """
+        Send the messages queued for a chat until the bot stops.
+
+        Each chat has its own task, so a chat waiting for its rate limit or a digest window
+        doesn't delay the others. The messages are acknowledged once sent, the failed ones are
+        retried by the outbox.
+
+        Args:
+            chat_id (str): The chat
+            chat_queue (Queue): Its messages, see chat_queue()
+        """
+        added = self.chat_events[chat_id]
+        # Monotonic time of the last batch of items, a batch soon after it starts a digest window
+        last_batch = 0
+        while not self.stopping:
+            try:
+                messages = _take(chat_queue, MAX_BATCH_SIZE)
+                if not messages:
+                    # Also wakes up regularly, for the retried messages that are due
+                    await _wait(added, QUEUE_TIMEOUT)
+                    continue
+
+                window = self.digest_window
+                if window and (
+                    len(messages) > 1 or time.monotonic() - last_batch < window
+                ):
+                    # A burst: the items arriving during the window are sent as digests
+                    deadline = time.monotonic() + window
+                    while len(messages) < MAX_BATCH_SIZE:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        await _wait(added, remaining)
+                        messages += _take(chat_queue, MAX_BATCH_SIZE - len(messages))
+                last_batch = time.monotonic()
+
+                await self.send_to_chat(
+                    chat_id, messages, self.template, self.digest_size
+                )
+                durable_queue.ack(chat_queue)
+            except Exception:
+                logger.exception(f"Error sending to chat {chat_id}")
+
+    async def send_to_chat(self, chat_id, messages, template, digest_size=1):
+        """
+        Send queued notifications to a chat, one after the other.
+
+        The items of a query are grouped in digests of up to digest_size items, an item
+        alone is sent as a normal message.
+
+        Args:
+            chat_id (str): The chat
+            messages (list): The notifications, made by wire.encode_notification
+            template (CompiledTemplate): Renders the item fields
+            digest_size (int, optional): The maximum number of items per message
+        """
+        items = [(message, wire.decode_notification(message)) for message in messages]
+        if digest_size > 1:
+            # query id -> its items, in order
+            queries = {}
+            for item in items:
+                query_id = item[1][5][0] if len(item[1]) > 5 else None
+                queries.setdefault(query_id, []).append(item)
+            groups = [
+                query_items[start : start + digest_size]
+                for query_items in queries.values()
+                for start in range(0, len(query_items), digest_size)
+            ]
+        else:
+            # In the order of the dispatcher
+            groups = [[item] for item in items]
+
+        for group in groups:
+            if len(group) == 1:
+                fields, url, text, buy_url, buy_text, *_ = group[0][1]
+                sent = await self.send_new_post(
+                    template.html(fields), url, text, buy_url, buy_text, chat_id
+                )
+            else:
+                sent = await self.send(
+                    chat_id,
+                    *digest_message(
+                        [
+                            (notification[0], notification[1])
+                            for _, notification in group
+                        ]
+                    ),
+                )
+                if sent:
+                    digest_items.inc(len(group))
+            for message, notification in group:
+                if not sent:
+                    durable_queue.retry(self.chat_queues.get(chat_id), message)
+                elif len(notification) > 5:
+                    self.latency.observe(notification[5])
 
     async def set_commands(self, context: ContextTypes.DEFAULT_TYPE):
         try:
@@ -0,0 +1,54 @@
+import os
+import sys
+
+import pytest
+
+DESKTOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The modules are imported the way the app runs them, from the desktop folder
+sys.path.insert(0, DESKTOP)
+
+import db
+from pyVintedVN.items.item import Item
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """
+    A new database, migrated to the current version like at startup.
+    """
+    monkeypatch.chdir(DESKTOP)
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "vinted_notifications.db"))
+    db.create_or_update_sqlite_db("initial_db.sql")
+    migration_files = os.listdir("migrations")
+    while True:
+        version = db.get_parameter("version")
+        migration_file = next(
+            (f for f in migration_files if f.startswith(version + "_")), None
+        )
+        if migration_file is None:
+            break
+        db.create_or_update_sqlite_db("./migrations/" + migration_file)
+
+
+@pytest.fixture
+def make_item():
+    """
+    Build an item the way the scraper gets it from the Vinted API.
+    """
+
+    def make(item_id, title, photo, timestamp):
+        return Item(
+            {
+                "id": item_id,
+                "title": title,
+                "brand_title": "Nike",
+                "size_title": "M",
+                "price": {"amount": str(10 * item_id), "currency_code": "EUR"},
+                "photo": {"url": photo, "high_resolution": {"timestamp": timestamp}},
+                "url": f"https://www.vinted.fr/items/{item_id}",
+                "user": {"id": item_id, "login": f"seller{item_id}"},
+            }
+        )
+
+    return make
@@ -0,0 +1,38 @@
+import queue
+import time
+
+import core
+import db
+import durable_queue
+import wire
+from durable_queue import DurableQueue
+
+
+def test_batch_is_read_again_when_its_commit_fails(
+    database, make_item, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(durable_queue, "QUEUES_DB", str(tmp_path / "queues.db"))
+    monkeypatch.setattr(core, "STORE_RETRY_DELAY", 0)
+    db.add_query_to_db("https://www.vinted.fr/catalog?search_text=nike")
+    query_id = db.get_queries()[0][0]
+
+    items_queue = DurableQueue("items")
+    item = make_item(1, "Nike hoodie", "https://images/1.jpg", int(time.time()))
+    items_queue.put(wire.encode_items([item], query_id))
+    new_items_queue = queue.Queue()
+
+    run_write_operations = db.run_write_operations
+    # The commit fails, as on a full disk
+    monkeypatch.setattr(
+        db, "run_write_operations", lambda operations: [False] * len(operations)
+    )
+    core.clear_item_queue(items_queue, new_items_queue)
+    assert items_queue.qsize() == 1
+    assert db.is_item_in_db_by_id(1) is False
+
+    monkeypatch.setattr(db, "run_write_operations", run_write_operations)
+    new_items_queue = queue.Queue()
+    core.clear_item_queue(items_queue, new_items_queue)
+    assert items_queue.qsize() == 0
+    assert db.is_item_in_db_by_id(1) is True
+    assert new_items_queue.qsize() == 1
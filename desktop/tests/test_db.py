@@ -0,0 +1,28 @@
+import time
+
+import db
+
+
+def timings(operation):
+    histogram = db._operation_seconds.values.get((operation,))
+    return (histogram.count, histogram.total) if histogram else (0, 0)
+
+
+def test_reads_are_timed(database):
+    count, _ = timings("get_queries")
+    db.get_queries()
+    assert timings("get_queries")[0] == count + 1
+
+
+def test_generator_is_timed_without_its_caller(database):
+    db.add_query_to_db("https://www.vinted.fr/catalog?search_text=nike")
+    query_id = db.get_queries()[0][0]
+    for item_id in range(3):
+        db.add_item_to_db(item_id, f"Item {item_id}", query_id, 10, item_id, None)
+
+    count, total = timings("iter_items")
+    for _ in db.iter_items(limit=2):
+        # The caller handles each row slowly
+        time.sleep(0.2)
+    assert timings("iter_items")[0] == count + 1
+    assert timings("iter_items")[1] - total < 0.2
@@ -0,0 +1,42 @@
+import queue
+import time
+
+import dispatcher
+import wire
+from dispatcher import Dispatcher, Sink
+from priorities import NORMAL
+
+
+def make_message(number):
+    notification = wire.encode_notification(
+        ({"title": f"Item {number}"}, f"https://www.vinted.fr/items/{number}", "Open")
+    )
+    return wire.encode_dispatch(notification, time.time(), NORMAL, 0)
+
+
+def test_a_pass_is_capped_for_each_sink(monkeypatch):
+    # Sinks whose consumer takes everything at once
+    monkeypatch.setattr(dispatcher, "IN_FLIGHT", 10_000)
+    monkeypatch.setattr(dispatcher, "STATS_INTERVAL", 3600)
+    monkeypatch.setattr(dispatcher.stats, "publish", lambda *args: None)
+    sinks = [Sink("busy", local=True), Sink("other", local=True)]
+    for sink in sinks:
+        sink.active.set()
+    input_queue = queue.Queue()
+    for number in range(dispatcher.MAX_READ + 50):
+        input_queue.put(make_message(number))
+    items_dispatcher = Dispatcher(input_queue, sinks)
+
+    items_dispatcher.run_once(max_wait=0)
+    assert input_queue.qsize() == 50
+    # The second sink got its share in the same pass
+    assert [sink.queue.qsize() for sink in sinks] == [dispatcher.FLUSH_BATCH] * 2
+    assert items_dispatcher.behind
+
+    # The next passes don't wait for new items while some are left
+    start = time.monotonic()
+    while items_dispatcher.behind:
+        items_dispatcher.run_once(max_wait=5)
+    assert time.monotonic() - start < 1
+    assert input_queue.qsize() == 0
+    assert [sink.queue.qsize() for sink in sinks] == [dispatcher.MAX_READ + 50] * 2
@@ -0,0 +1,35 @@
+import asyncio
+
+import pytest
+
+from telegram_bot_plugin import governor
+from telegram_bot_plugin.governor import SendGovernor, chat_rate
+
+
+@pytest.mark.parametrize(
+    "chat_id, rate",
+    [
+        ("123456789", governor.PRIVATE_CHAT_RATE),
+        (123456789, governor.PRIVATE_CHAT_RATE),
+        ("-1001234567890", governor.GROUP_CHAT_RATE),
+        (-42, governor.GROUP_CHAT_RATE),
+        ("@my_channel", governor.GROUP_CHAT_RATE),
+    ],
+)
+def test_chat_rate(chat_id, rate):
+    assert chat_rate(chat_id) == rate
+
+
+def test_channel_username_is_paced_as_a_channel(monkeypatch):
+    # Faster paces, the test doesn't wait for the real ones
+    monkeypatch.setattr(governor, "GROUP_CHAT_RATE", 10)
+    monkeypatch.setattr(governor, "PRIVATE_CHAT_RATE", 1)
+
+    async def waits():
+        send_governor = SendGovernor(global_rate=1000)
+        return [await send_governor.acquire("@my_channel") for _ in range(2)]
+
+    first, second = asyncio.run(waits())
+    assert first < 0.1
+    # The second message waits for the channel slot, not the private chat one
+    assert second == pytest.approx(1 / governor.GROUP_CHAT_RATE, abs=0.05)
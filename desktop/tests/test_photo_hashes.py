@@ -0,0 +1,52 @@
+import queue
+import time
+
+import core
+import db
+import photo_hashes
+import wire
+from photo_hashes import PhotoMatcher
+
+# The same photo, uploaded again with another listing
+PHOTO_HASHES = {
+    "https://images/first.jpg": 0x0123456789ABCDEF,
+    "https://images/again.jpg": 0x0123456789ABCDEF,
+}
+
+
+def test_slow_filters_dont_use_the_photo_budget(database, make_item, monkeypatch):
+    db.set_parameter("photo_dedup_enabled", "True")
+    db.set_parameter("photo_dedup_budget_ms", "500")
+    db.add_query_to_db("https://www.vinted.fr/catalog?search_text=nike")
+    query_id = db.get_queries()[0][0]
+
+    def download_hash(self, url):
+        time.sleep(0.05)
+        return PHOTO_HASHES[url]
+
+    # No download and no Pillow needed, the hashes are known
+    monkeypatch.setattr(photo_hashes, "Image", object())
+    monkeypatch.setattr(PhotoMatcher, "_download_hash", download_hash)
+    monkeypatch.setattr(core, "photo_matcher", PhotoMatcher())
+
+    new_items = core._new_items
+
+    def slow_new_items(*args):
+        # Like country lookups on a slow network, longer than the photo budget
+        time.sleep(0.7)
+        return new_items(*args)
+
+    monkeypatch.setattr(core, "_new_items", slow_new_items)
+
+    now = int(time.time())
+    items = [
+        make_item(2, "Air max trainers", "https://images/again.jpg", now + 1),
+        make_item(1, "Nike hoodie", "https://images/first.jpg", now),
+    ]
+    items_queue = queue.Queue()
+    items_queue.put(wire.encode_items(items, query_id))
+    new_items_queue = queue.Queue()
+    core.clear_item_queue(items_queue, new_items_queue)
+
+    # The second listing has the photo of the first one
+    assert new_items_queue.qsize() == 1
@@ -1,7 +1,10 @@
 import multiprocessing
-import time
 import os
+import sys
+from datetime import datetime
 import db
+import metrics
+import profiling
 from apscheduler.schedulers.background import BackgroundScheduler
 from logger import get_logger
 
@@ -18,19 +21,41 @@ if not os.path.exists("./data/vinted_notifications.db"):
     logger.info("Database created successfully")
 
 import core
+import db_writer
+from dispatcher import Sink, SPILL_TO_DISK, dispatcher_function
+from durable_queue import DurableQueue
+from outbox import Outbox, OutboxQueue
+from seen_items import SeenItems
+import supervisor as supervisor_module
+from supervisor import Child, Supervisor
 from rss_feed_plugin.rss_feed import rss_feed_process
 from web_ui_plugin.web_ui import web_ui_process
 
+# Global references
+supervisor = None
+# Commands for the scrape process, see scraper_process
+scraper_control = None
+# Database writer, None when every process writes directly
+database_writer = None
 
-# Global process references
-telegram_process = None
-rss_process = None
-scrape_process = None
-current_query_refresh_delay = None
 
+def scraper_process(items_queue, control_queue, writer=None):
+    """
+    Scrape the queries at the refresh delay, and apply the commands of the main process.
 
-def scraper_process(items_queue):
+    The queries, the number of items per query and the proxies are read from the database at
+    every run. The refresh delay is changed in the running scheduler, so the process keeps its
+    session, cookies and proxy cache.
+
+    Args:
+        items_queue (Queue): The queue to put the scraped items in
+        control_queue (Queue): The commands, "reload_config" or "queries_changed"
+        writer (DatabaseWriter, optional): The database writer
+    """
     logger.info("Scrape process started")
+    db_writer.attach(writer, "scraper")
+    metrics.start("scraper")
+    profiling.start("scraper")
 
     # Get the query refresh delay from the database
     current_query_refresh_delay = int(db.get_parameter("query_refresh_delay"))
@@ -42,146 +67,108 @@ def scraper_process(items_queue):
         "interval",
         seconds=current_query_refresh_delay,
         args=[items_queue],
+        id="scraper",
         name="scraper",
     )
     scraper_scheduler.start()
     try:
-        # Keep the process running
+        # Wait for commands until the process is stopped
         while True:
-            time.sleep(1)
+            command = control_queue.get()
+            if command == "reload_config":
+                new_delay = int(db.get_parameter("query_refresh_delay"))
+                if new_delay != current_query_refresh_delay:
+                    logger.info(
+                        f"Query refresh delay changed from {current_query_refresh_delay} to {new_delay} seconds"
+                    )
+                    current_query_refresh_delay = new_delay
+                    scraper_scheduler.reschedule_job(
+                        "scraper", trigger="interval", seconds=new_delay
+                    )
+            elif command == "queries_changed":
+                # Scrape the new queries now instead of at the next run
+                scraper_scheduler.modify_job("scraper", next_run_time=datetime.now())
     except (KeyboardInterrupt, SystemExit):
         scraper_scheduler.shutdown()
         logger.info("Scrape process stopped")
 
 
-def item_extractor(items_queue, new_items_queue):
+def item_extractor(items_queue, new_items_queue, writer=None):
     logger.info("Item extractor process started")
+    db_writer.attach(writer, "extractor")
+    metrics.start("extractor")
+    profiling.start("extractor")
+    # Ids of the stored items, so duplicates are mostly rejected without a db lookup
+    seen_items = SeenItems.from_db()
     try:
         while True:
-            # Check if there's an item in the queue
-            core.clear_item_queue(items_queue, new_items_queue)
-            time.sleep(0.1)  # Small sleep to prevent high CPU usage
+            # Wait for scraped items, the process sleeps until some are queued
+            core.clear_item_queue(items_queue, new_items_queue, seen_items, timeout=1)
     except (KeyboardInterrupt, SystemExit):
         logger.info("Consumer process stopped")
 
 
-def dispatcher_function(input_queue, rss_queue, telegram_queue):
-    logger.info("Dispatcher process started")
-    try:
-        while True:
-            # Get from input queue
-            item = input_queue.get()
-            # Send to RSS queue
-            rss_queue.put(item)
-            #
-            telegram_queue.put(item)
-    except (KeyboardInterrupt, SystemExit):
-        logger.info("Dispatcher process stopped")
-    except Exception as e:
-        logger.error(f"Error in dispatcher process: {e}", exc_info=True)
-
-
-def telegram_bot_process(queue):
+def telegram_bot_process(queue, writer=None, channel=None):
     logger.info("Telegram bot process started")
-    import asyncio
+    db_writer.attach(writer, "telegram")
+    metrics.start("telegram")
+    profiling.start("telegram")
+    supervisor_module.attach(channel)
 
     try:
         # Import LeRobot
         from telegram_bot_plugin.telegram_bot import LeRobot
 
-        # The bot will run with app.run_polling() which is already in the module
-        asyncio.run(LeRobot(queue))
+        # The bot runs with app.run_polling() until the process is stopped
+        LeRobot(queue).run()
     except (KeyboardInterrupt, SystemExit):
         logger.info("Telegram bot process stopped")
     except Exception as e:
         logger.error(f"Error in telegram bot process: {e}", exc_info=True)
 
 
-def check_refresh_delay(items_queue):
-    """Check if the query refresh delay has changed and update the scheduler if needed"""
-    global scrape_process, current_query_refresh_delay
+def forward_to_scraper(command):
+    """
+    Make a command handler passing the command on to the scrape process.
 
-    # Check if the scheduler is running
+    Args:
+        command (str): The command, "reload_config" after the configuration was saved,
+            "queries_changed" after a query was added
 
-    if scrape_process is None or not scrape_process.is_alive():
-        return
+    Returns:
+        callable: The command handler
+    """
 
-    # Get the current value from the database
-    try:
-        new_delay = int(db.get_parameter("query_refresh_delay"))
+    def forward():
+        # Applied by the running scraper, without restarting it
+        scraper_control.put(command)
+        return {"status": "ok"}
 
-        # If the delay has changed, update the scheduler
-        if new_delay != current_query_refresh_delay:
-            logger.info(
-                f"Query refresh delay changed from {current_query_refresh_delay} to {new_delay} seconds"
-            )
+    return forward
 
-            # Update the global variable
-            current_query_refresh_delay = new_delay
-
-            # Remove the existing job and add a new one with the updated interval
-            scrape_process.terminate()
-            scrape_process.join()
-            scrape_process = multiprocessing.Process(
-                target=scraper_process, args=(items_queue,)
-            )
-            scrape_process.start()
 
-            logger.info(
-                f"Scheduler updated with new refresh delay of {new_delay} seconds"
-            )
-    except Exception as e:
-        logger.error(f"Error updating refresh delay: {e}", exc_info=True)
-
-
-def monitor_processes(items_queue, telegram_queue, rss_queue):
-    global telegram_process, rss_process
-
-    # Check if the query refresh delay has changed
-    check_refresh_delay(items_queue)
-
-    ### TELEGRAM ###
-    # Check telegram process status
-    telegram_should_run = db.get_parameter("telegram_process_running") == "True"
+def telegram_can_start():
     # Check if the telegram token and chat ID are set
-    telegram_token = db.get_parameter("telegram_token")
-    telegram_chat_id = db.get_parameter("telegram_chat_id")
-    if not telegram_token or not telegram_chat_id:
-        telegram_should_run = False
-    telegram_is_running = telegram_process is not None and telegram_process.is_alive()
-
-    if telegram_should_run and not telegram_is_running:
-        # Start telegram process
-        logger.info("Starting telegram bot process.")
-        telegram_process = multiprocessing.Process(
-            target=telegram_bot_process, args=(telegram_queue,)
-        )
-        telegram_process.start()
-    elif not telegram_should_run and telegram_is_running:
-        # Stop telegram process
-        logger.info("Stopping telegram bot process.")
-        telegram_process.terminate()
-        telegram_process.join()
-        telegram_process = None
-
-    ### RSS ###
-    # Check RSS process status
-    rss_should_run = db.get_parameter("rss_process_running") == "True"
-    rss_is_running = rss_process is not None and rss_process.is_alive()
-
-    if rss_should_run and not rss_is_running:
-        # Start RSS process
-        logger.info("Starting RSS process based on database status")
-        rss_process = multiprocessing.Process(
-            target=rss_feed_process, args=(rss_queue,)
-        )
-        rss_process.start()
-    elif not rss_should_run and rss_is_running:
-        # Stop RSS process
-        logger.info("Stopping RSS process based on database status")
-        rss_process.terminate()
-        rss_process.join()
-        rss_process = None
+    if not db.get_parameter("telegram_token") or not db.get_parameter(
+        "telegram_chat_id"
+    ):
+        return "Telegram token and chat ID are not set"
+    return None
+
+
+def sink_switch(sink):
+    # The sink only gets new items while its process should run
+    def switch(should_run):
+        if should_run:
+            sink.active.set()
+        else:
+            sink.active.clear()
+            if isinstance(sink.queue, (OutboxQueue, DurableQueue)):
+                # What the sink didn't send is discarded, like the dispatcher does. With a
+                # durable queue, the outbox only has what the sink took, for its destinations.
+                db.clear_outbox(sink.name)
+
+    return switch
 
 
 def plugin_checker():
@@ -202,10 +189,12 @@ if __name__ == "__main__":
     current_version = db.get_parameter("version")
     # Check if there is a file that starts with the current version in the migrations folder. We keep comparing until
     # we find no migration files that start with the current version.
+    # The underscore is part of the prefix, so "1.0.5" doesn't match "1.0.5.1_1.0.5.2.sql".
     migration_files = [f for f in os.listdir("migrations")]
     while True:
         migration_file = next(
-            (f for f in migration_files if f.startswith(current_version)), None
+            (f for f in migration_files if f.startswith(current_version + "_")),
+            None,
         )
         if migration_file:
             logger.info(f"Running migration: {migration_file}")
@@ -218,103 +207,134 @@ if __name__ == "__main__":
     # Plugin checker
     plugin_checker()
 
-    # Create a shared queue
-    items_queue = multiprocessing.Queue()
-    new_items_queue = multiprocessing.Queue()
-    rss_queue = multiprocessing.Queue()
-    telegram_queue = multiprocessing.Queue()
+    # Lite mode: every component runs in this process
+    if "--lite" in sys.argv:
+        import lite_runtime
 
-    # 1. Create and start the scrape process
+        lite_runtime.run()
+        sys.exit(0)
+
+    # The supervisor starts the processes, restarts them if they crash and takes the commands of the web UI
+    supervisor = Supervisor()
+    scraper_control = multiprocessing.Queue()
+    supervisor.handle("reload_config", forward_to_scraper("reload_config"))
+    supervisor.handle("queries_changed", forward_to_scraper("queries_changed"))
+
+    # Start the database writer if enabled. From now on, every process sends its writes to it.
+    if db.get_parameter("db_writer_enabled") == "True":
+        database_writer = db_writer.DatabaseWriter(
+            ["main", "scraper", "extractor", "web_ui", "telegram", "rss"]
+        )
+        supervisor.add(
+            Child("db_writer", db_writer.db_writer_process, (database_writer,))
+        )
+        db_writer.attach(database_writer, "main")
+        logger.info("Database writer enabled")
+
+    # Create the shared queues, on disk if enabled so a crash doesn't lose the items in transit
+    durable = db.get_parameter("durable_queues") == "True"
+    use_outbox = db.get_parameter("outbox_enabled") == "True"
+    if durable:
+        items_queue = DurableQueue("items")
+        logger.info("Durable queues enabled")
+    else:
+        items_queue = multiprocessing.Queue()
+    # The destinations of the new items. Missed notifications are kept on disk, the feed only shows the last ones anyway.
+    sinks = {
+        "telegram": Sink(
+            "telegram", overflow=SPILL_TO_DISK, durable=durable, outbox=use_outbox
+        ),
+        "rss": Sink("rss", durable=durable, outbox=use_outbox),
+    }
+    if use_outbox:
+        # The extractor writes the notifications with the items, the sinks read them from the database
+        new_items_queue = Outbox(list(sinks.values()))
+        logger.info("Outbox enabled")
+    elif durable:
+        new_items_queue = DurableQueue("new_items")
+    else:
+        new_items_queue = multiprocessing.Queue()
+
+    # 1. The scrape process
     # This process will scrape items and put them in the items_queue
-    current_query_refresh_delay = int(db.get_parameter("query_refresh_delay"))
-    scrape_process = multiprocessing.Process(
-        target=scraper_process, args=(items_queue,)
+    supervisor.add(
+        Child(
+            "scraper",
+            scraper_process,
+            (items_queue, scraper_control, database_writer),
+        )
     )
-    scrape_process.start()
 
-    # 2. Create the item extractor process
+    # 2. The item extractor process
     # This process will extract items from the items_queue and put them in the new_items_queue
-    item_extractor_process = multiprocessing.Process(
-        target=item_extractor, args=(items_queue, new_items_queue)
+    supervisor.add(
+        Child(
+            "extractor",
+            item_extractor,
+            (items_queue, new_items_queue, database_writer),
+        )
     )
-    item_extractor_process.start()
-
-    # 3. Create the dispatcher process
-    # This process will handle the new items and send them to the enabled services
-    dispatcher_process = multiprocessing.Process(
-        target=dispatcher_function,
-        args=(
-            new_items_queue,
-            rss_queue,
-            telegram_queue,
-        ),
+
+    # 3. The dispatcher process
+    # This process will handle the new items and send them to the running services
+    if not use_outbox:
+        supervisor.add(
+            Child(
+                "dispatcher",
+                dispatcher_function,
+                (new_items_queue, list(sinks.values())),
+            )
+        )
+
+    # 4. The Web UI process
+    # This process will provide a web interface to control the application
+    supervisor.add(
+        Child("web_ui", web_ui_process, (database_writer, supervisor.channel))
     )
-    dispatcher_process.start()
 
-    # 4. Set up a scheduler to monitor processes
-    # This will check the process status in the database and start/stop processes as needed
-    monitor_scheduler = BackgroundScheduler()
-    monitor_scheduler.add_job(
-        monitor_processes,
-        "interval",
-        seconds=5,
-        args=[items_queue, telegram_queue, rss_queue],
-        name="process_monitor",
+    # 5. The plugins, started and stopped from the web UI
+    supervisor.add(
+        Child(
+            "telegram",
+            telegram_bot_process,
+            (sinks["telegram"].queue, database_writer, supervisor.channel),
+            should_run=db.get_parameter("telegram_process_running") == "True",
+            can_start=telegram_can_start,
+            on_change=sink_switch(sinks["telegram"]),
+        )
+    )
+    supervisor.add(
+        Child(
+            "rss",
+            rss_feed_process,
+            (sinks["rss"].queue, database_writer),
+            should_run=db.get_parameter("rss_process_running") == "True",
+            on_change=sink_switch(sinks["rss"]),
+        )
     )
-    monitor_scheduler.start()
 
-    # 5. Create and start the Web UI process
-    # This process will provide a web interface to control the application
-    web_ui_process_instance = multiprocessing.Process(target=web_ui_process)
-    web_ui_process_instance.start()
+    # Notifications left for a plugin that won't run are discarded
+    for name, sink in sinks.items():
+        if not supervisor.children[name].should_run:
+            sink_switch(sink)(False)
+
+    supervisor.start_all()
+    metrics.start("main")
+    profiling.start("main")
 
     try:
-        # Wait for processes to finish (which they won't unless interrupted)
-        scrape_process.join()
-        item_extractor_process.join()
-        dispatcher_process.join()
-        web_ui_process_instance.join()
-
-        # plugins
-        if telegram_process:
-            telegram_process.join()
-        if rss_process:
-            rss_process.join()
+        # Supervise the processes until interrupted
+        supervisor.run()
     except KeyboardInterrupt:
         # Handle Ctrl+C gracefully
         logger.info("Main process interrupted")
 
-        # Shutdown the monitor scheduler
-        monitor_scheduler.shutdown()
-
-        # Terminate all processes
-        scrape_process.terminate()
-        item_extractor_process.terminate()
-        dispatcher_process.terminate()
-        # Terminate web UI process
-        web_ui_process_instance.terminate()
-
-        # Plugins
-
-        if telegram_process and telegram_process.is_alive():
-            telegram_process.terminate()
-            # Set the process status in the database
-            db.set_parameter("telegram_process_running", "False")
-        if rss_process and rss_process.is_alive():
-            rss_process.terminate()
-            # Set the process status in the database
-            db.set_parameter("rss_process_running", "False")
-
-        # Wait for all processes to terminate
-        scrape_process.join()
-        item_extractor_process.join()
-        dispatcher_process.join()
-        web_ui_process_instance.join()
-
-        # Plugins
-        if telegram_process:
-            telegram_process.join()
-        if rss_process:
-            rss_process.join()
+        # Set the plugin statuses in the database, before the writer is stopped
+        for name in ["telegram", "rss"]:
+            if supervisor.children[name].running:
+                db.set_parameter(f"{name}_process_running", "False")
+
+        # Terminate all processes, the writer goes last
+        supervisor.stop_all()
 
         logger.info("All processes terminated")
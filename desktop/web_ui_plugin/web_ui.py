@@ -1,5 +1,23 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+from flask import (
+    Flask,
+    render_template,
+    request,
+    redirect,
+    url_for,
+    flash,
+    jsonify,
+    abort,
+    send_from_directory,
+)
 import db
+import db_writer
+import latency
+import metrics
+import profiling
+import priorities
+import stats
+import supervisor
+from dispatcher import STATS_INTERVAL
 import core
 import os
 import re
@@ -98,8 +116,27 @@ def index():
     telegram_running = db.get_parameter("telegram_process_running") == "True"
     rss_running = db.get_parameter("rss_process_running") == "True"
 
+    # Get the health of each process from the supervisor
+    processes = supervisor.send_command("status") or {}
+
+    # Get the queue of each sink, published by the dispatcher
+    dispatcher_stats = stats.read("dispatcher", max_age=3 * STATS_INTERVAL)
+    sink_stats = dispatcher_stats["sinks"] if dispatcher_stats else {}
+    if db.get_parameter("outbox_enabled") == "True":
+        # Without the dispatcher, the notifications waiting are in the outbox
+        outbox_stats = db.get_outbox_stats()
+        sink_stats = {
+            name: {
+                "active": running,
+                "waiting": 0,
+                "lag": 0,
+                **outbox_stats.get(name, {}),
+            }
+            for name, running in [("telegram", telegram_running), ("rss", rss_running)]
+        }
+
     # Get statistics for the dashboard
-    stats = {
+    dashboard_stats = {
         "total_items": db.get_total_items_count(),
         "total_queries": db.get_total_queries_count(),
         "items_per_day": db.get_items_per_day(),
@@ -108,7 +145,7 @@ def index():
     # Get the last found item
     last_item = db.get_last_found_item()
     if last_item:
-        stats["last_item"] = {
+        dashboard_stats["last_item"] = {
             "title": last_item[1],
             "price": last_item[2],
             "currency": last_item[3],
@@ -117,10 +154,10 @@ def index():
             ),
             "query": last_item[5],
             "photo_url": last_item[6],
-            "url": f"{urlparse(last_item[5]).scheme}://{urlparse(last_item[5]).netloc}/items/{last_item[0]}"
+            "url": f"{urlparse(last_item[5]).scheme}://{urlparse(last_item[5]).netloc}/items/{last_item[0]}",
         }
     else:
-        stats["last_item"] = None
+        dashboard_stats["last_item"] = None
 
     return render_template(
         "index.html",
@@ -129,7 +166,9 @@ def index():
         items=formatted_items,
         telegram_running=telegram_running,
         rss_running=rss_running,
-        stats=stats,
+        sink_stats=sink_stats,
+        processes=processes,
+        stats=dashboard_stats,
     )
 
 
@@ -164,10 +203,15 @@ def queries():
                 "query": query[1],
                 "display": query_name if query_name else query[1],
                 "last_found_item": last_found_item,
+                "priority": query[4],
             }
         )
 
-    return render_template("queries.html", queries=formatted_queries)
+    return render_template(
+        "queries.html",
+        queries=formatted_queries,
+        priorities=priorities.PRIORITY_NAMES,
+    )
 
 
 @app.route("/add_query", methods=["POST"])
@@ -214,10 +258,14 @@ def remove_all_queries():
 def update_query(query_id):
     query = request.form.get("query")
     query_name = request.form.get("query_name", "").strip()
+    priority = request.form.get("priority", priorities.NORMAL, type=int)
 
     if query:
         message, success = core.process_update_query(
-            query_id, query, name=query_name if query_name != "" else None
+            query_id,
+            query,
+            name=query_name if query_name != "" else None,
+            priority=priority,
         )
         if success:
             flash("Query updated", "success")
@@ -229,56 +277,110 @@ def update_query(query_id):
     return redirect(url_for("queries"))
 
 
+# Largest page the items views will render, whatever the limit asked for
+MAX_ITEMS_PER_PAGE = 100
+
+
+def _encode_cursor(cursor):
+    # repr() keeps float ranks exact when they come back through the URL
+    return None if cursor is None else f"{cursor[0]!r}:{cursor[1]}"
+
+
+def _decode_cursor(value, first_type):
+    if not value:
+        return None
+    try:
+        first, second = value.rsplit(":", 1)
+        return first_type(first), int(second)
+    except ValueError:
+        return None
+
+
+def _get_limit(default=50):
+    try:
+        limit = int(request.args.get("limit", default))
+    except ValueError:
+        limit = default
+    return max(1, min(limit, MAX_ITEMS_PER_PAGE))
+
+
+def _get_query_display_data(queries):
+    """
+    Parse every query URL once, so formatting a page of items never parses URLs per row.
+
+    Args:
+        queries (list): Rows as returned by db.get_queries
+
+    Returns:
+        dict: Query URL -> {"display": name shown for the query, "base_url": scheme://netloc}
+    """
+    display_data = {}
+    for query in queries:
+        parsed_query = urlparse(query[1])
+        search_text = parse_qs(parsed_query.query).get("search_text", [None])[0]
+        display_data[query[1]] = {
+            "display": query[3] or search_text or query[1],
+            "base_url": f"{parsed_query.scheme}://{parsed_query.netloc}",
+        }
+    return display_data
+
+
+def _format_item(item, display_data):
+    query_data = display_data.get(item[5])
+    if query_data is None:
+        # The query was changed after the page was prepared
+        query_data = _get_query_display_data([(None, item[5], None, item[7])])[item[5]]
+    return {
+        "title": item[1],
+        "price": item[2],
+        "currency": item[3],
+        "timestamp": datetime.fromtimestamp(item[4]).strftime("%Y-%m-%d %H:%M:%S"),
+        "query": query_data["display"],
+        "url": f"{query_data['base_url']}/items/{item[0]}",
+        "photo_url": item[6],
+    }
+
+
 @app.route("/items")
 def items():
     query_id = request.args.get("query", "")  # Default to empty string instead of None
-    limit = int(request.args.get("limit", 50))
-
-    # Get items
-    query_string = None
-    if query_id:
-        # Get the actual query string for the given ID
-        queries = db.get_queries()
-        for q in queries:
-            if str(q[0]) == query_id:
-                query_string = q[1]
-                break
-
-    items_data = db.get_items(limit=limit, query=query_string)
-    formatted_items = []
-
-    for item in items_data:
-        formatted_items.append(
-            {
-                "title": item[1],
-                "price": item[2],
-                "currency": item[3],
-                "timestamp": datetime.fromtimestamp(item[4]).strftime(
-                    "%Y-%m-%d %H:%M:%S"
-                ),
-                # Ugly Ugly Ugly very Ugly eeew but I have to do a proper migration of existing db later else it'll break
-                # Eeew bad me >:c
-                "query": (
-                    item[7] if item[7] else parse_qs(urlparse(item[5]).query).get("search_text", [None])[0]
-                    if parse_qs(urlparse(item[5]).query).get("search_text", [None])[0]
-                    else item[5]
-                ),
-                "url": f"{urlparse(item[5]).scheme}://{urlparse(item[5]).netloc}/items/{item[0]}",
-                "photo_url": item[6],
-            }
+    limit = _get_limit()
+    search = request.args.get("search", "").strip()
+    selected_query_id = int(query_id) if query_id.isdigit() else None
+
+    if search:
+        # Full-text search, best matches first
+        items_data, next_cursor = db.search_items(
+            search,
+            limit=limit,
+            cursor=_decode_cursor(request.args.get("cursor"), float),
+            query_id=selected_query_id,
+        )
+    else:
+        # Most recent items first, the cursor is the (timestamp, item) of the last row shown
+        items_data = db.iter_items(
+            limit=limit,
+            query_id=selected_query_id,
+            before=_decode_cursor(request.args.get("cursor"), int),
         )
+        next_cursor = None
 
-    # Get queries for filter dropdown
+    # Get queries for filter dropdown, their display data is computed once for the whole page
     queries = db.get_queries()
+    display_data = _get_query_display_data(queries)
+
+    formatted_items = []
+    last_item = None
+    for item in items_data:
+        formatted_items.append(_format_item(item, display_data))
+        last_item = item
+    if not search and last_item is not None and len(formatted_items) == limit:
+        next_cursor = (last_item[4], last_item[0])
+
     formatted_queries = []
     selected_query_display = None
     for i, q in enumerate(queries):
-        parsed_query = urlparse(q[1])
-        query_params = parse_qs(parsed_query.query)
-        query_name = (
-            q[3] if q[3] is not None else query_params.get("search_text", [None])[0]
-        )
-        display_name = query_name if query_name else q[0]
+        display_name = display_data[q[1]]["display"]
         # Store display name for selected query
         if query_id == str(q[0]):
             selected_query_display = display_name
@@ -293,6 +395,28 @@ def items():
         selected_query=query_id,
         selected_query_display=selected_query_display,
         limit=limit,
+        search=search,
+        next_cursor=_encode_cursor(next_cursor),
+    )
+
+
+@app.route("/api/items/search")
+def api_search_items():
+    search = request.args.get("q", "").strip()
+    query_id = request.args.get("query", "")
+
+    items_data, next_cursor = db.search_items(
+        search,
+        limit=_get_limit(),
+        cursor=_decode_cursor(request.args.get("cursor"), float),
+        query_id=int(query_id) if query_id.isdigit() else None,
+    )
+    display_data = _get_query_display_data(db.get_queries())
+    return jsonify(
+        {
+            "items": [_format_item(item, display_data) for item in items_data],
+            "next_cursor": _encode_cursor(next_cursor),
+        }
     )
 
 
@@ -304,11 +428,29 @@ def config():
 
 @app.route("/update_config", methods=["POST"])
 def update_config():
+    # All the parameters are saved in a single transaction
+    with db.write_batch():
+        _save_config()
+    # Let the running processes pick up the new values
+    supervisor.send_command("reload_config")
+
+    flash("Configuration updated", "success")
+    return redirect(url_for("config"))
+
+
+def _save_config():
     # Update Telegram parameters
     telegram_enabled = "telegram_enabled" in request.form
     db.set_parameter("telegram_enabled", str(telegram_enabled))
     db.set_parameter("telegram_token", request.form.get("telegram_token", ""))
     db.set_parameter("telegram_chat_id", request.form.get("telegram_chat_id", ""))
+    db.set_parameter(
+        "telegram_digest_window", request.form.get("telegram_digest_window", "0")
+    )
+    db.set_parameter(
+        "telegram_digest_max_items",
+        request.form.get("telegram_digest_max_items", "10"),
+    )
 
     # Update RSS parameters
     rss_enabled = "rss_enabled" in request.form
@@ -322,6 +464,17 @@ def update_config():
         "query_refresh_delay", request.form.get("query_refresh_delay", "60")
     )
     db.set_parameter("banwords", request.form.get("banwords", ""))
+    db.set_parameter("banwords_whole_word", str("banwords_whole_word" in request.form))
+    db.set_parameter(
+        "banwords_ignore_accents", str("banwords_ignore_accents" in request.form)
+    )
+    db.set_parameter(
+        "relist_window_hours", request.form.get("relist_window_hours", "0")
+    )
+    db.set_parameter("photo_dedup_enabled", str("photo_dedup_enabled" in request.form))
+    db.set_parameter(
+        "photo_dedup_budget_ms", request.form.get("photo_dedup_budget_ms", "500")
+    )
 
     # Update Proxy parameters
     check_proxies = "check_proxies" in request.form
@@ -333,28 +486,31 @@ def update_config():
     db.set_parameter("message_template", request.form.get("message_template", ""))
     db.set_parameter("user_agents", request.form.get("user_agents", "[]"))
     db.set_parameter("default_headers", request.form.get("default_headers", "{}"))
+    db_writer_enabled = "db_writer_enabled" in request.form
+    db.set_parameter("db_writer_enabled", str(db_writer_enabled))
+    durable_queues = "durable_queues" in request.form
+    db.set_parameter("durable_queues", str(durable_queues))
+    outbox_enabled = "outbox_enabled" in request.form
+    db.set_parameter("outbox_enabled", str(outbox_enabled))
 
     # Reset proxy cache to force refresh on next use
     db.set_parameter("last_proxy_check_time", "1")
     logger.info("Proxy settings updated, cache reset")
 
-    flash("Configuration updated", "success")
-    return redirect(url_for("config"))
-
 
 @app.route("/control/<process_name>/<action>", methods=["POST"])
 def control_process(process_name, action):
     if process_name not in ["telegram", "rss"]:
         return jsonify({"status": "error", "message": "Invalid process name"})
+    label = "Telegram bot" if process_name == "telegram" else "RSS feed"
+    running = db.get_parameter(f"{process_name}_process_running") == "True"
 
     if action == "start":
-        if process_name == "telegram":
-            # Check current status
-            if db.get_parameter("telegram_process_running") == "True":
-                return jsonify(
-                    {"status": "warning", "message": "Telegram bot already running"}
-                )
+        # Check current status
+        if running:
+            return jsonify({"status": "warning", "message": f"{label} already running"})
 
+        if process_name == "telegram":
             # Check if telegram_token and telegram_chat_id are set
             telegram_token = db.get_parameter("telegram_token")
             telegram_chat_id = db.get_parameter("telegram_chat_id")
@@ -366,55 +522,31 @@ def control_process(process_name, action):
                     }
                 )
 
-            # Update process status in the database
-            # The manager process will detect this and start the process
-            db.set_parameter("telegram_process_running", "True")
-            logger.info("Telegram bot process start requested")
-            return jsonify(
-                {"status": "success", "message": "Telegram bot start requested"}
-            )
-
-        elif process_name == "rss":
-            # Check current status
-            if db.get_parameter("rss_process_running") == "True":
-                return jsonify(
-                    {"status": "warning", "message": "RSS feed already running"}
-                )
-
-            # Update process status in the database
-            # The manager process will detect this and start the process
-            db.set_parameter("rss_process_running", "True")
-            logger.info("RSS feed process start requested")
-            return jsonify({"status": "success", "message": "RSS feed start requested"})
-
     elif action == "stop":
-        if process_name == "telegram":
-            # Check current status
-            if db.get_parameter("telegram_process_running") != "True":
-                return jsonify(
-                    {"status": "warning", "message": "Telegram bot not running"}
-                )
-
-            # Update process status in the database
-            # The manager process will detect this and stop the process
-            db.set_parameter("telegram_process_running", "False")
-            logger.info("Telegram bot process stop requested")
-            return jsonify(
-                {"status": "success", "message": "Telegram bot stop requested"}
-            )
+        # Check current status
+        if not running:
+            return jsonify({"status": "warning", "message": f"{label} not running"})
 
-        elif process_name == "rss":
-            # Check current status
-            if db.get_parameter("rss_process_running") != "True":
-                return jsonify({"status": "warning", "message": "RSS feed not running"})
-
-            # Update process status in the database
-            # The manager process will detect this and stop the process
-            db.set_parameter("rss_process_running", "False")
-            logger.info("RSS feed process stop requested")
-            return jsonify({"status": "success", "message": "RSS feed stop requested"})
+    else:
+        return jsonify({"status": "error", "message": "Invalid action"})
 
-    return jsonify({"status": "error", "message": "Invalid action"})
+    # The database keeps the status for the next start, the supervisor applies it now
+    db.set_parameter(
+        f"{process_name}_process_running", "True" if action == "start" else "False"
+    )
+    logger.info(f"{label} process {action} requested")
+    reply = supervisor.send_command(action, process_name)
+    if reply is None:
+        return jsonify(
+            {
+                "status": "warning",
+                "message": f"{label} {action} saved, it will apply on restart",
+            }
+        )
+    if "error" in reply:
+        return jsonify({"status": "error", "message": reply["error"]})
+    done = "started" if action == "start" else "stopped"
+    return jsonify({"status": "success", "message": f"{label} {done}"})
 
 
 @app.route("/control/status", methods=["GET"])
@@ -423,7 +555,14 @@ def process_status():
     telegram_running = db.get_parameter("telegram_process_running") == "True"
     rss_running = db.get_parameter("rss_process_running") == "True"
 
-    return jsonify({"telegram": telegram_running, "rss": rss_running})
+    return jsonify(
+        {
+            "telegram": telegram_running,
+            "rss": rss_running,
+            # The health of each process, from the supervisor
+            "processes": supervisor.send_command("status"),
+        }
+    )
 
 
 @app.route("/allowlist")
@@ -463,6 +602,227 @@ def clear_allowlist():
     return redirect(url_for("allowlist"))
 
 
+# Labels and value hints of the filter rules, by rule type
+FILTER_RULE_LABELS = {
+    "price_min": ("Minimum price", "e.g. 10"),
+    "price_max": ("Maximum price", "e.g. 50"),
+    "brand_include": ("Only brands", "Comma separated, e.g. Nike, Adidas"),
+    "brand_exclude": ("Exclude brands", "Comma separated, e.g. Shein"),
+    "size_include": ("Only sizes", "Comma separated, e.g. M, L"),
+    "size_exclude": ("Exclude sizes", "Comma separated, e.g. XS"),
+    "title_regex": ("Title must match", "Regular expression, e.g. air ?max"),
+    "title_exclude_regex": (
+        "Title must not match",
+        "Regular expression, e.g. fake|replica",
+    ),
+    "seller_exclude": ("Exclude sellers", "Comma separated logins or ids"),
+    "seller_country": (
+        "Seller countries",
+        "Comma separated codes, e.g. FR, BE (slower)",
+    ),
+}
+
+
+@app.route("/filters")
+def filter_rules():
+    queries = db.get_queries()
+    display_data = _get_query_display_data(queries)
+    query_names = {q[0]: display_data[q[1]]["display"] for q in queries}
+
+    rules = [
+        {
+            "id": rule_id,
+            "query": query_names.get(query_id, "All queries"),
+            "rule": FILTER_RULE_LABELS.get(rule, (rule,))[0],
+            "value": value,
+        }
+        for rule_id, query_id, rule, value in db.get_filter_rules()
+    ]
+    return render_template(
+        "filters.html",
+        rules=rules,
+        queries=[{"query_id": q[0], "display": query_names[q[0]]} for q in queries],
+        rule_types=FILTER_RULE_LABELS,
+    )
+
+
+@app.route("/add_filter_rule", methods=["POST"])
+def add_filter_rule():
+    query_id = request.form.get("query", "")
+    message, success = core.process_add_filter_rule(
+        int(query_id) if query_id.isdigit() else None,
+        request.form.get("rule", ""),
+        request.form.get("value", ""),
+    )
+    flash(message, "success" if success else "error")
+    return redirect(url_for("filter_rules"))
+
+
+@app.route("/remove_filter_rule/<int:rule_id>", methods=["POST"])
+def remove_filter_rule(rule_id):
+    db.remove_filter_rule(rule_id)
+    flash("Rule removed", "success")
+    return redirect(url_for("filter_rules"))
+
+
+@app.route("/routes")
+def telegram_routes():
+    queries = db.get_queries()
+    display_data = _get_query_display_data(queries)
+    query_names = {q[0]: display_data[q[1]]["display"] for q in queries}
+
+    routes = [
+        {
+            "id": route_id,
+            "query": query_names.get(query_id, "All queries"),
+            "chat_id": chat_id,
+        }
+        for route_id, query_id, chat_id in db.get_telegram_routes()
+    ]
+    return render_template(
+        "routes.html",
+        routes=routes,
+        queries=[{"query_id": q[0], "display": query_names[q[0]]} for q in queries],
+        default_chat=db.get_parameter("telegram_chat_id"),
+    )
+
+
+@app.route("/add_route", methods=["POST"])
+def add_telegram_route():
+    query_id = request.form.get("query", "")
+    message, success = core.process_add_telegram_route(
+        int(query_id) if query_id.isdigit() else None,
+        request.form.get("chat_id", ""),
+    )
+    flash(message, "success" if success else "error")
+    return redirect(url_for("telegram_routes"))
+
+
+@app.route("/remove_route/<int:route_id>", methods=["POST"])
+def remove_telegram_route(route_id):
+    db.remove_telegram_route(route_id)
+    flash("Route removed", "success")
+    return redirect(url_for("telegram_routes"))
+
+
+# What each latency stage measures, from the previous stage of the item
+LATENCY_STAGES = {
+    "fetch_start": "Listed to search started",
+    "fetch_end": "Search request",
+    "enqueued": "Scraper processing",
+    "picked": "Waiting for the extractor",
+    "filtered": "Filters and checks",
+    "dispatched": "Waiting for the dispatcher",
+    "sent": "Waiting for the plugin and sending",
+    "total": "Total, listed to sent",
+}
+
+
+@app.route("/latency")
+def latency_view():
+    query_id = request.args.get("query", "")
+    queries = db.get_queries()
+    display_data = _get_query_display_data(queries)
+    query_names = {
+        str(query[0]): display_data[query[1]]["display"] for query in queries
+    }
+
+    sinks = {}
+    for sink in ("telegram", "rss"):
+        snapshot = stats.read(f"latency_{sink}")
+        if not snapshot:
+            continue
+        # The queries are merged unless one was picked
+        merged = {}
+        for snapshot_query, stages in snapshot["queries"].items():
+            if query_id and snapshot_query != query_id:
+                continue
+            for stage, histogram in stages.items():
+                histogram = stats.Histogram.from_snapshot(histogram)
+                if stage in merged:
+                    merged[stage].merge(histogram)
+                else:
+                    merged[stage] = histogram
+        sinks[sink] = [
+            (LATENCY_STAGES[stage], merged[stage].snapshot())
+            for stage in (*latency.STAGES[1:], "total")
+            if stage in merged
+        ]
+
+    return render_template(
+        "latency.html",
+        sinks=sinks,
+        queries=query_names,
+        query_id=query_id,
+    )
+
+
+@app.route("/metrics")
+def metrics_view():
+    # Scraped by Prometheus, the snapshots of every process are merged
+    return app.response_class(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+def _running_processes():
+    # The running processes are the ones publishing their metrics
+    return stats.read_all("metrics_", max_age=3 * metrics.PUBLISH_INTERVAL).keys()
+
+
+@app.route("/profiles")
+def profiles():
+    processes = sorted(_running_processes())
+    return render_template(
+        "profiles.html",
+        processes=processes,
+        pending=profiling.pending(),
+        profiles=[
+            {
+                "name": name,
+                "process": process,
+                "finished": datetime.fromtimestamp(finished).strftime(
+                    "%Y-%m-%d %H:%M:%S"
+                ),
+                "size": size,
+            }
+            for name, process, finished, size in profiling.list_profiles()
+        ],
+        max_seconds=profiling.MAX_SECONDS,
+    )
+
+
+@app.route("/profiles/start", methods=["POST"])
+def start_profile():
+    process = request.form.get("process", "")
+    try:
+        seconds = int(request.form.get("seconds", ""))
+    except ValueError:
+        flash("Invalid duration", "error")
+        return redirect(url_for("profiles"))
+    if process not in _running_processes():
+        flash(f"The {process} process isn't running", "error")
+    elif not 1 <= seconds <= profiling.MAX_SECONDS:
+        flash(
+            f"The duration must be between 1 and {profiling.MAX_SECONDS} seconds",
+            "error",
+        )
+    else:
+        profiling.request(process, seconds)
+        flash(f"Profiling the {process} process for {seconds} seconds", "success")
+    return redirect(url_for("profiles"))
+
+
+@app.route("/profiles/<name>")
+def download_profile(name):
+    if name not in [profile[0] for profile in profiling.list_profiles()]:
+        abort(404)
+    return send_from_directory(
+        os.path.abspath(profiling.PROFILES_DIR),
+        name,
+        mimetype="text/plain",
+        as_attachment=True,
+    )
+
+
 @app.route("/logs")
 def logs():
     return render_template("logs.html")
@@ -534,8 +894,12 @@ def api_logs():
     return jsonify({"logs": log_entries, "total": total_matching_entries})
 
 
-def web_ui_process():
+def web_ui_process(writer=None, channel=None):
     logger.info("Web UI process started")
+    db_writer.attach(writer, "web_ui")
+    metrics.start("web_ui")
+    profiling.start("web_ui")
+    supervisor.attach(channel)
     try:
         app.run(host="0.0.0.0", port=8000, debug=False)
     except (KeyboardInterrupt, SystemExit):
@@ -0,0 +1,147 @@
+import marshal
+
+# Format version, the first byte of every message. Bump it when the fields below change.
+VERSION = 1
+
+# The item fields sent from the scraper to the extractor, in this order
+ITEM_FIELDS = (
+    "id",
+    "title",
+    "brand_title",
+    "size_title",
+    "currency",
+    "price",
+    "photo",
+    "url",
+    "user_id",
+    "user_login",
+    "raw_timestamp",
+)
+
+
+class ItemRecord:
+    """
+    The fields of an item needed after scraping, without the raw API data.
+
+    It has the same attributes as Item for these fields, so the extractor and the
+    filters work the same with both.
+    """
+
+    __slots__ = ITEM_FIELDS
+
+    def __init__(self, *values):
+        for field, value in zip(ITEM_FIELDS, values):
+            setattr(self, field, value)
+
+    @property
+    def buy_url(self):
+        # Same as Item.buy_url
+        return (
+            self.url.split("items")[0]
+            + "transaction/buy/new?source_screen=item&transaction%5Bitem_id%5D="
+            + str(self.id)
+        )
+
+
+def _dumps(value):
+    return bytes((VERSION,)) + marshal.dumps(value)
+
+
+def _loads(data):
+    if data[0] != VERSION:
+        raise ValueError(f"Unsupported message version: {data[0]}")
+    return marshal.loads(memoryview(data)[1:])
+
+
+def encode_items(items, query_id, trace=None):
+    """
+    Serialize the items scraped for a query.
+
+    The messages only travel between the processes of the application, which all run the
+    same Python version, so marshal can be used. It's faster and smaller than pickle for
+    plain tuples, but must never be used with data from elsewhere.
+
+    Args:
+        items (list): The items, Item or ItemRecord
+        query_id (int): The query id
+        trace (dict, optional): The time of the scraping stages, see latency.py
+
+    Returns:
+        bytes: The message
+    """
+    return _dumps(
+        (
+            query_id,
+            [tuple(getattr(item, field) for field in ITEM_FIELDS) for item in items],
+            trace or {},
+        )
+    )
+
+
+def decode_items(data):
+    """
+    Deserialize the items scraped for a query.
+
+    Args:
+        data (bytes): A message made by encode_items
+
+    Returns:
+        tuple: (list of ItemRecord, query id, trace)
+    """
+    query_id, records, *trace = _loads(data)
+    # Messages queued by an older version have no trace
+    return [ItemRecord(*record) for record in records], query_id, (trace or [{}])[0]
+
+
+def encode_notification(notification):
+    """
+    Serialize a new item notification.
+
+    Args:
+        notification (tuple): (fields, url, text, buy_url, buy_text, trace), trace is
+            (query id, {stage: time}), see latency.py
+
+    Returns:
+        bytes: The message
+    """
+    return _dumps(tuple(notification))
+
+
+def decode_notification(data):
+    """
+    Deserialize a new item notification.
+
+    Args:
+        data (bytes): A message made by encode_notification
+
+    Returns:
+        tuple: (fields, url, text, buy_url, buy_text, trace), without the trace for
+            notifications queued by an older version
+    """
+    return _loads(data)
+
+
+def encode_dispatch(notification, queued_at, priority, boost):
+    """
+    Wrap a notification for the dispatcher, with what it needs to order it.
+
+    Args:
+        notification (bytes): A message made by encode_notification
+        queued_at (float): When the item was found, as returned by time.time()
+        priority (int): The priority of the item query, see priorities.py
+        boost (float): Seconds the item goes before the items queued after it
+
+    Returns:
+        bytes: The message
+    """
+    return _dumps((queued_at, priority, boost, notification))
+
+
+def decode_dispatch(data):
+    """
+    Unwrap a notification made by encode_dispatch.
+
+    Returns:
+        tuple: (queued_at, priority, boost, notification)
+    """
+    return _loads(data)